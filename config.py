@@ -31,3 +31,127 @@ ENABLE_RELATED_USER_MEMORY = False
 ENABLE_FILE_LOG = False
 ENABLE_PER_USER_RESULT = False
 DIALOGUE_MAX_WORKERS = 16  # 多用户对话生成的并行进程数
+# 共享检索资源（Embedding 模型 + 两个 FAISS 索引）的预加载方式：
+# "parent": 父进程加载后 fork，worker 通过 copy-on-write 只读共享（仅 fork 启动方式 + CPU 设备可用）
+# "worker": 每个 worker 进程初始化时加载一次，供该 worker 的所有对话复用
+PRELOAD_MODE = "parent"
+
+# 单进程异步模式：用协程 + AsyncOpenAI 并发驱动大量对话，替代多进程池
+ASYNC_MODE = False
+ASYNC_MAX_CONCURRENCY = 200  # 同时进行中的对话数上限
+
+# 结果以 JSONL 逐条追加写入；fsync 按条数 / 秒数批量执行
+RESULT_FSYNC_EVERY = 20
+RESULT_FSYNC_INTERVAL = 5.0
+
+# 跨进程共享限流（0 表示不限制）；收到 429 时所有 worker 统一指数退避
+LLM_REQUESTS_PER_MINUTE = 0
+LLM_TOKENS_PER_MINUTE = 0
+LLM_ESTIMATED_COMPLETION_TOKENS = 256  # 预占的输出 token 数，调用完成后按实际用量修正
+LLM_RATE_LIMIT_RETRIES = 5
+LLM_MAX_BACKOFF = 60.0
+
+# LLM 响应磁盘缓存（按 model / messages / temperature / response_format 内容寻址）
+# "off" | "readwrite"（只缓存 temperature=0 的调用）| "record"（缓存全部调用）| "replay"（只读，未命中报错，可离线重跑）
+LLM_CACHE_MODE = "off"
+LLM_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "output", "llm_cache")
+LLM_CACHE_MAX_MB = 2048  # 超出后按 LRU 淘汰；0 表示不限制
+
+# 分阶段 trace（耗时 / token / 重试），导出 JSONL 与 Chrome trace，结束时打印 p50/p95 统计
+ENABLE_TRACING = True
+TRACE_DIR = "output/traces"
+
+# 进程级共享 keep-alive HTTP 连接池（注入 DialogueController 与 autogen agent 的 OpenAI 客户端）
+ENABLE_SHARED_HTTP_POOL = True
+HTTP_MAX_CONNECTIONS = 100
+HTTP_MAX_KEEPALIVE = 20
+HTTP_KEEPALIVE_EXPIRY = 60.0
+HTTP2 = False  # 需要安装 h2（pip install httpx[http2]）
+
+# 进程池模式下每个 worker 最多预先提交的对话数（profile 流式读取，在途任务数 = worker 数 × 该值）
+PROFILE_INFLIGHT_PER_WORKER = 2
+
+# 相互独立的审查（PROFILE / COHERENCE 等）并发执行，任一项 FAIL 即取消其余审查
+CONCURRENT_REVIEWS = True
+
+# 用户回复的 PROFILE、COHERENCE 审查与意图判断合并为一次 JSON 结构化调用
+FUSED_USER_REVIEW = False
+
+# 意图判断与用户回复审查并发执行（投机），审查通过即可直接进入系统回合；FUSED_USER_REVIEW 开启时不生效
+SPECULATIVE_INTENT = False
+
+# 本地 Embedding 预筛 PROFILE 一致性（modules/profile_screen.py）
+# "off": 关闭；"shadow": 计算分数并与 LLM 结论一起写入 trace（用于校准），仍全部调用 LLM；
+# "on": 分数高于 PASS 阈值直接通过、低于 FAIL 阈值直接否决，只有中间区间调用 LLM
+PROFILE_SCREEN_MODE = "off"
+PROFILE_SCREEN_PASS_THRESHOLD = 0.55
+PROFILE_SCREEN_FAIL_THRESHOLD = 0.10
+# utils/calibrate_profile_screen.py 拟合出的阈值，存在时优先于上面两个默认值
+PROFILE_SCREEN_CALIBRATION_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "output", "profile_screen_calibration.json")
+
+# 本地意图分类器（modules/intent_classifier.py）
+# "off": 只用 LLM；"log": LLM 判断并记录到 INTENT_LOG_PATH 作为训练数据；
+# "on": 本地分类器置信度 >= INTENT_CLASSIFIER_THRESHOLD 时直接采用，否则回退到 LLM（同样记录）
+INTENT_CLASSIFIER_MODE = "off"
+INTENT_CLASSIFIER_THRESHOLD = 0.9
+INTENT_CLASSIFIER_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "output", "intent_classifier.npz")
+INTENT_LOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "output", "intent_log.jsonl")
+
+# 锁步批量模式（modules/batch_api.py）：所有对话逐阶段推进，同一阶段的生成与评审请求合并为一个批量任务提交
+# 需要 ASYNC_MODE（未开启时 main.py 自动切换），ASYNC_MAX_CONCURRENCY 即每批最多的对话数
+BATCH_MODE = False
+BATCH_BACKEND = "local"          # "local": 本地文件替身（逐条调用 BASE_URL）；"openai": OpenAI 兼容 Batch API
+BATCH_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "output", "batches")
+BATCH_FLUSH_IDLE = 2.0           # 秒；未等齐所有对话时，空闲这么久也提交
+BATCH_MAX_REQUESTS = 50000       # 单个批量文件的最大请求数
+BATCH_POLL_INTERVAL = 30.0       # 秒；openai 后端轮询间隔
+BATCH_COMPLETION_WINDOW = "24h"
+BATCH_LOCAL_CONCURRENCY = 16     # local 后端执行请求的线程数
+
+# 每轮并行生成的候选回复数（用户回合与系统回合），并发审查、取第一个通过的候选；1 表示逐个生成、逐个重试
+GENERATION_CANDIDATES = 1
+
+# 每完成一轮保存对话检查点，崩溃 / 出错后从最后一个完整轮次继续（结果写入输出文件后删除）
+ENABLE_CHECKPOINTS = True
+CHECKPOINT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "output", "checkpoints")
+# 出错的 profile 在本次运行结束前的重试次数（有检查点时从中断的轮次继续）
+DIALOGUE_MAX_RETRIES = 2
+
+# 对话历史的 token 预算（估算值，>0 时开启）：最近的消息原样保留，更早的消息增量折叠进滚动摘要（额外的摘要 LLM 调用）
+# 0 表示沿用旧行为（agent 取最近约 10 条消息、审查取最近 3 条）
+HISTORY_TOKEN_BUDGET = 0
+HISTORY_SUMMARY_MAX_TOKENS = 150   # 滚动摘要的长度上限
+HISTORY_BUDGET_FOR_REVIEW = False  # 审查也改用按预算渲染的历史；默认审查仍只看最近 3 条消息
+
+# agent 生成回复的执行方式："autogen" 使用 initiate_chat；"native" 直接用 function calling（工具调用 + 最终回复，通常两次请求）
+AGENT_EXECUTOR = "autogen"
+NATIVE_TOOL_MAX_ROUNDS = 1   # native 模式下最多几轮工具调用，之后强制输出最终回复
+
+# 每个 worker 进程复用 agent：对话结束后归还，下一个对话换绑 profile（system message、记忆范围、seen_movies），不再重新构造
+AGENT_POOL = True
+
+# 用户回合在本地按系统消息（推荐片名 + 原文）预先检索记忆并写进 prompt，省去模型调用 lookup_memory 的一轮请求
+MEMORY_PREFETCH = False
+
+# 系统回合在本地按用户发言与最近历史预先检索电影，把最佳的未推荐候选写进 prompt，一次请求得到推荐（seen_movies 照常记录）
+SPECULATIVE_MOVIE_SEARCH = False
+
+# 系统回复流式生成并逐段按 _review_format 的规则检查，违规立即中止并重新生成（需要 AGENT_EXECUTOR="native"）
+STREAM_FORMAT_ABORT = False
+
+# ---------------------------------------------------------------------------
+# 环境变量覆盖：CFG_<NAME>=<JSON 或字符串>，例如 CFG_BASE_URL=http://127.0.0.1:8765/v1。
+# 供基准测试等场景在子进程中切换配置；新增配置项请写在此段之前。
+import json as _json
+
+for _name in [n for n in list(globals()) if n.isupper()]:
+    _raw = os.environ.get(f"CFG_{_name}")
+    if _raw is None:
+        continue
+    try:
+        globals()[_name] = _json.loads(_raw)
+    except ValueError:
+        globals()[_name] = _raw
+
+for _entry in LLM_CONFIG["config_list"]:
+    _entry.update(model=MODEL_NAME, api_key=API_KEY, base_url=BASE_URL)
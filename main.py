@@ -1,9 +1,24 @@
 import sys
 import os
-import json
+import gc
+import asyncio
+import argparse
+import hashlib
+import itertools
+import multiprocessing
 from datetime import datetime
-from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Iterable, Iterator
 from modules.ControllerAgent import DialogueController
+from modules.tools import preload_shared_resources
+from modules.rate_limiter import create_limiter_from_config, install_limiter, get_limiter
+from modules.profile_source import iter_profiles
+from modules.result_store import JsonlResultSink, load_completed_user_ids, finalize_jsonl
+from modules.tracing import TraceCollector
+from modules.http_pool import CONNECTION_STATS, close_async_http_client
+from modules.batch_api import batch_mode_enabled, batch_summary
+from modules.checkpoint import get_checkpoint_store
 import config
 
 class DualLogger:
@@ -29,16 +44,31 @@ class DualLogger:
         except Exception:
             pass
 
-def load_profiles(profile_path: str) -> list[dict]:
-    if not os.path.exists(profile_path):
-        raise FileNotFoundError(f"Profile not found: {profile_path}")
-    with open(profile_path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    if isinstance(data, list):
-        return data
-    return [data]
+def parse_shard(spec: str) -> tuple[int, int]:
+    """解析 "K/N"（K 从 0 开始），返回 (K, N)。"""
+    try:
+        index_str, count_str = spec.split("/", 1)
+        index, count = int(index_str), int(count_str)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid shard '{spec}', expected K/N such as 3/8")
+    if count <= 0 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"Invalid shard '{spec}', need 0 <= K < N")
+    return index, count
+
+def shard_of(user_id: str, num_shards: int) -> int:
+    """按 user_id 的稳定哈希分片（不依赖 PYTHONHASHSEED，跨机器一致）。"""
+    digest = hashlib.md5(user_id.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % num_shards
+
+def init_worker(limiter):
+    """进程池 initializer：安装父进程创建的共享限流器，并预加载检索资源。"""
+    install_limiter(limiter)
+    preload_shared_resources()
 
-def run_profile_job(profile: dict, idx: int, timestamp: str, log_dir: str, enable_file_log: bool, verbose: bool) -> dict:
+def run_profile_job(
+    profile: dict, idx: int, timestamp: str, log_dir: str, enable_file_log: bool, verbose: bool, resume: bool = False
+) -> tuple[dict, list]:
+    """运行单个对话，返回 (对话结果, trace span 列表)；resume 时从检查点继续。"""
     original_stdout = sys.stdout
     user_id = profile.get("user_id", f"user_{idx}")
     log_path = os.path.join(log_dir, f"run_{timestamp}_{user_id}.log")
@@ -55,9 +85,11 @@ def run_profile_job(profile: dict, idx: int, timestamp: str, log_dir: str, enabl
         controller = DialogueController(
             profile_data=profile,
             output_path="",
-            enable_result_file=False
+            enable_result_file=False,
+            resume_checkpoint=resume,
         )
-        return controller.run()
+        result = controller.run()
+        return result, controller.tracer.records()
     finally:
         if enable_file_log and logger:
             logger.close()
@@ -65,13 +97,183 @@ def run_profile_job(profile: dict, idx: int, timestamp: str, log_dir: str, enabl
             devnull.close()
         sys.stdout = original_stdout
 
+async def run_profiles_async(
+    profiles: Iterable[tuple[int, dict]], concurrency: int, verbose: bool, on_result, resume: bool = False
+) -> list:
+    """
+    单进程异步模式：以协程驱动多个 DialogueController，并发数由 concurrency 限制。
+    对话几乎全部时间都在等待 LLM 返回，协程远比进程轻量。
+    profiles 为 (idx, profile) 迭代器，按需拉取，同时在途的对话不超过 concurrency 个。
+    每完成一个对话即调用 on_result(idx, (result, spans))，返回错误列表 [(idx, profile, 错误信息)]。
+    resume 时对话从检查点继续。
+    """
+    loop = asyncio.get_running_loop()
+    # agent 的 autogen 调用在线程中执行；多候选生成时每个对话同时占用 GENERATION_CANDIDATES 个线程
+    candidates = max(1, int(getattr(config, "GENERATION_CANDIDATES", 1)))
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=concurrency * candidates))
+
+    async def run_one(profile: dict) -> tuple[dict, list]:
+        controller = await asyncio.to_thread(
+            DialogueController,
+            profile_data=profile,
+            output_path="",
+            enable_result_file=False,
+            resume_checkpoint=resume,
+        )
+        result = await controller.a_run()
+        return result, controller.tracer.records()
+
+    original_stdout = sys.stdout
+    devnull = None
+    if not verbose:
+        # 并发对话的详细日志会相互穿插，非 verbose 时直接丢弃
+        devnull = open(os.devnull, "w")
+        sys.stdout = devnull
+
+    errors = []
+    progress = ProgressBar(None, stream=original_stdout)
+    jobs = iter(profiles)
+    tasks = {}
+    try:
+        while True:
+            for idx, profile in itertools.islice(jobs, concurrency - len(tasks)):
+                tasks[asyncio.ensure_future(run_one(profile))] = (idx, profile)
+            if not tasks:
+                break
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                idx, profile = tasks.pop(task)
+                try:
+                    on_result(idx, task.result())
+                except Exception as exc:
+                    errors.append((idx, profile, str(exc)))
+                finally:
+                    progress.update()
+    finally:
+        for task in tasks:
+            task.cancel()
+        progress.close()
+        await close_async_http_client()
+        if devnull:
+            devnull.close()
+        sys.stdout = original_stdout
+    return errors
+
+def run_profiles_in_pool(
+    profiles: Iterable[tuple[int, dict]],
+    workers: int,
+    timestamp: str,
+    log_dir: str,
+    enable_file_log: bool,
+    verbose: bool,
+    on_result,
+    resume: bool = False,
+) -> list:
+    """
+    多进程模式：每个对话在进程池中独立运行，完成即调用 on_result(idx, (result, spans))。
+    profiles 为 (idx, profile) 迭代器，按需提交，在途任务不超过 workers * PROFILE_INFLIGHT_PER_WORKER，
+    resume 时对话从检查点继续；
+    父进程内存不随 profile 总数增长，首批对话也无需等待整个文件读完。
+    worker 进程异常退出（OOM、段错误等）导致进程池损坏时，在途对话记为错误（由调用方从检查点重试），
+    重建进程池后继续处理剩余 profile；连续多次重建都没有对话完成时，剩余 profile 全部记为错误。
+    返回错误列表 [(idx, profile, 错误信息)]。
+    """
+    # 共享检索资源：父进程预加载后 fork（copy-on-write），否则每个 worker 初始化时加载一次
+    preload_mode = getattr(config, "PRELOAD_MODE", "parent")
+    if preload_mode == "parent" and (
+        multiprocessing.get_start_method() != "fork" or config.EMBEDDING_DEVICE != "cpu"
+    ):
+        print("[Init] Fork preload needs the 'fork' start method and a CPU device; falling back to per-worker preload.")
+        preload_mode = "worker"
+    if preload_mode == "parent":
+        preload_shared_resources()
+        # 冻结已加载对象，避免 GC 扫描触碰引用计数导致共享页被复制
+        gc.freeze()
+
+    max_inflight = max(workers, workers * getattr(config, "PROFILE_INFLIGHT_PER_WORKER", 2))
+    max_idle_restarts = 3
+    errors = []
+    jobs = iter(profiles)
+    futures = {}
+    progress = ProgressBar(None)
+    idle_restarts = 0
+
+    def new_executor() -> ProcessPoolExecutor:
+        return ProcessPoolExecutor(max_workers=workers, initializer=init_worker, initargs=(get_limiter(),))
+
+    def collect(fut) -> bool:
+        """处理一个已结束的任务，返回进程池是否已损坏。"""
+        nonlocal idle_restarts
+        idx, profile = futures.pop(fut)
+        try:
+            on_result(idx, fut.result())
+            idle_restarts = 0
+        except BrokenProcessPool as exc:
+            errors.append((idx, profile, f"Worker pool broken: {exc}"))
+            return True
+        except Exception as exc:
+            errors.append((idx, profile, str(exc)))
+        finally:
+            progress.update()
+        return False
+
+    executor = new_executor()
+    try:
+        while True:
+            broken = False
+            for idx, profile in itertools.islice(jobs, max_inflight - len(futures)):
+                try:
+                    fut = executor.submit(
+                        run_profile_job,
+                        profile,
+                        idx,
+                        timestamp,
+                        log_dir,
+                        enable_file_log,
+                        verbose,
+                        resume,
+                    )
+                except BrokenProcessPool as exc:
+                    errors.append((idx, profile, f"Worker pool broken: {exc}"))
+                    progress.update()
+                    broken = True
+                    break
+                futures[fut] = (idx, profile)
+            if not futures and not broken:
+                break
+            if futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    broken = collect(fut) or broken
+            if not broken:
+                continue
+            # 损坏的进程池会让所有在途任务以 BrokenProcessPool 结束，全部收尾后重建
+            for fut in wait(futures).done:
+                collect(fut)
+            executor.shutdown(wait=False, cancel_futures=True)
+            idle_restarts += 1
+            if idle_restarts > max_idle_restarts:
+                remaining = [(idx, profile, "Not started: worker pool kept breaking") for idx, profile in jobs]
+                errors.extend(remaining)
+                print(f"\n[Pool] Worker pool broke {idle_restarts} times without progress; {len(remaining)} profile(s) not started.")
+                break
+            print(f"\n[Pool] A worker process died; rebuilding the pool ({len(errors)} error(s) so far).")
+            executor = new_executor()
+    finally:
+        executor.shutdown()
+        progress.close()
+    return errors
+
 class ProgressBar:
-    def __init__(self, total: int, width: int = 30):
-        self.total = max(total, 0)
+    """total 为 None 时（流式读取、总数未知）只显示已完成数量。"""
+
+    def __init__(self, total: int | None, width: int = 30, stream=None):
+        self.total = None if total is None else max(total, 0)
         self.width = width
         self.current = 0
+        self.stream = stream
         if self.total == 0:
-            print("No profiles to process.")
+            print("No profiles to process.", file=self.stream)
         else:
             self._render()
 
@@ -82,18 +284,32 @@ class ProgressBar:
         self._render()
 
     def _render(self):
+        if self.total is None:
+            print(f"\rProgress: {self.current} done", end="", flush=True, file=self.stream)
+            return
         filled = 0 if self.total == 0 else int(self.width * self.current / self.total)
         bar = "#" * filled + "-" * (self.width - filled)
-        print(f"\rProgress [{bar}] {self.current}/{self.total}", end="", flush=True)
+        print(f"\rProgress [{bar}] {self.current}/{self.total}", end="", flush=True, file=self.stream)
 
     def close(self):
-        if self.total > 0:
-            print()
+        if self.total is None or self.total > 0:
+            print(file=self.stream)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Generate movie-recommendation dialogues from user profiles.")
+    parser.add_argument("--profiles", default="output/sample_profile_100.json", help="Profile file (JSON array, single object or JSONL), read as a stream.")
+    parser.add_argument("--output", default="output/dialogue_10.jsonl", help="JSONL file each finished dialogue is appended to.")
+    parser.add_argument("--limit", type=int, default=10, help="0 表示全量；>0 则仅生成前 N 个 profile")
+    parser.add_argument("--resume", action="store_true", help="Skip user_ids already present in --output, append to it and continue unfinished dialogues from their checkpoints.")
+    parser.add_argument("--shard", type=parse_shard, default=None, help="Only process shard K of N (0-based), e.g. 3/8.")
+    parser.add_argument("--finalize", default="output/dialogue_10.json", help="Write the sorted JSON array here at the end ('' to skip).")
+    return parser.parse_args()
 
 if __name__ == "__main__":
-    PROFILE_SRC = "output/sample_profile_100.json"
-    OUTPUT_DST = "output/dialogue_10.json"
-    PROFILE_LIMIT = 10  # 0 表示全量；>0 则仅生成前 N 个 profile
+    args = parse_args()
+    PROFILE_SRC = args.profiles
+    OUTPUT_DST = args.output
+    PROFILE_LIMIT = args.limit  # 0 表示全量；>0 则仅生成前 N 个 profile
     WORKERS = config.DIALOGUE_MAX_WORKERS
     VERBOSE_LOG = False         # True 时在控制台打印详细对话
     LOG_TO_FILE = False         # True 时将详细日志写入 output/logs
@@ -102,49 +318,107 @@ if __name__ == "__main__":
     os.makedirs(log_dir, exist_ok=True)
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
 
-    profiles = load_profiles(PROFILE_SRC)
-    total_available = len(profiles)
-    if PROFILE_LIMIT and PROFILE_LIMIT > 0:
-        profiles = profiles[:PROFILE_LIMIT]
-    selected_count = len(profiles)
+    completed = set()
+    if args.resume:
+        completed = load_completed_user_ids(OUTPUT_DST)
+        print(f"[Resume] {len(completed)} dialogue(s) already in {OUTPUT_DST} will be skipped.")
+    if args.shard:
+        shard_index, shard_count = args.shard
+        print(f"[Shard] Only processing shard {shard_index}/{shard_count}.")
 
-    indexed_results = []
-    errors = []
-    with ProcessPoolExecutor(max_workers=WORKERS) as executor:
-        futures = {
-            executor.submit(
-                run_profile_job,
-                profile,
-                idx,
-                timestamp,
-                log_dir,
-                LOG_TO_FILE,
-                VERBOSE_LOG,
-            ): idx
-            for idx, profile in enumerate(profiles)
-        }
-        progress = ProgressBar(len(futures))
-        for fut in as_completed(futures):
-            idx = futures[fut]
-            try:
-                res = fut.result()
-                indexed_results.append((idx, res))
-            except Exception as exc:
-                errors.append((idx, str(exc)))
-            finally:
-                progress.update()
-        progress.close()
+    # profile 逐个流式读取、筛选后交给执行器；user_order 只保存 user_id，用于最终排序
+    user_order = []
+    counts = {"read": 0, "selected": 0, "skipped": 0}
+
+    def select_profiles() -> Iterator[tuple[int, dict]]:
+        stream = iter_profiles(PROFILE_SRC)
+        if PROFILE_LIMIT and PROFILE_LIMIT > 0:
+            stream = itertools.islice(stream, PROFILE_LIMIT)
+        for idx, profile in enumerate(stream):
+            counts["read"] += 1
+            user_id = profile.get("user_id", f"user_{idx}")
+            user_order.append(user_id)
+            if args.shard and shard_of(user_id, shard_count) != shard_index:
+                continue
+            counts["selected"] += 1
+            if user_id in completed:
+                counts["skipped"] += 1
+                continue
+            yield idx, profile
+
+    sink = JsonlResultSink(
+        OUTPUT_DST,
+        append=args.resume,
+        fsync_every=config.RESULT_FSYNC_EVERY,
+        fsync_interval=config.RESULT_FSYNC_INTERVAL,
+    )
+
+    # 所有 worker 共用一个限流器（未配置限额时为 None）
+    install_limiter(create_limiter_from_config())
+
+    tracing = getattr(config, "ENABLE_TRACING", True)
+    trace_path = os.path.join(config.TRACE_DIR, f"trace_{timestamp}.jsonl")
+    collector = TraceCollector(trace_path) if tracing else None
 
-    indexed_results.sort(key=lambda x: x[0])
-    all_results = [res for _, res in indexed_results if res is not None]
+    checkpoints = get_checkpoint_store()
 
-    aggregate_payload = all_results
-    os.makedirs(os.path.dirname(OUTPUT_DST) or ".", exist_ok=True)
-    with open(OUTPUT_DST, "w", encoding="utf-8") as f:
-        json.dump(aggregate_payload, f, ensure_ascii=False, indent=2)
+    def on_result(idx: int, payload: tuple[dict | None, list]):
+        res, spans = payload
+        if res is not None:
+            sink.write(res)
+            # 结果已进入输出文件，检查点不再需要
+            if checkpoints is not None:
+                checkpoints.delete(res.get("user_id"))
+        if collector is not None:
+            collector.add(spans)
+
+    if batch_mode_enabled() and not getattr(config, "ASYNC_MODE", False):
+        # 锁步批量需要所有对话在同一个事件循环中推进
+        print("[Batch] BATCH_MODE requires ASYNC_MODE; switching to async mode.")
+        config.ASYNC_MODE = True
+
+    def run_batch(jobs: Iterable[tuple[int, dict]], resume: bool) -> list:
+        if getattr(config, "ASYNC_MODE", False):
+            return asyncio.run(run_profiles_async(jobs, config.ASYNC_MAX_CONCURRENCY, VERBOSE_LOG, on_result, resume))
+        return run_profiles_in_pool(jobs, WORKERS, timestamp, log_dir, LOG_TO_FILE, VERBOSE_LOG, on_result, resume)
+
+    try:
+        if getattr(config, "ASYNC_MODE", False):
+            # 单进程异步模式：资源在当前进程加载一次，所有协程共享
+            preload_shared_resources()
+        # 检查点只在 --resume 时沿用上次运行留下的；否则对话从头开始并覆盖旧检查点
+        errors = run_batch(select_profiles(), resume=args.resume)
+        # 出错的对话重新排队；开启检查点时从最后一个完整轮次继续，而不是从头生成
+        for attempt in range(1, getattr(config, "DIALOGUE_MAX_RETRIES", 0) + 1):
+            if not errors:
+                break
+            print(f"[Retry] Attempt {attempt}: re-running {len(errors)} failed dialogue(s).")
+            errors = run_batch([(idx, profile) for idx, profile, _ in errors], resume=True)
+    finally:
+        sink.close()
+        if collector is not None:
+            collector.close()
 
-    print(f"\nSaved {len(aggregate_payload)} dialogues (requested: {selected_count}, available: {total_available}) to {OUTPUT_DST}")
+    print(
+        f"\nSaved {sink.written} new dialogues (skipped: {counts['skipped']}, selected: {counts['selected']}, "
+        f"read: {counts['read']}) to {OUTPUT_DST}"
+    )
+    if args.finalize:
+        total = finalize_jsonl(OUTPUT_DST, args.finalize, user_order)
+        print(f"Finalized {total} dialogues to {args.finalize}")
+    if collector is not None:
+        chrome_path = trace_path[: -len(".jsonl")] + ".chrome.json"
+        collector.export_chrome_trace(chrome_path)
+        print(f"\nTrace spans: {trace_path} (Chrome trace: {chrome_path})")
+        print(collector.summary())
+    if getattr(config, "ASYNC_MODE", False):
+        # 异步模式下所有对话共用本进程的连接池，直接读取进程级统计
+        http = CONNECTION_STATS.snapshot()
+        print(f"HTTP connection reuse (process): {http['reuse_rate']:.1%} "
+              f"({http['requests']} requests, {http['new_connections']} new connections)")
+    if batch_mode_enabled():
+        print(batch_summary())
     if errors:
         print(f"Completed with {len(errors)} error(s):")
-        for idx, msg in errors:
+        for idx, _, msg in errors:
             print(f"  - Profile #{idx}: {msg}")
@@ -1,11 +1,30 @@
+import asyncio
+import contextlib
+import contextvars
+import functools
 import json
 import os
-import re
-from openai import OpenAI
-from typing import Tuple
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Literal, Tuple
+import openai
+from pydantic import BaseModel, Field
 import config
+from modules.llm_client import AsyncChatClient
+from modules.llm_cache import CacheMissError
+from modules.tracing import Tracer, annotate_span
+from modules.profile_screen import create_profile_screen
+from modules.intent_classifier import get_local_intent_judge, log_intent_decision
+from modules.http_pool import CONNECTION_STATS
+from modules.batch_api import get_batch_dispatcher, BatchRequestError
+from modules.checkpoint import get_checkpoint_store, profile_fingerprint
+from modules.history import RollingHistory, format_messages, stable_window
 from modules.UserAgent import UserAgent
-from modules.SystemAgent import SystemAgent
+from modules.SystemAgent import SystemAgent, TitleClaims
+from modules.agent_pool import get_agent_pool
+from modules.format_rules import format_issues
+from modules.tool_loop import StreamAbortedError
+from modules.tools import get_rss_mb
 
 def print_section(title, char="=", length=60):
     print(f"\n{char * length}")
@@ -19,6 +38,81 @@ def print_final_response(role, content):
     print(f"{content}")
     print(f"{border}\n")
 
+class UserTurnReview(BaseModel):
+    """融合审查（FUSED_USER_REVIEW）一次调用返回的结构化结果。"""
+    profile_ok: bool = Field(..., description="Does the response match the user's PROFILE (tone, persona, verbosity, preferences)?")
+    profile_reason: str = Field("", description="One-line reason when profile_ok is false.")
+    coherence_ok: bool = Field(..., description="Is the response coherent with the conversation history?")
+    coherence_reason: str = Field("", description="One-line reason when coherence_ok is false.")
+    intent: Literal["ACCEPT", "REJECT", "INQUIRY"] = Field(..., description="The user's intent towards the recommendation.")
+
+# 与对话无关的固定审查指令，作为 system 消息放在请求最前面，所有对话共享同一前缀
+COHERENCE_REVIEW_INSTRUCTIONS = """
+        Check if the user's response is coherent with the conversation history.
+        
+        **Review Task:**
+        Check if the response:
+        1. Responds appropriately to the system's last message
+        2. Is consistent with previously expressed views
+        3. Does not contain obvious logical contradictions
+        4. Maintains conversation flow naturally
+        
+        **Output Format:**
+        If coherent, output: PASS
+        If not coherent, output: FAIL|specific reason (e.g., does not respond to system's question, contradicts previous statement, etc.)
+        """
+
+INTENT_JUDGE_INSTRUCTIONS = """
+        Analyze the user response in a movie recommendation context.
+        
+        Classify into EXACTLY one category:
+        1. ACCEPT: User agrees to watch the movie.
+        2. REJECT: User expresses disinterest or dislike.
+        3. INQUIRY: User is answering a question, chatting, or asking info (neutral).
+        
+        Output ONLY the category word.
+        """
+
+HISTORY_SUMMARY_INSTRUCTIONS = """
+        You maintain a running summary of a movie-recommendation dialogue between a User and a System.
+        Update the existing summary with the new messages. Keep: the user's stated mood and preferences,
+        every movie the system recommended and how the user reacted to it, and any open question.
+        Write plain prose in at most {max_tokens} tokens. Output ONLY the updated summary.
+        """
+
+# 历史渲染时各角色的显示名（与 agent 原先拼接历史时的写法一致）
+USER_VIEW = {"system": "System", "user": "You (User)"}
+SYSTEM_VIEW = {"user": "User", "system": "You (System)"}
+REVIEW_VIEW = {"system": "System", "user": "User"}
+
+# 审查 / 意图判断 / 摘要不能吞掉的错误（限流重试耗尽、回放缓存未命中、批量请求失败）：
+# 吞掉后审查会默认 PASS、意图默认 INQUIRY，生成的数据悄悄失真，必须交给上层把该对话记为失败
+FATAL_LLM_ERRORS = (openai.RateLimitError, CacheMissError, BatchRequestError)
+
+_WORKER_LOOP = None
+_LOCAL_MODEL_EXECUTOR = None
+
+def _get_worker_loop() -> asyncio.AbstractEventLoop:
+    """进程内复用的事件循环（fork 出的 worker 各自创建）。"""
+    global _WORKER_LOOP
+    if _WORKER_LOOP is None or _WORKER_LOOP.is_closed():
+        _WORKER_LOOP = asyncio.new_event_loop()
+        asyncio.set_event_loop(_WORKER_LOOP)
+    return _WORKER_LOOP
+
+async def _run_local_model(fn, *args):
+    """
+    本地模型推理（预筛、意图分类）放在独立线程池中执行，与 asyncio.to_thread 一样复制上下文。
+    默认线程池可能全部被等待批量结果的 agent 线程占住（BATCH_MODE），本地推理不能排在它们后面。
+    """
+    global _LOCAL_MODEL_EXECUTOR
+    if _LOCAL_MODEL_EXECUTOR is None:
+        _LOCAL_MODEL_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="local-model")
+    ctx = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(
+        _LOCAL_MODEL_EXECUTOR, functools.partial(ctx.run, fn, *args)
+    )
+
 class DialogueController:
     def __init__(
         self,
@@ -26,7 +120,9 @@ class DialogueController:
         output_path: str = "",
         profile_data: dict | None = None,
         enable_result_file: bool = True,
+        resume_checkpoint: bool = False,
     ):
+        """resume_checkpoint: 从已有检查点继续（main.py 仅在 --resume 与失败重试时开启）；否则从头开始并覆盖旧检查点。"""
         self.profile_path = profile_path
         self.output_path = output_path
         self.enable_result_file = enable_result_file
@@ -35,37 +131,72 @@ class DialogueController:
         
         print(f"--- Initializing AutoGen Controller for User: {self.user_profile.get('user_id')} ---")
         
-        self.user_agent = UserAgent(self.user_profile)
-        self.system_agent = SystemAgent()
+        init_start = time.perf_counter()
+        # AGENT_POOL 开启时从进程内的 agent 池取用（换绑 profile），对话成功结束后归还
+        self.agent_pool = get_agent_pool()
+        self.user_agent = self._new_user_agent()
+        self.system_agent = self._new_system_agent()
         
-        self.client = OpenAI(api_key=config.API_KEY, base_url=config.BASE_URL)
+        self.llm = AsyncChatClient()
+        self.profile_screen = create_profile_screen(self.user_profile)
+        self.intent_classifier = get_local_intent_judge()
+        self.tracer = Tracer(self.user_profile.get("user_id"), enabled=getattr(config, "ENABLE_TRACING", True))
+        self.init_seconds = time.perf_counter() - init_start
+        print(f"[Init] Controller ready in {self.init_seconds:.2f}s (RSS {get_rss_mb():.1f} MB)")
         
         self.raw_log = [] 
+        self._profile_review_prompt = None
+        # 多候选生成（GENERATION_CANDIDATES > 1）时的 agent 池与未完成的候选生成，首次使用时创建
+        self.candidate_count = max(1, int(getattr(config, "GENERATION_CANDIDATES", 1)))
+        self._user_candidates = None
+        self._system_candidates = None
+        self._stragglers = {}
+        self.checkpoints = get_checkpoint_store()
+        self.resume_checkpoint = resume_checkpoint
+        # HISTORY_TOKEN_BUDGET > 0 时 agent（可选地包括审查）使用按 token 预算截断的历史（摘要 + 最近消息）
+        history_budget = getattr(config, "HISTORY_TOKEN_BUDGET", 0)
+        self.history = RollingHistory(history_budget) if history_budget > 0 else None
         self.rejection_count = 0
         self.turn_count = 0
         self.is_finished = False
 
+    def _new_user_agent(self) -> UserAgent:
+        if self.agent_pool is not None:
+            return self.agent_pool.acquire_user_agent(self.user_profile)
+        return UserAgent(self.user_profile)
+
+    def _new_system_agent(self) -> SystemAgent:
+        if self.agent_pool is not None:
+            return self.agent_pool.acquire_system_agent()
+        return SystemAgent()
+
+    def _release_agents(self):
+        """把本对话用过的 agent（含多候选 agent）归还 agent 池。"""
+        if self.agent_pool is None:
+            return
+        agents = [self.user_agent, self.system_agent] + (self._user_candidates or []) + (self._system_candidates or [])
+        unique = list({id(agent): agent for agent in agents}.values())
+        self.agent_pool.release(unique)
+
     def _load_profile(self) -> dict:
         if not os.path.exists(self.profile_path):
             raise FileNotFoundError(f"Profile not found: {self.profile_path}")
         with open(self.profile_path, 'r', encoding='utf-8') as f:
             return json.load(f)
     
-    def _review_user_response(self, user_response: str) -> tuple[bool, str]:
-        """
-        审核 UserAgent 生成的回复是否符合 PROFILE
-        返回: (是否符合, 反馈信息)
-        """
-        reflections = self.user_profile.get("reflections", {})
-        style = self.user_profile.get("dialogue_style", {})
-        
-        persona = reflections.get("spectator_persona", "")
-        tone = style.get("tone", "")
-        preferences = reflections.get("aesthetic_preferences", [])
-        verbosity = style.get("verbosity", "") 
-        decision_logic = reflections.get("decision_logic", "")
-        
-        prompt = f"""
+    def _profile_review_instructions(self) -> str:
+        """PROFILE 审查的固定部分（指令 + 画像），每个对话只拼一次，保证每次请求的前缀完全一致。"""
+        if self._profile_review_prompt is None:
+            reflections = self.user_profile.get("reflections", {})
+            style = self.user_profile.get("dialogue_style", {})
+            
+            persona = reflections.get("spectator_persona", "")
+            tone = style.get("tone", "")
+            preferences = reflections.get("aesthetic_preferences", [])
+            verbosity = style.get("verbosity", "") 
+            decision_logic = reflections.get("decision_logic", "")
+            
+            self._profile_review_prompt = f"""
         You are a reviewer responsible for checking if a user's response matches their personal profile (PROFILE).
         
         **User PROFILE Information:**
@@ -75,9 +206,6 @@ class DialogueController:
         - Verbosity: {verbosity}
         - Decision Logic: {decision_logic}
         
-        **User's Generated Response:**
-        "{user_response}"
-        
         **Review Task:**
         Please check if the user's response matches their PROFILE. Pay special attention to:
         1. Whether the response's tone matches the tone specified in the PROFILE
@@ -91,17 +219,40 @@ class DialogueController:
         
         If it does not match, please briefly explain the specific reason in one line (e.g., tone is too formal and does not match conversational style, content does not reflect persona characteristics, etc.).
         Format: FAIL|reason explanation
+        """
+        return self._profile_review_prompt
+
+    async def _review_user_response(self, user_response: str) -> tuple[bool, str]:
+        """
+        审核 UserAgent 生成的回复是否符合 PROFILE
+        返回: (是否符合, 反馈信息)
+        """
+        screen_score = None
+        if self.profile_screen is not None:
+            # 本地预筛：高置信度时直接给出结论，省去一次 LLM 调用
+            screen_score = await _run_local_model(self.profile_screen.score, user_response)
+            annotate_span(screen_score=round(screen_score, 4))
+            if getattr(config, "PROFILE_SCREEN_MODE", "off") == "on":
+                verdict = self.profile_screen.decide(screen_score)
+                if verdict is not None:
+                    annotate_span(screen_verdict="PASS" if verdict else "FAIL")
+                    if verdict:
+                        return True, ""
+                    return False, f"Response does not reflect the persona, tone or preferences in the PROFILE (local score {screen_score:.2f})"
+
+        # 不变的指令与画像放在 system 消息中作为公共前缀，每轮变化的回复放在最后
+        prompt = f"""
+        **User's Generated Response:**
+        "{user_response}"
         
         **Output:**
         """
         
         try:
-            resp = self.client.chat.completions.create(
-                model=config.MODEL_NAME,
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.0
-            )
-            result = resp.choices[0].message.content.strip()
+            result = await self.llm.chat(prompt, temperature=0.0, system=self._profile_review_instructions())
+            if screen_score is not None:
+                # 与本地分数一起记入 trace，供 utils/calibrate_profile_screen.py 校准阈值
+                annotate_span(llm_pass=not result.upper().startswith("FAIL"))
             
             if result.upper().startswith("PASS"):
                 return True, ""
@@ -113,12 +264,14 @@ class DialogueController:
             else:
                 # 如果输出格式不符合预期，默认为通过（避免过于严格）
                 return True, ""
+        except FATAL_LLM_ERRORS:
+            raise
         except Exception as e:
             print(f"    [REVIEW ERROR]: {e}")
             # 出错时默认通过，避免阻塞流程
             return True, ""
 
-    def _review_coherence(self, user_response: str) -> Tuple[bool, str]:
+    async def _review_coherence(self, user_response: str) -> Tuple[bool, str]:
         """
         审查对话连贯性：检查回复是否与对话历史连贯
         返回: (是否连贯, 反馈信息)
@@ -126,39 +279,18 @@ class DialogueController:
         if len(self.raw_log) < 2:
             return True, ""  # 对话刚开始，无法检查连贯性
         
-        # 获取最近3轮对话作为上下文
-        recent_history = self.raw_log[-3:] if len(self.raw_log) >= 3 else self.raw_log
-        
         prompt = f"""
-        Check if the user's response is coherent with the conversation history.
-        
         **Recent Conversation History:**
-        {json.dumps(recent_history, ensure_ascii=False)}
+        {self._review_history()}
         
         **User's Current Response:**
         "{user_response}"
         
-        **Review Task:**
-        Check if the response:
-        1. Responds appropriately to the system's last message
-        2. Is consistent with previously expressed views
-        3. Does not contain obvious logical contradictions
-        4. Maintains conversation flow naturally
-        
-        **Output Format:**
-        If coherent, output: PASS
-        If not coherent, output: FAIL|specific reason (e.g., does not respond to system's question, contradicts previous statement, etc.)
-        
         **Output:**
         """
         
         try:
-            resp = self.client.chat.completions.create(
-                model=config.MODEL_NAME,
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.0
-            )
-            result = resp.choices[0].message.content.strip()
+            result = await self.llm.chat(prompt, temperature=0.0, system=COHERENCE_REVIEW_INSTRUCTIONS)
             
             if result.upper().startswith("PASS"):
                 return True, ""
@@ -168,11 +300,13 @@ class DialogueController:
                 return False, reason
             else:
                 return True, ""
+        except FATAL_LLM_ERRORS:
+            raise
         except Exception as e:
             print(f"    [COHERENCE REVIEW ERROR]: {e}")
             return True, ""
     
-    def _review_recommendation_quality(self, system_response: str) -> Tuple[bool, str]:
+    async def _review_recommendation_quality(self, system_response: str) -> Tuple[bool, str]:
         """
         审查推荐质量：检查系统推荐是否符合用户需求
         返回: (是否符合, 反馈信息)
@@ -187,18 +321,13 @@ class DialogueController:
         if "**" not in system_response and "recommend" not in system_response.lower():
             return True, ""  # 不是推荐回复，跳过检查
         
-        prompt = f"""
+        # 指令与用户偏好在对话内不变，放在 system 前缀中
+        instructions = f"""
         Check if the movie recommendation matches user needs and preferences.
         
         **User Preferences:**
         {json.dumps(user_preferences, ensure_ascii=False)}
         
-        **User's Last Message:**
-        "{user_last_msg}"
-        
-        **System's Recommendation:**
-        "{system_response}"
-        
         **Review Task:**
         Check if the recommendation:
         1. Addresses the user's specific requests
@@ -210,17 +339,19 @@ class DialogueController:
         **Output Format:**
         If the recommendation is good, output: PASS
         If the recommendation has issues, output: FAIL|specific reason (e.g., does not match user preferences, recommends multiple movies, etc.)
+        """
+        prompt = f"""
+        **User's Last Message:**
+        "{user_last_msg}"
+        
+        **System's Recommendation:**
+        "{system_response}"
         
         **Output:**
         """
         
         try:
-            resp = self.client.chat.completions.create(
-                model=config.MODEL_NAME,
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.0
-            )
-            result = resp.choices[0].message.content.strip()
+            result = await self.llm.chat(prompt, temperature=0.0, system=instructions)
             
             if result.upper().startswith("PASS"):
                 return True, ""
@@ -230,128 +361,346 @@ class DialogueController:
                 return False, reason
             else:
                 return True, ""
+        except FATAL_LLM_ERRORS:
+            raise
         except Exception as e:
             print(f"    [RECOMMENDATION REVIEW ERROR]: {e}")
             return True, ""
     
+    def _stream_abort_enabled(self, final_attempt: bool) -> bool:
+        """
+        STREAM_FORMAT_ABORT 开启时系统回复流式生成、违规即中止；最后一次尝试需要完整回复，不中止。
+        多候选生成时按候选判断：只有占用最后一个名额的候选不中止，同一轮的其他候选照常中止。
+        """
+        return bool(getattr(config, "STREAM_FORMAT_ABORT", False)) and not final_attempt
+
+    @staticmethod
+    def _stream_abort_feedback(error: StreamAbortedError) -> str:
+        # 与 _review_system_response 的格式反馈一致
+        return f"[FORMAT] Format issues: {', '.join(error.issues)}"
+
     def _review_format(self, response: str, role: str) -> Tuple[bool, str]:
         """
         审查回复格式：检查是否符合格式要求
         返回: (是否符合, 反馈信息)
         """
-        issues = []
-        
-        # 检查是否使用了编号列表
-        if re.search(r'^\d+[\.\)]\s', response, re.MULTILINE):
-            issues.append("Contains numbered list")
-        
-        # 检查是否使用了项目符号
-        if re.search(r'^[-*•]\s', response, re.MULTILINE):
-            issues.append("Contains bullet points")
-        
-        # 对于系统回复，检查是否使用了机器人式标题
-        if role == "system":
-            if re.search(r'\*\*[^*]+:\*\*', response) or re.search(r'\*\*[^*]+\*\*:', response):
-                issues.append("Contains robotic headers like '**Plot:**' or '**Why this fits:**'")
-        
-        # 检查是否包含多个电影推荐（系统回复）
-        if role == "system":
-            movie_titles = re.findall(r'\*\*"([^"]+)"\*\*', response)
-            if len(movie_titles) > 1:
-                issues.append(f"Recommends multiple movies ({len(movie_titles)} movies found)")
-        
+        issues = format_issues(response, role)
         if issues:
             return False, f"Format issues: {', '.join(issues)}"
         
         return True, ""
     
-    def _review_user_response_comprehensive(self, user_response: str) -> Tuple[bool, str]:
+    async def _run_review_checks(self, checks: list) -> Tuple[bool, str]:
+        """
+        执行多项相互独立的审查，任一项 FAIL 即返回，其余仍在进行的审查直接取消。
+        checks: [(检查名, span 名, 返回审查协程的函数)]
+        CONCURRENT_REVIEWS 开启时各项并发执行，否则按顺序逐项执行。
+        返回: (是否通过, 反馈信息)
+        """
+        async def traced(span_name, factory):
+            with self.tracer.span(span_name) as span:
+                try:
+                    return await factory()
+                except asyncio.CancelledError:
+                    if span is not None:
+                        span.attrs["cancelled"] = True
+                    raise
+
+        if not getattr(config, "CONCURRENT_REVIEWS", True):
+            for check_name, span_name, factory in checks:
+                passed, feedback = await traced(span_name, factory)
+                if not passed:
+                    return False, f"[{check_name}] {feedback}"
+            return True, ""
+
+        tasks = [(check_name, asyncio.ensure_future(traced(span_name, factory))) for check_name, span_name, factory in checks]
+        pending = {task for _, task in tasks}
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # 同时完成的多项按 checks 顺序取第一个 FAIL，保证反馈稳定
+                for check_name, task in tasks:
+                    if task in done:
+                        passed, feedback = task.result()
+                        if not passed:
+                            return False, f"[{check_name}] {feedback}"
+            return True, ""
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _review_user_response_comprehensive(self, user_response: str) -> Tuple[bool, str]:
         """
         综合审查用户回复（多维度）
         返回: (是否通过, 反馈信息)
         """
         checks = [
-            ("PROFILE", self._review_user_response(user_response)),
-            ("COHERENCE", self._review_coherence(user_response)),
+            ("PROFILE", "user.review.profile", lambda: self._review_user_response(user_response)),
+            ("COHERENCE", "user.review.coherence", lambda: self._review_coherence(user_response)),
         ]
-        
-        for check_name, (passed, feedback) in checks:
-            if not passed:
-                return False, f"[{check_name}] {feedback}"
-        
-        return True, ""
+        return await self._run_review_checks(checks)
     
-    def _review_system_response(self, system_response: str) -> Tuple[bool, str]:
+    async def _review_system_response(self, system_response: str) -> Tuple[bool, str]:
         """
         综合审查系统回复（多维度）
         返回: (是否通过, 反馈信息)
         """
+        # 格式检查在本地完成，不通过时无需再调用 LLM 审查质量
+        passed, feedback = self._review_format(system_response, "system")
+        if not passed:
+            return False, f"[FORMAT] {feedback}"
         checks = [
-            ("FORMAT", self._review_format(system_response, "system")),
-            ("QUALITY", self._review_recommendation_quality(system_response)),
+            ("QUALITY", "system.review.quality", lambda: self._review_recommendation_quality(system_response)),
         ]
-        
-        for check_name, (passed, feedback) in checks:
-            if not passed:
-                return False, f"[{check_name}] {feedback}"
-        
-        return True, ""
+        return await self._run_review_checks(checks)
+
+    async def _review_user_turn_fused(self, user_response: str) -> tuple[bool, str, str | None]:
+        """
+        融合审查：一次 JSON 调用同时完成 PROFILE、COHERENCE 审查与意图判断
+        （结果用 pydantic 校验，方式同 MemoryProfileChain._call_llm）。
+        返回: (是否通过, 反馈信息, 意图)；调用或解析失败时按通过处理，意图为 None 交由 _judge_intent 判断。
+        """
+        reflections = self.user_profile.get("reflections", {})
+        style = self.user_profile.get("dialogue_style", {})
+        has_history = len(self.raw_log) >= 2
+
+        system_prompt = f"""
+        You are a reviewer for a simulated movie-recommendation dialogue. Review the user's latest response in three ways:
+        1. PROFILE: Does the response's tone, persona, verbosity, preferences and decision logic match the user's PROFILE?
+        2. COHERENCE: Does it respond appropriately to the system's last message, stay consistent with previously expressed views and keep the conversation flowing naturally? (If there is no history, coherence_ok is true.)
+        3. INTENT: Classify the response into EXACTLY one category:
+           ACCEPT: User agrees to watch the movie.
+           REJECT: User expresses disinterest or dislike.
+           INQUIRY: User is answering a question, chatting, or asking info (neutral).
+        Give a one-line reason for every failed check.
+
+        IMPORTANT: Output valid JSON only following this schema:
+        {json.dumps(UserTurnReview.model_json_schema(), indent=2)}
+
+        **User PROFILE Information:**
+        - Persona: {reflections.get("spectator_persona", "")}
+        - Tone: {style.get("tone", "")}
+        - Preferences: {json.dumps(reflections.get("aesthetic_preferences", []), ensure_ascii=False)}
+        - Verbosity: {style.get("verbosity", "")}
+        - Decision Logic: {reflections.get("decision_logic", "")}
+        """
+        # 指令、schema 与画像在对话内不变，放在 system 前缀；历史与回复放在最后
+        user_content = f"""
+        **Recent Conversation History:**
+        {self._review_history() if has_history else "(conversation just started)"}
+
+        **User's Generated Response:**
+        "{user_response}"
+        """
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_content},
+        ]
+        try:
+            resp = await self.llm.complete(messages, temperature=0.0, response_format={"type": "json_object"})
+            review = UserTurnReview.model_validate(json.loads(resp.choices[0].message.content or ""))
+        except FATAL_LLM_ERRORS:
+            raise
+        except Exception as e:
+            print(f"    [FUSED REVIEW ERROR]: {e}")
+            return True, "", None
+
+        if not review.profile_ok:
+            return False, f"[PROFILE] {review.profile_reason or 'Response does not match PROFILE requirements'}", review.intent
+        if has_history and not review.coherence_ok:
+            return False, f"[COHERENCE] {review.coherence_reason or 'Response is not coherent with conversation'}", review.intent
+        return True, "", review.intent
+
+    async def _judge_intent(self, user_response: str) -> str:
+        if self.intent_classifier is not None:
+            # 本地分类器置信度足够时不调用 LLM
+            intent, confidence = await _run_local_model(self.intent_classifier.predict, user_response)
+            annotate_span(local_intent=intent, local_confidence=round(confidence, 3))
+            if confidence >= getattr(config, "INTENT_CLASSIFIER_THRESHOLD", 0.9):
+                return intent
 
-    def _judge_intent(self, user_response: str) -> str:
         prompt = f"""
-        Analyze the user response in a movie recommendation context.
         User Response: "{user_response}"
-        
-        Classify into EXACTLY one category:
-        1. ACCEPT: User agrees to watch the movie.
-        2. REJECT: User expresses disinterest or dislike.
-        3. INQUIRY: User is answering a question, chatting, or asking info (neutral).
-        
-        Output ONLY the category word.
         """
         try:
-            resp = self.client.chat.completions.create(
-                model=config.MODEL_NAME,
-                messages=[{"role": "user", "content": prompt}],
-                temperature=0.0
-            )
-            result = resp.choices[0].message.content.strip().upper()
-            if "ACCEPT" in result: return "ACCEPT"
-            if "REJECT" in result: return "REJECT"
-            return "INQUIRY"
+            result = (await self.llm.chat(prompt, temperature=0.0, system=INTENT_JUDGE_INSTRUCTIONS)).upper()
+            if "ACCEPT" in result: intent = "ACCEPT"
+            elif "REJECT" in result: intent = "REJECT"
+            else: intent = "INQUIRY"
+            log_intent_decision(user_response, intent)
+            return intent
+        except FATAL_LLM_ERRORS:
+            raise
         except Exception:
             return "INQUIRY"
 
-    def run(self):
-        init_msg = "Hi! I'm your movie assistant. How are you feeling today?"
-        
-        print_final_response("SYSTEM", init_msg)
-        self.raw_log.append({"role": "system", "content": init_msg})
-        
-        last_msg = init_msg
+    async def _speculative_judge_intent(self, user_response: str) -> str:
+        """与审查并发执行的意图判断；候选被否决时任务会被取消。"""
+        with self.tracer.span("user.judge_intent", speculative=True) as span:
+            try:
+                return await self._judge_intent(user_response)
+            except asyncio.CancelledError:
+                if span is not None:
+                    span.attrs["cancelled"] = True
+                raise
 
-        while not self.is_finished:
-            self.turn_count += 1
-            
-            print_section(f"ROUND {self.turn_count} START", char="=")
+    async def _review_user_candidate(self, user_resp: str, final_attempt: bool = False) -> tuple[bool, str, str | None]:
+        """
+        审查一个用户回复候选；融合审查 / 投机判断模式下一并得出意图（否则意图为 None）。
+        final_attempt: 无论结果如何都会采用该候选（没有重试机会了），投机判断的结果需要保留。
+        返回: (是否通过, 反馈信息, 意图)
+        """
+        if getattr(config, "FUSED_USER_REVIEW", False):
+            print(f"    [REVIEW] Fused review (PROFILE, COHERENCE, INTENT)...")
+            with self.tracer.span("user.review.fused"):
+                return await self._review_user_turn_fused(user_resp)
 
-            # --- User Turn ---
-            print_section(f"USER TURN (Thinking & Memory Search...)", char="-")
+        # 投机模式：意图判断与审查同时进行，候选通过审查时意图已经就绪
+        speculative = getattr(config, "SPECULATIVE_INTENT", False)
+        judge_task = asyncio.ensure_future(self._speculative_judge_intent(user_resp)) if speculative else None
+        print(f"    [REVIEW] Comprehensive review (PROFILE, COHERENCE)...")
+        try:
+            is_compliant, feedback = await self._review_user_response_comprehensive(user_resp)
+        except BaseException:
+            if judge_task is not None:
+                judge_task.cancel()
+            raise
+        intent = None
+        if judge_task is not None:
+            if is_compliant or final_attempt:
+                # 该候选会被采用（通过审查，或已无重试机会）
+                intent = await judge_task
+            else:
+                judge_task.cancel()
+                await asyncio.gather(judge_task, return_exceptions=True)
+        return is_compliant, feedback, intent
+
+    async def _generate_with_candidates(self, role: str, agents: list, generate, review, max_attempts: int = 4):
+        """
+        多候选生成：每轮用 len(agents) 个 agent 并行生成候选，每个候选生成完立即开始审查，
+        第一个通过的候选胜出，其余审查直接取消。候选总数不超过 max_attempts（与逐个重试的预算一致，
+        最后一轮只用剩余名额数量的 agent），默认 4 个候选时一轮即可完成。
+        只有编号为 max_attempts - 1 的候选算作最后一次尝试（final_attempt=True），其余候选照常严格审查；
+        全部未通过时采用该候选。
+        生成跑在线程里无法中断，胜出时仍未完成的生成记为 straggler，下次使用这些 agent 前先等它们结束。
+        generate(agent, feedback, final_attempt) -> str 在线程中执行，抛出 StreamAbortedError 时该候选直接记为未通过；
+        review(resp, final_attempt) -> (是否通过, 反馈, 附加结果)
+        返回: (采用的回复, 附加结果, 采用该回复的 agent, 轮数)
+        """
+        await self._drain_stragglers(role)
+        rounds = -(-max_attempts // len(agents))
+        feedback = ""
+        resp, extra, winner = "", None, agents[0]
+        for round_idx in range(rounds):
+            round_agents = agents[:max_attempts - round_idx * len(agents)]
+            final_agent = round_agents[-1] if round_idx == rounds - 1 else None
+
+            async def gen(candidate: int, agent, feedback=feedback, attempt=round_idx):
+                with self.tracer.span(f"{role}.generate", attempt=attempt, candidate=candidate) as span:
+                    try:
+                        return await asyncio.to_thread(generate, agent, feedback, agent is final_agent)
+                    except StreamAbortedError:
+                        if span is not None:
+                            span.attrs["stream_aborted"] = True
+                        raise
+
+            gen_tasks = {asyncio.ensure_future(gen(i, agent)): agent for i, agent in enumerate(round_agents)}
+            review_tasks = {}
+            pending = set(gen_tasks)
+            failures = []
+            passed = None
+            try:
+                while pending and passed is None:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        if task in gen_tasks:
+                            try:
+                                candidate = task.result()
+                            except StreamAbortedError as e:
+                                # 流式生成中途违反格式，无需再审查
+                                failures.append((e.text, self._stream_abort_feedback(e), None, gen_tasks[task]))
+                                continue
+                            review_task = asyncio.ensure_future(review(candidate, gen_tasks[task] is final_agent))
+                            review_tasks[review_task] = (candidate, gen_tasks[task])
+                            pending.add(review_task)
+                            continue
+                        ok, candidate_feedback, candidate_extra = task.result()
+                        candidate, agent = review_tasks[task]
+                        if ok:
+                            passed = (candidate, candidate_extra, agent)
+                            break
+                        failures.append((candidate, candidate_feedback, candidate_extra, agent))
+            finally:
+                for task in pending:
+                    if task in gen_tasks:
+                        self._stragglers.setdefault(role, []).append(task)
+                    else:
+                        task.cancel()
+                cancelled = [task for task in pending if task not in gen_tasks]
+                if cancelled:
+                    await asyncio.gather(*cancelled, return_exceptions=True)
+
+            if passed is not None:
+                print(f"    [{role.upper()} CANDIDATES] PASS - candidate accepted in round {round_idx + 1}")
+                return passed[0], passed[1], passed[2], round_idx + 1
+            # 优先采用最后一次尝试的候选（其审查按 final_attempt 处理，例如意图已判断）
+            resp, feedback, extra, winner = next((f for f in failures if f[3] is final_agent), failures[-1])
+            print(f"    [{role.upper()} CANDIDATES] All {len(round_agents)} candidate(s) failed - {feedback} (Round {round_idx + 1}/{rounds})")
+        print(f"    [{role.upper()} CANDIDATES] Max retries reached, using current response")
+        return resp, extra, winner, rounds
+
+    async def _drain_stragglers(self, role: str | None = None):
+        """等待上一轮未完成的候选生成结束（结果丢弃），之后才能复用对应的 agent。"""
+        roles = [role] if role else list(self._stragglers)
+        tasks = [task for r in roles for task in self._stragglers.pop(r, [])]
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
 
+    async def _generate_user_turn(self, last_msg: str) -> tuple[str, str | None]:
+        """
+        生成用户回复并审核，不通过则带着反馈重新生成（最多 3 次）。
+        返回: (用户回复, 意图)；融合审查 / 投机判断模式下意图随审查一并得出，否则为 None。
+        """
+        if self.candidate_count > 1:
+            if self._user_candidates is None:
+                self._user_candidates = [self.user_agent] + [self._new_user_agent() for _ in range(self.candidate_count - 1)]
+            with self.tracer.span("user.turn", turn=self.turn_count, candidates=self.candidate_count) as turn_span:
+                user_resp, intent, _, rounds = await self._generate_with_candidates(
+                    "user",
+                    self._user_candidates,
+                    lambda agent, feedback, final_attempt: agent.reply(
+                        last_msg, self.raw_log, self.rejection_count, feedback, self._history_text(USER_VIEW)
+                    ),
+                    self._review_user_candidate,
+                )
+                if turn_span is not None:
+                    turn_span.attrs["retries"] = rounds - 1
+            return user_resp, intent
+
+        with self.tracer.span("user.turn", turn=self.turn_count) as turn_span:
             max_review_retries = 3
             review_retry_count = 0
             user_resp = ""
             review_feedback = ""
+            intent = None
 
             # 生成回复并进行审核，如果不通过则重新生成
             while review_retry_count <= max_review_retries:
                 # 生成回复
-                user_resp = self.user_agent.reply(last_msg, self.raw_log, self.rejection_count, review_feedback)
-                
+                # autogen 的 initiate_chat 是同步调用，放到线程中执行以免阻塞事件循环
+                with self.tracer.span("user.generate", attempt=review_retry_count):
+                    user_resp = await asyncio.to_thread(
+                        self.user_agent.reply, last_msg, self.raw_log, self.rejection_count, review_feedback,
+                        self._history_text(USER_VIEW),
+                    )
+            
                 # 综合审核回复（多维度）
-                print(f"    [REVIEW] Comprehensive review (PROFILE, COHERENCE)...")
-                is_compliant, feedback = self._review_user_response_comprehensive(user_resp)
-                
+                is_compliant, feedback, intent = await self._review_user_candidate(
+                    user_resp, final_attempt=review_retry_count >= max_review_retries
+                )
+            
                 if is_compliant:
                     print(f"    [REVIEW] PASS - All checks passed")
                     break
@@ -362,12 +711,226 @@ class DialogueController:
                     if review_retry_count > max_review_retries:
                         print(f"    [REVIEW] Max retries reached, using current response")
                         break
+            if turn_span is not None:
+                turn_span.attrs["retries"] = review_retry_count
+        return user_resp, intent
+
+    async def _generate_system_turn(self, user_resp: str) -> str:
+        """生成系统回复并审核，不通过则带着反馈重新生成（最多 3 次）。"""
+        if self.candidate_count > 1:
+            if self._system_candidates is None:
+                # 候选 agent 各自从主 agent 的 seen_movies 副本开始，只有胜出候选检索到的电影计入
+                self._system_candidates = [self._new_system_agent() for _ in range(self.candidate_count)]
+
+            # 本回合各候选检索到的片名互相排除，多出来的生成换来不同的推荐，而不是同一部电影的多个版本
+            claims = TitleClaims()
+
+            def generate(agent, feedback, final_attempt):
+                agent.seen_movies = set(self.system_agent.seen_movies)
+                agent.claims = claims
+                return agent.reply(
+                    user_resp, self.raw_log, feedback, self._history_text(SYSTEM_VIEW), self._stream_abort_enabled(final_attempt)
+                )
+
+            async def review(candidate, final_attempt):
+                passed, feedback = await self._review_system_response(candidate)
+                return passed, feedback, None
+
+            with self.tracer.span("system.turn", turn=self.turn_count, candidates=self.candidate_count) as turn_span:
+                sys_resp, _, winner, rounds = await self._generate_with_candidates(
+                    "system", self._system_candidates, generate, review
+                )
+                self.system_agent.seen_movies = set(winner.seen_movies)
+                if turn_span is not None:
+                    turn_span.attrs["retries"] = rounds - 1
+            return sys_resp
+
+        with self.tracer.span("system.turn", turn=self.turn_count) as turn_span:
+            # 生成系统回复并进行审核
+            max_system_retries = 3
+            system_retry_count = 0
+            sys_resp = ""
+            system_feedback = ""
+        
+            while system_retry_count <= max_system_retries:
+                # 生成回复（传递反馈信息以进行改进）
+                aborted = None
+                with self.tracer.span("system.generate", attempt=system_retry_count) as gen_span:
+                    try:
+                        sys_resp = await asyncio.to_thread(
+                            self.system_agent.reply, user_resp, self.raw_log, system_feedback,
+                            self._history_text(SYSTEM_VIEW),
+                            self._stream_abort_enabled(system_retry_count >= max_system_retries),
+                        )
+                    except StreamAbortedError as e:
+                        sys_resp, aborted = e.text, e
+                        if gen_span is not None:
+                            gen_span.attrs["stream_aborted"] = True
+            
+                if aborted is not None:
+                    # 流式生成中途违反格式，已中止，直接带着反馈重新生成
+                    is_compliant, feedback = False, self._stream_abort_feedback(aborted)
+                    print(f"    [SYSTEM STREAM] Aborted after {len(aborted.text)} chars - {feedback}")
+                else:
+                    # 综合审核系统回复（多维度）
+                    print(f"    [SYSTEM REVIEW] Comprehensive review (FORMAT, QUALITY)...")
+                    is_compliant, feedback = await self._review_system_response(sys_resp)
+            
+                if is_compliant:
+                    print(f"    [SYSTEM REVIEW] PASS - All checks passed")
+                    break
+                else:
+                    system_retry_count += 1
+                    system_feedback = feedback
+                    print(f"    [SYSTEM REVIEW] FAIL - {feedback} (Retry {system_retry_count}/{max_system_retries})")
+                    if system_retry_count > max_system_retries:
+                        print(f"    [SYSTEM REVIEW] Max retries reached, using current response")
+                        break
+            if turn_span is not None:
+                turn_span.attrs["retries"] = system_retry_count
+        return sys_resp
+
+    def run(self):
+        """
+        同步入口（进程池模式使用）：在本进程复用的事件循环中跑完整段对话，
+        使共享连接池可以跨对话保持 keep-alive。
+        """
+        return _get_worker_loop().run_until_complete(self.a_run())
+
+    async def a_run(self):
+        """
+        异步入口：所有 LLM 等待都让出事件循环，
+        便于在同一进程内并发驱动大量对话（见 main.py 的 ASYNC_MODE）。
+        """
+        http_before = CONNECTION_STATS.snapshot()
+        dispatcher = get_batch_dispatcher()
+        # 锁步批量模式下登记为活跃对话，调度器据此判断同一阶段的请求是否到齐
+        batch_scope = dispatcher.dialogue_scope(self.user_profile.get("user_id")) if dispatcher else contextlib.nullcontext()
+        completed = False
+        try:
+            with batch_scope, self.tracer.span("dialogue") as span:
+                result = await self._run_dialogue()
+                if span is not None and not getattr(config, "ASYNC_MODE", False):
+                    # 进程级计数的增量；进程池模式下每个 worker 同时只跑一个对话，因此即为本对话的值
+                    # （异步模式下对话并发，由 main.py 直接打印进程级统计）
+                    http_after = CONNECTION_STATS.snapshot()
+                    span.attrs["http_requests"] = http_after["requests"] - http_before["requests"]
+                    span.attrs["http_new_connections"] = http_after["new_connections"] - http_before["new_connections"]
+                if span is not None and self.history is not None:
+                    span.attrs.update(self.history.stats())
+                completed = True
+                return result
+        finally:
+            await self._drain_stragglers()
+            await self.llm.close()
+            if completed:
+                # 出错的对话可能仍有 agent 在线程中运行，不归还
+                self._release_agents()
+
+    def _history_text(self, labels: dict) -> str | None:
+        """按 token 预算渲染的历史；未开启时返回 None，agent 自行取最近约 10 条。"""
+        if self.history is None:
+            return None
+        # 对照基准：agent 原本发送的最近约 10 条消息
+        return self.history.render(self.raw_log, labels, format_messages(stable_window(self.raw_log, 10), labels))
+
+    def _review_history(self) -> str:
+        """审查使用的对话上下文：最近 3 条消息；开启 HISTORY_BUDGET_FOR_REVIEW 时改用按预算渲染的历史。"""
+        recent = json.dumps(self.raw_log[-3:], ensure_ascii=False)
+        if self.history is not None and getattr(config, "HISTORY_BUDGET_FOR_REVIEW", False):
+            return self.history.render(self.raw_log, REVIEW_VIEW, recent)
+        return recent
+
+    async def _summarize_history(self, summary: str, messages: list) -> str:
+        """把新折叠的消息并入上一版摘要。"""
+        max_tokens = getattr(config, "HISTORY_SUMMARY_MAX_TOKENS", 150)
+        new_lines = "\n".join(f"{REVIEW_VIEW.get(m['role'], m['role'])}: {m['content']}" for m in messages)
+        prompt = f"""
+        **Existing Summary:**
+        {summary or "(none)"}
+
+        **New Messages:**
+        {new_lines}
+
+        **Updated Summary:**
+        """
+        return await self.llm.chat(
+            prompt, temperature=0.0, system=HISTORY_SUMMARY_INSTRUCTIONS.format(max_tokens=max_tokens)
+        )
+
+    async def _update_history(self):
+        """每个回合生成前检查历史是否超出预算，超出时增量更新摘要。"""
+        if self.history is None or not self.history.needs_update(self.raw_log):
+            return
+        try:
+            with self.tracer.span("history.summarize", turn=self.turn_count):
+                await self.history.update(self.raw_log, self._summarize_history)
+        except FATAL_LLM_ERRORS:
+            raise
+        except Exception as e:
+            # 摘要失败时本回合保留全部未折叠消息，下个回合再试
+            print(f"    [HISTORY SUMMARY ERROR]: {e}")
+
+    def _save_checkpoint(self, last_msg: str):
+        """每完成一轮（用户回合 + 系统回合）保存一次对话状态。"""
+        if self.checkpoints is None:
+            return
+        self.checkpoints.save(self.user_profile.get("user_id"), {
+            "profile_fingerprint": profile_fingerprint(self.user_profile),
+            "raw_log": self.raw_log,
+            "rejection_count": self.rejection_count,
+            "turn_count": self.turn_count,
+            "last_msg": last_msg,
+            "seen_movies": sorted(self.system_agent.seen_movies),
+            "history": self.history.state() if self.history is not None else None,
+        })
+
+    def _restore_checkpoint(self) -> str | None:
+        """允许续跑且存在与当前 profile、配置匹配的检查点时恢复状态，返回下一轮用户要回应的消息；否则返回 None。"""
+        if self.checkpoints is None or not self.resume_checkpoint:
+            return None
+        state = self.checkpoints.load(self.user_profile.get("user_id"))
+        if state is None or state.get("profile_fingerprint") != profile_fingerprint(self.user_profile):
+            return None
+        self.raw_log = state["raw_log"]
+        self.rejection_count = state["rejection_count"]
+        self.turn_count = state["turn_count"]
+        self.system_agent.seen_movies = set(state.get("seen_movies", []))
+        if self.history is not None and state.get("history"):
+            self.history.load_state(state["history"])
+        return state["last_msg"]
+
+    async def _run_dialogue(self):
+        last_msg = self._restore_checkpoint()
+        if last_msg is None:
+            init_msg = "Hi! I'm your movie assistant. How are you feeling today?"
+            
+            print_final_response("SYSTEM", init_msg)
+            self.raw_log.append({"role": "system", "content": init_msg})
+            
+            last_msg = init_msg
+        else:
+            print(f"[Checkpoint] Resuming after turn {self.turn_count} ({len(self.raw_log)} messages restored)")
+            annotate_span(resumed_from_turn=self.turn_count)
+
+        while not self.is_finished:
+            self.turn_count += 1
+            
+            print_section(f"ROUND {self.turn_count} START", char="=")
+
+            # --- User Turn ---
+            print_section(f"USER TURN (Thinking & Memory Search...)", char="-")
+
+            await self._update_history()
+            user_resp, intent = await self._generate_user_turn(last_msg)
             
             print_final_response("USER", user_resp)
             self.raw_log.append({"role": "user", "content": user_resp})
 
             # --- Judge Turn ---
-            intent = self._judge_intent(user_resp)
+            if intent is None:
+                with self.tracer.span("user.judge_intent"):
+                    intent = await self._judge_intent(user_resp)
             print(f"    [JUDGE]: {intent} (Rejections: {self.rejection_count})")
 
             # 状态更新
@@ -385,35 +948,14 @@ class DialogueController:
             # --- System Turn ---
             print_section(f"SYSTEM TURN (Thinking & Database Search...)", char="-")
             
-            # 生成系统回复并进行审核
-            max_system_retries = 3
-            system_retry_count = 0
-            sys_resp = ""
-            system_feedback = ""
-            
-            while system_retry_count <= max_system_retries:
-                # 生成回复（传递反馈信息以进行改进）
-                sys_resp = self.system_agent.reply(user_resp, self.raw_log, system_feedback)
-                
-                # 综合审核系统回复（多维度）
-                print(f"    [SYSTEM REVIEW] Comprehensive review (FORMAT, QUALITY)...")
-                is_compliant, feedback = self._review_system_response(sys_resp)
-                
-                if is_compliant:
-                    print(f"    [SYSTEM REVIEW] PASS - All checks passed")
-                    break
-                else:
-                    system_retry_count += 1
-                    system_feedback = feedback
-                    print(f"    [SYSTEM REVIEW] FAIL - {feedback} (Retry {system_retry_count}/{max_system_retries})")
-                    if system_retry_count > max_system_retries:
-                        print(f"    [SYSTEM REVIEW] Max retries reached, using current response")
-                        break
+            await self._update_history()
+            sys_resp = await self._generate_system_turn(user_resp)
             
             print_final_response("SYSTEM", sys_resp)
             self.raw_log.append({"role": "system", "content": sys_resp})
             
             last_msg = sys_resp
+            self._save_checkpoint(last_msg)
 
         data = {
             "user_id": self.user_profile.get("user_id"),
@@ -430,3 +972,6 @@ class DialogueController:
             with open(self.output_path, 'w', encoding='utf-8') as f:
                 json.dump(data, f, indent=2, ensure_ascii=False)
             print(f"\nData saved to {self.output_path}")
+            # 单独运行时结果已落盘即可删除检查点；main.py 在结果写入 JSONL 后删除
+            if self.checkpoints is not None:
+                self.checkpoints.delete(data["user_id"])
@@ -1,25 +1,53 @@
 import autogen
+import contextlib
+import threading
 from modules.tools import MovieRetriever
 import config
+from modules.rate_limiter import throttle_autogen_reply, settle_autogen_usage, call_with_rate_limit_retry, inject_retry_policy
+from modules.llm_cache import get_autogen_cache, inject_replay_client, register_replay_client
+from modules.http_pool import inject_http_client
+from modules.batch_api import inject_batch_client, register_batch_client
+from modules.history import stable_window
+from modules.tracing import trace_span, count_autogen_reply, clear_autogen_usage, record_autogen_usage
+from modules.tool_loop import ToolCallingAgent, native_tool_calling_enabled
+from modules.format_rules import format_issues
 import re
 
+class TitleClaims:
+    """同一回合的并行候选共享：已被某个候选检索到的片名，其他候选检索时一并排除，使各候选推荐不同的电影。"""
+
+    def __init__(self):
+        self.titles = set()
+        self.lock = threading.Lock()
+
+
 class SystemAgent:
     def __init__(self):
         self.retriever = MovieRetriever()
         self.seen_movies = set()
-        self.llm_config = config.LLM_CONFIG
-        self.llm_config["temperature"] = 0.7
-        self.assistant = autogen.AssistantAgent(
-            name="System_Assistant",
-            system_message="""
+        self.claims = None  # 多候选生成时由控制器设置的 TitleClaims
+        # SPECULATIVE_MOVIE_SEARCH 开启时在本地预先检索候选电影并写进 prompt，不再注册 search_movie_database 工具
+        self.speculative_search = bool(getattr(config, "SPECULATIVE_MOVIE_SEARCH", False))
+        if self.speculative_search:
+            search_rules = """2. **TRUST THE DATABASE:** The movie under [DATABASE CANDIDATE] was searched for you. **YOU MUST USE IT**. That IS the best match.
+            3. **NO OTHER MOVIES:** Do NOT recommend anything else. Work with what you have."""
+            workflow = """1. Read the [DATABASE CANDIDATE].
+            2. Take it.
+            3. Recommend it briefly."""
+        else:
+            search_rules = """2. **TRUST THE TOOL:** If `search_movie_database` returns a movie, **YOU MUST USE IT**. That IS the best match.
+            3. **NO RE-SEARCHING:** Do NOT search again. Work with what you have."""
+            workflow = """1. Search ONCE based on keywords.
+            2. Take the result.
+            3. Recommend it briefly."""
+        system_message=f"""
             You are a Casual Movie Buff Friend.
 
             **GOAL:** Recommend the **BEST AVAILABLE** movie from the database in **UNDER 50 WORDS**.
 
             **CRITICAL CONSTRAINTS:**
             1. **DATABASE IS LIMITED:** You do not have every movie in the world.
-            2. **TRUST THE TOOL:** If `search_movie_database` returns a movie, **YOU MUST USE IT**. That IS the best match.
-            3. **NO RE-SEARCHING:** Do NOT search again. Work with what you have.
+            {search_rules}
             4. **BE A SALESMAN:** Spin the movie positively even if it's not a 100% match.
 
             **STYLE RULES (TO BREAK THE "PERFECT" LOOP):**
@@ -36,13 +64,38 @@ class SystemAgent:
             3. **VARIETY:** Do not use the same sentence structure twice in a row.
 
             **WORKFLOW:**
-            1. Search ONCE based on keywords.
-            2. Take the result.
-            3. Recommend it briefly.
+            {workflow}
 
             **TERMINATION:**
             - Always end with **"TERMINATE"**.
-            """,
+            """
+
+        def search_wrapper(keywords: str, exclude_titles: str = "") -> str:
+            return self.search(keywords, exclude_titles)
+
+        search_desc = "Search the movie library. Returns the best matching movie details."
+        tools = [] if self.speculative_search else [("search_movie_database", search_desc, search_wrapper)]
+
+        self.tool_agent = None
+        if native_tool_calling_enabled():
+            # 原生 function calling：不构造 autogen agent
+            self.tool_agent = ToolCallingAgent(
+                system_message,
+                tools,
+                temperature=0.7,
+                max_tool_rounds=getattr(config, "NATIVE_TOOL_MAX_ROUNDS", 1),
+            )
+            return
+
+        # 所有 agent 共用进程级 keep-alive 连接池；BATCH_MODE 下生成请求走批量接口；有限流器时关闭 SDK 自带的重试；
+        # replay 模式下 autogen 缓存未命中时报 CacheMissError
+        self.llm_config = inject_retry_policy(
+            inject_replay_client(inject_batch_client(inject_http_client(config.LLM_CONFIG)))
+        )
+        self.llm_config["temperature"] = 0.7
+        self.assistant = autogen.AssistantAgent(
+            name="System_Assistant",
+            system_message=system_message,
             llm_config=self.llm_config,
         )
 
@@ -55,55 +108,109 @@ class SystemAgent:
             default_auto_reply="",
         )
 
-        def search_wrapper(keywords: str, exclude_titles: str = "") -> str:
-            explicit_excludes = [t.strip() for t in exclude_titles.split(",") if t.strip()]
+        if not self.speculative_search:
+            autogen.register_function(
+                search_wrapper,
+                caller=self.assistant,
+                executor=self.executor,
+                name="search_movie_database",
+                description=search_desc
+            )
+
+        # 每次 LLM 生成前先经过共享限流器，并计入当前 trace span 的调用次数
+        self.assistant.register_reply([autogen.Agent, None], throttle_autogen_reply, position=0)
+        self.assistant.register_hook("process_message_before_send", settle_autogen_usage)
+        self.assistant.register_reply([autogen.Agent, None], count_autogen_reply, position=0)
+        register_batch_client(self.assistant)
+        register_replay_client(self.assistant)
+
+    def search(self, keywords: str, exclude_titles: str = "") -> str:
+        """
+        检索电影库，排除已推荐过的电影；命中的片名计入 seen_movies（工具调用与投机检索共用）。
+        设置了 claims 时还排除同回合其他候选已检索到的片名（检索与登记在锁内完成）。
+        """
+        explicit_excludes = [t.strip() for t in exclude_titles.split(",") if t.strip()]
+        claims = self.claims
+        with claims.lock if claims is not None else contextlib.nullcontext():
             combined_excludes = self.seen_movies.union(set(explicit_excludes))
+            if claims is not None:
+                combined_excludes |= claims.titles
             final_exclude_str = ", ".join(list(combined_excludes))
-            result = self.retriever.search(keywords, final_exclude_str)
+            with trace_span("tool.search_movie_database"):
+                result = self.retriever.search(keywords, final_exclude_str)
             match = re.search(r"Title:\s*(.*?)(?:\n|$)", result)
             if match:
                 found_title = match.group(1).strip()
                 self.seen_movies.add(found_title)
-            
-            if "Title:" in result:
-                return f"[SYSTEM HINT: RECOMMEND THIS MOVIE.]\n\n{result}"
+                if claims is not None:
+                    claims.titles.add(found_title)
+        
+        if "Title:" in result:
+            return f"[SYSTEM HINT: RECOMMEND THIS MOVIE.]\n\n{result}"
 
-            return result
+        return result
 
-        autogen.register_function(
-            search_wrapper,
-            caller=self.assistant,
-            executor=self.executor,
-            name="search_movie_database",
-            description="Search the movie library. Returns the best matching movie details."
-        )
+    def speculative_query(self, last_user_input: str, chat_history: list = None) -> str:
+        """本地拼出检索词：当前用户发言在前，再加上最近两条更早的用户发言。"""
+        parts = [last_user_input]
+        for msg in reversed((chat_history or [])[-6:]):
+            if msg["role"] == "user" and msg["content"] not in parts:
+                parts.append(msg["content"])
+            if len(parts) >= 3:
+                break
+        return " ".join(parts)
+
+    def reset(self):
+        """复用已构造的 agent（见 modules/agent_pool.py）：清空已推荐电影与上一个对话留下的 autogen 状态。"""
+        self.seen_movies = set()
+        self.claims = None
+        if self.tool_agent is None:
+            self.assistant.reset()
+            self.executor.reset()
 
-    def reply(self, last_user_input: str, chat_history: list = None, review_feedback: str = None) -> str:
+    def reply(
+        self,
+        last_user_input: str,
+        chat_history: list = None,
+        review_feedback: str = None,
+        history_text: str = None,
+        abort_on_format_violation: bool = False,
+    ) -> str:
         """
         发起一次内部对话，获取 System 的回复。
         review_feedback: 审核反馈信息，如果提供则需要在回复中考虑
+        history_text: 控制器按 token 预算渲染好的历史（摘要 + 最近消息），为 None 时取最近约 10 条
+        abort_on_format_violation: 流式生成并逐段检查格式，违规时立即中止（抛出 StreamAbortedError）；
+            只在 native 执行方式下生效，autogen 方式仍生成完整回复后由审查判断
         """
         # 将上一轮输入作为 prompt。没有保存完整对话历史        
         # 限制 max_turns（思考turns）
         # 流程通常是: Assistant(Call Tool) -> Executor(Run Tool) -> Assistant(Final Answer)
         
-        # 清空 executor 的历史，重新开始一次“思考-行动-回复”的循环
-        self.executor.clear_history() 
-        self.assistant.clear_history()
-        
         history_str = ""
-        if chat_history:
-            for msg in chat_history[-10:]:
+        if history_text is not None:
+            history_str = history_text
+        elif chat_history:
+            # 历史窗口按块前移，保持请求前缀稳定以命中 provider 端缓存
+            for msg in stable_window(chat_history, 10):
                 role = "User" if msg['role'] == "user" else "You (System)"
                 history_str += f"{role}: {msg['content']}\n"
 
+        candidate_section = ""
+        if self.speculative_search:
+            # 不等模型决定检索词，直接在本地检索，结果随 prompt 一起发出，一次请求即可得到推荐
+            candidate_section = f"""
+
+        [DATABASE CANDIDATE]
+        {self.search(self.speculative_query(last_user_input, chat_history))}"""
+
         # 构建基础prompt
         context_prompt = f"""
         [CONVERSATION HISTORY]
         {history_str}
         
         [CURRENT SITUATION]
-        User just said: "{last_user_input}"
+        User just said: "{last_user_input}"{candidate_section}
         
         Based on the history and the new input, respond to the user.
         """
@@ -128,11 +235,26 @@ class SystemAgent:
             """
             context_prompt = context_prompt + feedback_section
 
-        self.executor.initiate_chat(
-            self.assistant,
-            message=context_prompt,
-            max_turns=6
-        )
+        if self.tool_agent is not None:
+            stream_check = (lambda text: format_issues(text, "system")) if abort_on_format_violation else None
+            return self.tool_agent.reply(context_prompt, stream_check)
+
+        # 清空 executor 的历史，重新开始一次“思考-行动-回复”的循环
+        self.executor.clear_history() 
+        self.assistant.clear_history()
+        clear_autogen_usage(self.assistant)
+
+        # record / replay 模式下 agent 调用走 autogen 的磁盘缓存
+        autogen_cache = get_autogen_cache()
+        with autogen_cache or contextlib.nullcontext():
+            chat_result = call_with_rate_limit_retry(
+                self.executor.initiate_chat,
+                self.assistant,
+                message=context_prompt,
+                max_turns=6,
+                cache=autogen_cache,
+            )
+        record_autogen_usage(chat_result)
         
         last_msg = self.executor.last_message(self.assistant)["content"]
         
@@ -1,10 +1,89 @@
 import autogen
+import contextlib
 import json
+import re
 from modules.tools import MemoryRetriever  
 import config
+from modules.rate_limiter import throttle_autogen_reply, settle_autogen_usage, call_with_rate_limit_retry, inject_retry_policy
+from modules.llm_cache import get_autogen_cache, inject_replay_client, register_replay_client
+from modules.http_pool import inject_http_client
+from modules.batch_api import inject_batch_client, register_batch_client
+from modules.history import stable_window
+from modules.tracing import trace_span, count_autogen_reply, clear_autogen_usage, record_autogen_usage
+from modules.tool_loop import ToolCallingAgent, native_tool_calling_enabled
+
+# SystemAgent 的推荐中片名以 *片名* / **"片名"** 标出
+TITLE_PATTERN = re.compile(r'\*{1,2}"?([^*"\n]+?)"?\*{1,2}')
 
 class UserAgent:
     def __init__(self, profile_data: dict):
+        # MEMORY_PREFETCH 开启时在本地预先检索记忆并写进 prompt，不再注册 lookup_memory 工具
+        self.prefetch_memory_enabled = bool(getattr(config, "MEMORY_PREFETCH", False))
+        self._bind_profile(profile_data)
+        enable_related_memory = bool(getattr(config, "ENABLE_RELATED_USER_MEMORY", True))
+
+        def lookup_memory_wrapper(query: str) -> str:
+            with trace_span("tool.lookup_memory"):
+                return self.memory_tool.lookup(query)
+
+        memory_tool_desc = "Search your movie history for evidence."
+        if enable_related_memory:
+            memory_tool_desc += " May include similar users' memories."
+        else:
+            memory_tool_desc += " Similar-user lookup is disabled."
+        memory_tool_desc += " MANDATORY usage."
+
+        self.tool_agent = None
+        if native_tool_calling_enabled():
+            # 原生 function calling：不构造 autogen agent
+            tools = [] if self.prefetch_memory_enabled else [("lookup_memory", memory_tool_desc, lookup_memory_wrapper)]
+            self.tool_agent = ToolCallingAgent(
+                self.system_message,
+                tools,
+                temperature=0.7,
+                max_tool_rounds=getattr(config, "NATIVE_TOOL_MAX_ROUNDS", 1),
+            )
+            return
+
+        # 所有 agent 共用进程级 keep-alive 连接池；BATCH_MODE 下生成请求走批量接口；有限流器时关闭 SDK 自带的重试；
+        # replay 模式下 autogen 缓存未命中时报 CacheMissError
+        self.llm_config = inject_retry_policy(
+            inject_replay_client(inject_batch_client(inject_http_client(config.LLM_CONFIG)))
+        )
+        self.llm_config["temperature"] = 0.7
+
+        self.assistant = autogen.AssistantAgent(
+            name="User_Simulator",
+            system_message=self.system_message,
+            llm_config=self.llm_config,
+        )
+
+        self.executor = autogen.UserProxyAgent(
+            name="User_Executor",
+            human_input_mode="NEVER",
+            code_execution_config=False,
+            is_termination_msg=lambda x: "TERMINATE" in x.get("content", ""),
+            default_auto_reply="",
+        )
+
+        if not self.prefetch_memory_enabled:
+            autogen.register_function(
+                lookup_memory_wrapper,  
+                caller=self.assistant,
+                executor=self.executor,
+                name="lookup_memory",
+                description=memory_tool_desc
+            )
+
+        # 每次 LLM 生成前先经过共享限流器，并计入当前 trace span 的调用次数
+        self.assistant.register_reply([autogen.Agent, None], throttle_autogen_reply, position=0)
+        self.assistant.register_hook("process_message_before_send", settle_autogen_usage)
+        self.assistant.register_reply([autogen.Agent, None], count_autogen_reply, position=0)
+        register_batch_client(self.assistant)
+        register_replay_client(self.assistant)
+
+    def _bind_profile(self, profile_data: dict):
+        """设置与 profile 相关的状态：画像、记忆检索范围与 system message。"""
         self.profile = profile_data
         self.user_id = profile_data.get("user_id", "unknown")
         
@@ -21,7 +100,18 @@ class UserAgent:
             else "You may also draw from similar users' memories when they exist."
         )
 
-        system_message=f"""
+        if self.prefetch_memory_enabled:
+            tool_usage = f"""**MEMORY:**
+        - Relevant memories are already looked up for you and included in each message under [YOUR RELEVANT MEMORIES].
+        - Memory policy: {memory_scope}
+        - Your response should be based on those memories."""
+        else:
+            tool_usage = f"""**TOOL USAGE:**
+        - You CAN use `lookup_memory` if you really need to recall a specific movie.
+        - Memory policy: {memory_scope}
+        - Your response should be based on lookup_memory results."""
+
+        self.system_message=f"""
         You are a movie enthusiast chatting with an AI.
         
         **YOUR PROFILE:**
@@ -40,55 +130,41 @@ class UserAgent:
         - **DIRECT:** Don't explain your whole life story. Just react to the recommendation.
         - **FOCUS:** Focus on ONE thing you like or hate at a time.
         
-        **TOOL USAGE:**
-        - You CAN use `lookup_memory` if you really need to recall a specific movie.
-        - Memory policy: {memory_scope}
-        - Your response should be based on lookup_memory results.
+        {tool_usage}
         
         **FINISH:**
         - ALWAYS end with **"TERMINATE"**.
         """
 
-        self.llm_config = config.LLM_CONFIG
-        self.llm_config["temperature"] = 0.7
-
-        self.assistant = autogen.AssistantAgent(
-            name="User_Simulator",
-            system_message=system_message,
-            llm_config=self.llm_config,
-        )
-
-        self.executor = autogen.UserProxyAgent(
-            name="User_Executor",
-            human_input_mode="NEVER",
-            code_execution_config=False,
-            is_termination_msg=lambda x: "TERMINATE" in x.get("content", ""),
-            default_auto_reply="",
-        )
-
-        def lookup_memory_wrapper(query: str) -> str:
+    def rebind(self, profile_data: dict):
+        """
+        复用已构造的 agent（见 modules/agent_pool.py）：换成新 profile 的 system message 与记忆检索范围，
+        并清空上一个对话留下的 autogen 状态。工具注册与 hook 保持不变。
+        """
+        self._bind_profile(profile_data)
+        if self.tool_agent is not None:
+            self.tool_agent.system_message = self.system_message
+            return
+        self.assistant.update_system_message(self.system_message)
+        # reset 同时清空历史、自动回复计数与 client 的用量汇总
+        self.assistant.reset()
+        self.executor.reset()
+
+    def prefetch_memory(self, system_msg: str) -> str:
+        """按收到的系统消息（推荐的片名 + 消息原文）在本地检索记忆，省去模型先发起 lookup_memory 的一次往返。"""
+        query = ". ".join(TITLE_PATTERN.findall(system_msg) + [system_msg])
+        with trace_span("tool.prefetch_memory"):
             return self.memory_tool.lookup(query)
 
-        memory_tool_desc = "Search your movie history for evidence."
-        if enable_related_memory:
-            memory_tool_desc += " May include similar users' memories."
-        else:
-            memory_tool_desc += " Similar-user lookup is disabled."
-        memory_tool_desc += " MANDATORY usage."
-
-        autogen.register_function(
-            lookup_memory_wrapper,  
-            caller=self.assistant,
-            executor=self.executor,
-            name="lookup_memory",
-            description=memory_tool_desc
-        )
-
-    def reply(self, system_msg: str, chat_history: list, rejection_count: int, review_feedback: str = "") -> str:
+    def reply(self, system_msg: str, chat_history: list, rejection_count: int, review_feedback: str = "", history_text: str | None = None) -> str:
+        """history_text: 控制器按 token 预算渲染好的历史（摘要 + 最近消息），为 None 时取最近约 10 条。"""
 
         history_str = ""
-        if chat_history:
-            for msg in chat_history[-10:]:
+        if history_text is not None:
+            history_str = history_text
+        elif chat_history:
+            # 历史窗口按块前移，保持请求前缀稳定以命中 provider 端缓存
+            for msg in stable_window(chat_history, 10):
                 role = "System" if msg['role'] == "system" else "You (User)"
                 history_str += f"{role}: {msg['content']}\n"
         
@@ -128,6 +204,13 @@ class UserAgent:
             ===================================================
             """
             
+        memory_section = ""
+        if self.prefetch_memory_enabled:
+            memory_section = f"""
+
+        [YOUR RELEVANT MEMORIES]
+        {self.prefetch_memory(system_msg)}"""
+
         # 拼接 Prompt：将策略包装得更像一条系统指令
         # 这里的 system_msg 是来自推荐系统的回复
         full_prompt = f"""
@@ -135,7 +218,7 @@ class UserAgent:
         {history_str}
 
         [INCOMING MESSAGE FROM SYSTEM]
-        "{system_msg}"
+        "{system_msg}"{memory_section}
 
         ===================================================
         [HIDDEN INSTRUCTION]
@@ -146,15 +229,25 @@ class UserAgent:
         
         Based on the history (don't repeat yourself) and the new message, respond.
         """
-        
+
+        if self.tool_agent is not None:
+            return self.tool_agent.reply(full_prompt)
+
         self.executor.clear_history()
         self.assistant.clear_history()
-
-        self.executor.initiate_chat(
-            self.assistant,
-            message=full_prompt,
-            max_turns=6
-        )
+        clear_autogen_usage(self.assistant)
+
+        # record / replay 模式下 agent 调用走 autogen 的磁盘缓存
+        autogen_cache = get_autogen_cache()
+        with autogen_cache or contextlib.nullcontext():
+            chat_result = call_with_rate_limit_retry(
+                self.executor.initiate_chat,
+                self.assistant,
+                message=full_prompt,
+                max_turns=6,
+                cache=autogen_cache,
+            )
+        record_autogen_usage(chat_result)
 
         last_msg = self.executor.last_message(self.assistant)["content"]
         return last_msg.replace("TERMINATE", "").strip()
@@ -0,0 +1,65 @@
+import threading
+import config
+from modules.UserAgent import UserAgent
+from modules.SystemAgent import SystemAgent
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+class AgentPool:
+    """
+    进程内（每个 worker 一个）的 agent 池：对话成功结束后归还 agent，下一个对话取出后换绑 profile
+    （UserAgent.rebind / SystemAgent.reset），省去每个对话重新构造 autogen agent、注册工具与 hook 的开销。
+    异步模式下并发的对话各自取用，空闲 agent 数不超过并发峰值。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._user_agents = []
+        self._system_agents = []
+        self.created = 0
+        self.reused = 0
+
+    def acquire_user_agent(self, profile: dict) -> UserAgent:
+        with self._lock:
+            agent = self._user_agents.pop() if self._user_agents else None
+            if agent is None:
+                self.created += 1
+            else:
+                self.reused += 1
+        if agent is None:
+            return UserAgent(profile)
+        agent.rebind(profile)
+        return agent
+
+    def acquire_system_agent(self) -> SystemAgent:
+        with self._lock:
+            agent = self._system_agents.pop() if self._system_agents else None
+            if agent is None:
+                self.created += 1
+            else:
+                self.reused += 1
+        if agent is None:
+            return SystemAgent()
+        agent.reset()
+        return agent
+
+    def release(self, agents: list):
+        with self._lock:
+            for agent in agents:
+                if isinstance(agent, UserAgent):
+                    self._user_agents.append(agent)
+                elif isinstance(agent, SystemAgent):
+                    self._system_agents.append(agent)
+
+
+def get_agent_pool() -> AgentPool | None:
+    """AGENT_POOL 开启时返回进程内共享的 agent 池，否则返回 None（每个对话新建 agent）。"""
+    global _POOL
+    if not getattr(config, "AGENT_POOL", False):
+        return None
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = AgentPool()
+        return _POOL
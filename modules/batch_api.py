@@ -0,0 +1,316 @@
+import asyncio
+import contextvars
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import config
+
+# 当前协程 / 线程所属的对话，用于判断是否所有活跃对话都在等待批量结果
+_CURRENT_DIALOGUE = contextvars.ContextVar("batch_dialogue", default=None)
+_DISPATCHER = None
+
+_CREATE_PARAMS = (
+    "model", "messages", "temperature", "top_p", "n", "stop", "max_tokens", "seed",
+    "tools", "tool_choice", "functions", "function_call", "response_format",
+)
+
+
+class BatchRequestError(RuntimeError):
+    """批量结果中该请求失败（或缺失）。"""
+
+
+def batch_mode_enabled() -> bool:
+    return bool(getattr(config, "BATCH_MODE", False))
+
+
+def _write_output(output_path: str, records: list[dict]):
+    with open(output_path, "w", encoding="utf-8") as f:
+        for rec in records:
+            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+
+
+def parse_batch_output(output_path: str) -> dict:
+    """解析 Batch API 输出 JSONL，返回 custom_id -> (响应 body | None, 错误信息)。"""
+    results = {}
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            rec = json.loads(line)
+            response = rec.get("response") or {}
+            if rec.get("error") or response.get("status_code", 200) >= 400:
+                results[rec["custom_id"]] = (None, str(rec.get("error") or response.get("body")))
+            else:
+                results[rec["custom_id"]] = (response.get("body"), "")
+    return results
+
+
+class LocalFileBatchBackend:
+    """
+    批量接口的本地替身：读取批量请求文件，逐条调用 BASE_URL 上的 chat/completions，
+    按 Batch API 的输出格式写回 <输入>.output.jsonl。配合 utils/bench_mock_server.py 可完全离线测试。
+    """
+
+    def __init__(self, concurrency: int = 16):
+        from openai import OpenAI
+        self.client = OpenAI(api_key=config.API_KEY, base_url=config.BASE_URL)
+        self.concurrency = concurrency
+
+    def _execute(self, line: str) -> dict:
+        req = json.loads(line)
+        try:
+            resp = self.client.chat.completions.create(**req["body"])
+            return {
+                "id": f"batch_req_{req['custom_id']}",
+                "custom_id": req["custom_id"],
+                "response": {"status_code": 200, "body": resp.model_dump(mode="json")},
+                "error": None,
+            }
+        except Exception as e:
+            return {"id": f"batch_req_{req['custom_id']}", "custom_id": req["custom_id"], "response": None, "error": {"message": str(e)}}
+
+    def run(self, input_path: str) -> dict:
+        with open(input_path, "r", encoding="utf-8") as f:
+            lines = [line for line in f if line.strip()]
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            records = list(pool.map(self._execute, lines))
+        output_path = input_path[: -len(".jsonl")] + ".output.jsonl"
+        _write_output(output_path, records)
+        return parse_batch_output(output_path)
+
+
+class OpenAIBatchBackend:
+    """OpenAI 兼容的 Batch API：上传请求文件、创建 batch、轮询直到结束后下载结果。"""
+
+    def __init__(self, poll_interval: float = 30.0, completion_window: str = "24h"):
+        from openai import OpenAI
+        self.client = OpenAI(api_key=config.API_KEY, base_url=config.BASE_URL)
+        self.poll_interval = poll_interval
+        self.completion_window = completion_window
+
+    def run(self, input_path: str) -> dict:
+        with open(input_path, "rb") as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window=self.completion_window,
+        )
+        print(f"[Batch] Submitted {batch.id} ({os.path.basename(input_path)})")
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            time.sleep(self.poll_interval)
+            batch = self.client.batches.retrieve(batch.id)
+        if batch.status != "completed" and not batch.output_file_id:
+            raise BatchRequestError(f"Batch {batch.id} ended with status {batch.status}")
+
+        output_path = input_path[: -len(".jsonl")] + ".output.jsonl"
+        with open(output_path, "w", encoding="utf-8") as f:
+            for file_id in (batch.output_file_id, batch.error_file_id):
+                if file_id:
+                    f.write(self.client.files.content(file_id).text.rstrip("\n") + "\n")
+        return parse_batch_output(output_path)
+
+
+def create_batch_backend():
+    backend = getattr(config, "BATCH_BACKEND", "local")
+    if backend == "local":
+        return LocalFileBatchBackend(getattr(config, "BATCH_LOCAL_CONCURRENCY", 16))
+    if backend == "openai":
+        return OpenAIBatchBackend(
+            getattr(config, "BATCH_POLL_INTERVAL", 30.0),
+            getattr(config, "BATCH_COMPLETION_WINDOW", "24h"),
+        )
+    raise ValueError(f"Unknown BATCH_BACKEND: {backend}")
+
+
+class BatchDispatcher:
+    """
+    锁步批量调度：所有对话的 LLM 请求先挂起，当每个活跃对话都在等待结果（即同一阶段的请求已到齐）、
+    空闲超过 BATCH_FLUSH_IDLE 秒或达到 BATCH_MAX_REQUESTS 时，整批写成一个批量请求文件提交，
+    结果回填给各自的等待方，各对话随即进入下一阶段。
+    只在单进程异步模式下使用，绑定到创建它的事件循环。
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, backend, batch_dir: str):
+        self.loop = loop
+        self.backend = backend
+        self.batch_dir = batch_dir
+        self.flush_idle = getattr(config, "BATCH_FLUSH_IDLE", 2.0)
+        self.max_requests = getattr(config, "BATCH_MAX_REQUESTS", 50000)
+        self.active = 0
+        self.phases = 0
+        self.requests = 0
+        self._ids = itertools.count()
+        self._pending = []
+        self._wake = asyncio.Event()
+        self._flusher = None
+        # 后端单独占一个线程：默认线程池被阻塞在 submit_blocking 上的 agent 线程占满时，批次仍能提交
+        self._backend_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="batch-backend")
+        os.makedirs(batch_dir, exist_ok=True)
+
+    @contextmanager
+    def dialogue_scope(self, dialogue_id: str):
+        """对话运行期间计入活跃数，并标记其后发出的请求属于该对话。"""
+        self.active += 1
+        token = _CURRENT_DIALOGUE.set(dialogue_id)
+        try:
+            yield
+        finally:
+            _CURRENT_DIALOGUE.reset(token)
+            self.active -= 1
+            # 活跃对话减少后，剩余挂起的请求可能已经满足提交条件
+            self._wake.set()
+
+    async def submit(self, body: dict, dialogue_id=None) -> dict:
+        """挂起一个 chat/completions 请求，返回批量结果中的响应 body。"""
+        fut = self.loop.create_future()
+        if dialogue_id is None:
+            dialogue_id = _CURRENT_DIALOGUE.get()
+        self._pending.append((f"req-{next(self._ids)}", body, fut, dialogue_id))
+        self._wake.set()
+        if self._flusher is None or self._flusher.done():
+            self._flusher = asyncio.ensure_future(self._flush_loop())
+        return await fut
+
+    def submit_blocking(self, body: dict) -> dict:
+        """供 autogen 所在的工作线程调用：把请求交给事件循环并阻塞等待结果。"""
+        dialogue_id = _CURRENT_DIALOGUE.get()
+        return asyncio.run_coroutine_threadsafe(self.submit(body, dialogue_id), self.loop).result()
+
+    def _ready(self) -> bool:
+        live = [item for item in self._pending if not item[2].done()]
+        waiting = {item[3] for item in live}
+        return len(live) >= self.max_requests or len(waiting) >= self.active
+
+    async def _flush_loop(self):
+        while self._pending:
+            while not self._ready():
+                self._wake.clear()
+                try:
+                    await asyncio.wait_for(self._wake.wait(), timeout=self.flush_idle)
+                except asyncio.TimeoutError:
+                    break
+            # 已被取消的请求（如短路掉的审查）不再提交
+            live = [item for item in self._pending if not item[2].done()]
+            batch, rest = live[: self.max_requests], live[self.max_requests:]
+            self._pending = rest
+            if batch:
+                await self._run_batch(batch)
+
+    async def _run_batch(self, batch: list):
+        self.phases += 1
+        self.requests += len(batch)
+        input_path = os.path.join(self.batch_dir, f"batch_{os.getpid()}_{self.phases:05d}.jsonl")
+        with open(input_path, "w", encoding="utf-8") as f:
+            for custom_id, body, _, _ in batch:
+                f.write(json.dumps({
+                    "custom_id": custom_id,
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": body,
+                }, ensure_ascii=False) + "\n")
+        dialogues = len({item[3] for item in batch})
+        print(f"[Batch] Phase {self.phases}: {len(batch)} request(s) from {dialogues} dialogue(s) -> {input_path}")
+
+        try:
+            results = await self.loop.run_in_executor(self._backend_executor, self.backend.run, input_path)
+        except Exception as e:
+            for _, _, fut, _ in batch:
+                if not fut.done():
+                    fut.set_exception(BatchRequestError(f"Batch submission failed: {e}"))
+            return
+        for custom_id, _, fut, _ in batch:
+            if fut.done():
+                continue
+            body, error = results.get(custom_id, (None, "missing from batch output"))
+            if body is None:
+                fut.set_exception(BatchRequestError(f"Batch request {custom_id} failed: {error}"))
+            else:
+                fut.set_result(body)
+
+
+def get_batch_dispatcher() -> BatchDispatcher | None:
+    """BATCH_MODE 开启时返回绑定当前事件循环的调度器，否则返回 None。"""
+    global _DISPATCHER
+    if not batch_mode_enabled():
+        return None
+    loop = asyncio.get_running_loop()
+    if _DISPATCHER is None or _DISPATCHER.loop is not loop:
+        # 失败重试时 main.py 会启动新的事件循环，调度器随之重建（累计统计保留）
+        previous = _DISPATCHER
+        _DISPATCHER = BatchDispatcher(
+            loop,
+            create_batch_backend(),
+            getattr(config, "BATCH_DIR", "output/batches"),
+        )
+        if previous is not None:
+            _DISPATCHER.phases, _DISPATCHER.requests = previous.phases, previous.requests
+    return _DISPATCHER
+
+
+def batch_summary() -> str:
+    if _DISPATCHER is None:
+        return "Batch mode: no requests submitted."
+    return f"Batch mode: {_DISPATCHER.requests} request(s) in {_DISPATCHER.phases} batch(es) (files in {_DISPATCHER.batch_dir})"
+
+
+def build_request_body(params: dict) -> dict:
+    """只保留 chat/completions 接口认识的参数（autogen 的 params 里还有其自身的配置项）。"""
+    return {k: v for k, v in params.items() if k in _CREATE_PARAMS and v is not None}
+
+
+class BatchModelClient:
+    """
+    autogen 的自定义 model client：AssistantAgent 的每次生成都交给 BatchDispatcher，
+    使 agent 的生成请求与评审请求进入同一批次。
+    """
+
+    def __init__(self, config: dict, **kwargs):
+        self.model = config.get("model")
+
+    def create(self, params: dict):
+        from openai.types.chat import ChatCompletion
+        body = build_request_body({"model": self.model, **params})
+        if _DISPATCHER is None:
+            raise BatchRequestError("Batch dispatcher is not running; BATCH_MODE requires ASYNC_MODE.")
+        return ChatCompletion.model_validate(_DISPATCHER.submit_blocking(body))
+
+    def message_retrieval(self, response) -> list:
+        return [
+            choice.message if choice.message.tool_calls or choice.message.function_call else choice.message.content
+            for choice in response.choices
+        ]
+
+    def cost(self, response) -> float:
+        return 0.0
+
+    @staticmethod
+    def get_usage(response) -> dict:
+        usage = response.usage
+        return {
+            "prompt_tokens": usage.prompt_tokens if usage else 0,
+            "completion_tokens": usage.completion_tokens if usage else 0,
+            "total_tokens": usage.total_tokens if usage else 0,
+            "cost": 0.0,
+            "model": response.model,
+        }
+
+
+def inject_batch_client(llm_config: dict) -> dict:
+    """BATCH_MODE 下返回 config_list 使用 BatchModelClient 的 llm_config 副本（构造 agent 之前调用，不修改传入的配置）。"""
+    if not batch_mode_enabled():
+        return llm_config
+    return {
+        **llm_config,
+        "config_list": [{**entry, "model_client_cls": "BatchModelClient"} for entry in llm_config.get("config_list", [])],
+    }
+
+
+def register_batch_client(assistant):
+    """BATCH_MODE 下为已构造的 AssistantAgent 注册 BatchModelClient（config_list 被 replay 模式改用其他 client 时跳过）。"""
+    entries = (getattr(assistant, "llm_config", None) or {}).get("config_list", [])
+    if batch_mode_enabled() and any(entry.get("model_client_cls") == "BatchModelClient" for entry in entries):
+        assistant.register_model_client(model_client_cls=BatchModelClient)
@@ -0,0 +1,77 @@
+import hashlib
+import json
+import os
+import re
+import time
+import uuid
+import config
+
+_STORE = None
+CHECKPOINT_VERSION = 1
+
+# 影响对话内容的配置：任何一项与保存检查点时不同，检查点都不再适用
+CHECKPOINT_CONFIG_KEYS = (
+    "MODEL_NAME", "BASE_URL", "MAX_REJECTIONS", "MAX_TOTAL_TURNS", "ENABLE_RELATED_USER_MEMORY",
+    "FAISS_INDEX_PATH", "MEMORY_PROFILE_PATH", "FUSED_USER_REVIEW", "SPECULATIVE_INTENT",
+    "PROFILE_SCREEN_MODE", "PROFILE_SCREEN_PASS_THRESHOLD", "PROFILE_SCREEN_FAIL_THRESHOLD",
+    "INTENT_CLASSIFIER_MODE", "INTENT_CLASSIFIER_THRESHOLD", "GENERATION_CANDIDATES",
+    "HISTORY_TOKEN_BUDGET", "HISTORY_SUMMARY_MAX_TOKENS", "HISTORY_BUDGET_FOR_REVIEW", "AGENT_EXECUTOR",
+    "NATIVE_TOOL_MAX_ROUNDS", "MEMORY_PREFETCH", "SPECULATIVE_MOVIE_SEARCH", "STREAM_FORMAT_ABORT",
+)
+
+
+def profile_fingerprint(profile: dict) -> str:
+    """profile 内容与 CHECKPOINT_CONFIG_KEYS 配置的哈希；profile 或相关配置改动后旧检查点作废。"""
+    settings = {key: getattr(config, key, None) for key in CHECKPOINT_CONFIG_KEYS}
+    raw = json.dumps([profile, settings], ensure_ascii=False, sort_keys=True, default=str)
+    return hashlib.md5(raw.encode("utf-8")).hexdigest()
+
+
+class CheckpointStore:
+    """
+    对话检查点：每个 user_id 一个 JSON 文件，每完成一轮写一次（先写临时文件再原子替换）。
+    对话结果落盘后删除，崩溃 / 超时后重跑时从最后一个完整轮次继续。
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, user_id: str) -> str:
+        # user_id 可能含有不适合做文件名的字符，保留可读前缀并加哈希避免冲突
+        safe = re.sub(r"[^A-Za-z0-9_.-]", "_", str(user_id))[:64]
+        digest = hashlib.md5(str(user_id).encode("utf-8")).hexdigest()[:8]
+        return os.path.join(self.directory, f"{safe}_{digest}.json")
+
+    def save(self, user_id: str, state: dict):
+        path = self._path(user_id)
+        tmp_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({**state, "version": CHECKPOINT_VERSION, "saved_at": time.time()}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def load(self, user_id: str) -> dict | None:
+        try:
+            with open(self._path(user_id), "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        if state.get("version") != CHECKPOINT_VERSION:
+            return None
+        return state
+
+    def delete(self, user_id: str):
+        try:
+            os.remove(self._path(user_id))
+        except OSError:
+            pass
+
+
+def get_checkpoint_store() -> CheckpointStore | None:
+    """ENABLE_CHECKPOINTS 开启时返回进程内共享的检查点存储，否则返回 None。"""
+    global _STORE
+    if not getattr(config, "ENABLE_CHECKPOINTS", False):
+        return None
+    if _STORE is None:
+        _STORE = CheckpointStore(getattr(config, "CHECKPOINT_DIR", "output/checkpoints"))
+    return _STORE
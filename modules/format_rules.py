@@ -0,0 +1,30 @@
+import re
+
+
+def format_issues(response: str, role: str) -> list[str]:
+    """
+    回复格式规则（DialogueController._review_format 与流式生成的提前中止共用）。
+    规则只在文本追加时由不命中变为命中，因此可以对生成到一半的文本逐段检查。
+    """
+    issues = []
+    
+    # 检查是否使用了编号列表
+    if re.search(r'^\d+[\.\)]\s', response, re.MULTILINE):
+        issues.append("Contains numbered list")
+    
+    # 检查是否使用了项目符号
+    if re.search(r'^[-*•]\s', response, re.MULTILINE):
+        issues.append("Contains bullet points")
+    
+    # 对于系统回复，检查是否使用了机器人式标题
+    if role == "system":
+        if re.search(r'\*\*[^*]+:\*\*', response) or re.search(r'\*\*[^*]+\*\*:', response):
+            issues.append("Contains robotic headers like '**Plot:**' or '**Why this fits:**'")
+    
+    # 检查是否包含多个电影推荐（系统回复）
+    if role == "system":
+        movie_titles = re.findall(r'\*\*"([^"]+)"\*\*', response)
+        if len(movie_titles) > 1:
+            issues.append(f"Recommends multiple movies ({len(movie_titles)} movies found)")
+    
+    return issues
@@ -0,0 +1,102 @@
+import threading
+
+
+def stable_window(messages: list, size: int = 10) -> list:
+    """
+    取最近约 size 条消息，窗口起点按 size // 2 对齐、跳跃式前移（返回 size 到 size + size // 2 - 1 条）。
+    逐条滑动的窗口每轮都会改变历史部分的开头，使 provider 端的上下文缓存整体失效；
+    对齐后相邻几轮请求的历史部分保持相同前缀。
+    """
+    step = max(1, size // 2)
+    start = max(0, len(messages) - size)
+    start -= start % step
+    return messages[start:]
+
+
+def estimate_text_tokens(text: str) -> int:
+    """粗略估算 token 数（4 字符 / token，与 rate_limiter.estimate_tokens 一致）。"""
+    return len(text) // 4
+
+
+def format_messages(messages: list, labels: dict) -> str:
+    """按 {role: 显示名} 把消息渲染成 "显示名: 内容" 的多行文本。"""
+    return "".join(f"{labels.get(msg['role'], msg['role'])}: {msg['content']}\n" for msg in messages)
+
+
+class RollingHistory:
+    """
+    对话级历史管理：最近的消息原样保留，总量超过 token_budget 时把较早的消息增量折叠进滚动摘要
+    （只把新折叠的消息与上一版摘要交给 LLM，不重新摘要整段对话）。
+    折叠后原样部分降到预算的一半左右，因此摘要只会隔几轮更新一次，相邻请求的历史前缀保持不变。
+    agent（以及开启 HISTORY_BUDGET_FOR_REVIEW 时的审查）通过 render 取得有界上下文，
+    并累计与不开启预算时原本发送的历史（固定条数窗口）相比的 token 数。
+    """
+
+    def __init__(self, token_budget: int, keep_recent: int = 2):
+        self.token_budget = token_budget
+        self.keep_recent = keep_recent
+        self.summary = ""
+        self.folded = 0  # 已折叠进摘要的消息数（raw_log 的前缀）
+        self.summaries = 0
+        self.baseline_tokens = 0
+        self.sent_tokens = 0
+        # 多候选生成时 render 在多个 agent 线程中同时调用
+        self._stats_lock = threading.Lock()
+
+    def _fold_cut(self, messages: list) -> int:
+        """返回需要折叠到的位置（不需要折叠时返回 self.folded）。"""
+        recent = messages[self.folded:]
+        sizes = [estimate_text_tokens(msg["content"]) for msg in recent]
+        if sum(sizes) <= self.token_budget:
+            return self.folded
+        # 从最新的消息往前保留，直到占满一半预算；至少保留 keep_recent 条
+        kept, total = 0, 0
+        for size in reversed(sizes):
+            if kept >= self.keep_recent and total + size > self.token_budget // 2:
+                break
+            kept += 1
+            total += size
+        return self.folded + len(recent) - kept
+
+    def needs_update(self, messages: list) -> bool:
+        return self._fold_cut(messages) > self.folded
+
+    async def update(self, messages: list, summarize) -> bool:
+        """
+        需要时折叠较早的消息：summarize(上一版摘要, 新折叠的消息) -> 新摘要（异步）。
+        返回是否更新了摘要；summarize 出错时状态不变（异常向上抛出）。
+        """
+        cut = self._fold_cut(messages)
+        if cut <= self.folded:
+            return False
+        self.summary = await summarize(self.summary, messages[self.folded:cut])
+        self.folded = cut
+        self.summaries += 1
+        return True
+
+    def render(self, messages: list, labels: dict, baseline: str) -> str:
+        """
+        摘要 + 原样保留的最近消息。baseline 为不开启预算时这次请求原本发送的历史文本，
+        与实际发送的 token 数一并累计。
+        """
+        text = format_messages(messages[self.folded:], labels)
+        if self.summary:
+            text = f"[Summary of earlier conversation]: {self.summary}\n{text}"
+        with self._stats_lock:
+            self.baseline_tokens += estimate_text_tokens(baseline)
+            self.sent_tokens += estimate_text_tokens(text)
+        return text
+
+    def state(self) -> dict:
+        return {"summary": self.summary, "folded": self.folded}
+
+    def load_state(self, state: dict):
+        self.summary = state.get("summary", "")
+        self.folded = state.get("folded", 0)
+
+    def stats(self) -> dict:
+        return {
+            "history_baseline_tokens": self.baseline_tokens,
+            "history_sent_tokens": self.sent_tokens,
+            "history_summaries": self.summaries,
+        }
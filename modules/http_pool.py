@@ -0,0 +1,156 @@
+import asyncio
+import threading
+import httpx
+import config
+from modules.tracing import record_cached_prompt_tokens
+
+_SYNC_CLIENT = None
+_ASYNC_CLIENTS = {}
+_LOCK = threading.Lock()
+
+
+class ConnectionStats:
+    """统计请求数与新建 TCP 连接数，用于估算连接复用率。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.new_connections = 0
+
+    def on_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def on_connect(self):
+        with self._lock:
+            self.new_connections += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            reused = max(0, self.requests - self.new_connections)
+            return {
+                "requests": self.requests,
+                "new_connections": self.new_connections,
+                "reuse_rate": reused / self.requests if self.requests else 0.0,
+            }
+
+
+CONNECTION_STATS = ConnectionStats()
+
+
+def _trace(event_name: str, info: dict):
+    # httpcore 的 trace 扩展：每次真正建立 TCP 连接时触发 connection.connect_tcp.complete
+    if event_name == "connection.connect_tcp.complete":
+        CONNECTION_STATS.on_connect()
+
+
+async def _async_trace(event_name: str, info: dict):
+    _trace(event_name, info)
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=getattr(config, "HTTP_MAX_CONNECTIONS", 100),
+        max_keepalive_connections=getattr(config, "HTTP_MAX_KEEPALIVE", 20),
+        keepalive_expiry=getattr(config, "HTTP_KEEPALIVE_EXPIRY", 60.0),
+    )
+
+
+def _timeout() -> httpx.Timeout:
+    return httpx.Timeout(config.LLM_CONFIG.get("timeout", 120), connect=10.0)
+
+
+def _record_cache_hits(response: httpx.Response):
+    """
+    autogen 的 ChatResult.cost 不含 provider 缓存命中明细，这里直接从响应体的 usage 中读取，
+    记到当前 span（autogen 在线程中运行，contextvars 随 asyncio.to_thread 复制过去）。
+    """
+    if response.status_code != 200:
+        return
+    try:
+        usage = response.json().get("usage")
+    except (ValueError, AttributeError):
+        return
+    if usage:
+        record_cached_prompt_tokens(usage)
+
+
+class _SharedHttpClient(httpx.Client):
+    """
+    进程内共享的同步连接池。
+    autogen 会 deepcopy llm_config，这里返回自身，保证所有 agent 拿到的是同一个连接池。
+    """
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def send(self, request, **kwargs):
+        CONNECTION_STATS.on_request()
+        request.extensions["trace"] = _trace
+        response = super().send(request, **kwargs)
+        if not kwargs.get("stream") and request.url.path.endswith("/chat/completions"):
+            _record_cache_hits(response)
+        return response
+
+
+class _SharedAsyncHttpClient(httpx.AsyncClient):
+    def __deepcopy__(self, memo):
+        return self
+
+    async def send(self, request, **kwargs):
+        CONNECTION_STATS.on_request()
+        request.extensions["trace"] = _async_trace
+        return await super().send(request, **kwargs)
+
+
+def get_shared_http_client() -> httpx.Client | None:
+    """进程级 keep-alive 连接池（同步），注入 autogen agent 的 OpenAI 客户端。未开启时返回 None。"""
+    global _SYNC_CLIENT
+    if not getattr(config, "ENABLE_SHARED_HTTP_POOL", True):
+        return None
+    with _LOCK:
+        if _SYNC_CLIENT is None:
+            _SYNC_CLIENT = _SharedHttpClient(
+                limits=_limits(),
+                timeout=_timeout(),
+                http2=getattr(config, "HTTP2", False),
+            )
+        return _SYNC_CLIENT
+
+
+def get_shared_async_http_client() -> httpx.AsyncClient | None:
+    """
+    当前事件循环的共享异步连接池（httpx.AsyncClient 不能跨事件循环使用，因此按 loop 缓存）。
+    异步模式下整个进程只有一个 loop，所有对话共用；进程池模式下每个 worker 复用同一个常驻 loop
+    （见 ControllerAgent._get_worker_loop），连接池在 worker 进程的整个生命周期内保持，随进程退出释放。
+    """
+    if not getattr(config, "ENABLE_SHARED_HTTP_POOL", True):
+        return None
+    loop = asyncio.get_running_loop()
+    with _LOCK:
+        client = _ASYNC_CLIENTS.get(loop)
+        if client is None or client.is_closed:
+            client = _SharedAsyncHttpClient(
+                limits=_limits(),
+                timeout=_timeout(),
+                http2=getattr(config, "HTTP2", False),
+            )
+            _ASYNC_CLIENTS[loop] = client
+        return client
+
+
+async def close_async_http_client():
+    """关闭当前事件循环的共享连接池（事件循环结束前调用）。"""
+    loop = asyncio.get_running_loop()
+    with _LOCK:
+        client = _ASYNC_CLIENTS.pop(loop, None)
+    if client is not None:
+        await client.aclose()
+
+
+def inject_http_client(llm_config: dict) -> dict:
+    """返回 llm_config 的副本，每个 config_list 条目注入共享连接池（不修改传入的 config.LLM_CONFIG）。"""
+    client = get_shared_http_client()
+    if client is None:
+        return {**llm_config, "config_list": [dict(entry) for entry in llm_config.get("config_list", [])]}
+    return {**llm_config, "config_list": [{**entry, "http_client": client} for entry in llm_config.get("config_list", [])]}
@@ -0,0 +1,135 @@
+import json
+import os
+import threading
+import numpy as np
+import config
+
+LABELS = ("ACCEPT", "REJECT", "INQUIRY")
+
+_LOCAL_JUDGE = None
+_LOCAL_JUDGE_LOADED = False
+_LOG_LOCK = threading.Lock()
+
+
+class IntentClassifier:
+    """基于句向量的多分类逻辑回归（softmax），纯 numpy 实现，CPU 上单条预测为毫秒级。"""
+
+    def __init__(self, weights: np.ndarray | None = None, bias: np.ndarray | None = None):
+        self.weights = weights
+        self.bias = bias
+
+    def fit(self, X: np.ndarray, y: np.ndarray, l2: float = 1e-3, lr: float = 0.5, epochs: int = 500) -> "IntentClassifier":
+        n, dim = X.shape
+        k = len(LABELS)
+        self.weights = np.zeros((dim, k), dtype="float32")
+        self.bias = np.zeros(k, dtype="float32")
+        onehot = np.eye(k, dtype="float32")[y]
+        # 按类别频率反向加权，避免 INQUIRY 等多数类淹没少数类
+        counts = np.bincount(y, minlength=k).astype("float32")
+        sample_weight = (n / (k * np.maximum(counts, 1)))[y][:, None]
+        for _ in range(epochs):
+            grad = (self.predict_proba(X) - onehot) * sample_weight / n
+            self.weights -= lr * (X.T @ grad + l2 * self.weights)
+            self.bias -= lr * grad.sum(axis=0)
+        return self
+
+    def predict_proba(self, X: np.ndarray) -> np.ndarray:
+        logits = X @ self.weights + self.bias
+        logits -= logits.max(axis=1, keepdims=True)
+        exp = np.exp(logits)
+        return exp / exp.sum(axis=1, keepdims=True)
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        np.savez(path, weights=self.weights, bias=self.bias, labels=np.array(LABELS))
+
+    @classmethod
+    def load(cls, path: str) -> "IntentClassifier":
+        data = np.load(path)
+        if tuple(data["labels"]) != LABELS:
+            raise ValueError(f"Intent classifier labels {tuple(data['labels'])} do not match {LABELS}")
+        return cls(data["weights"], data["bias"])
+
+
+class LocalIntentJudge:
+    """共享 MiniLM 编码 + IntentClassifier，返回 (意图, 置信度)。"""
+
+    def __init__(self, classifier: IntentClassifier):
+        from modules.tools import get_shared_model
+        self.model = get_shared_model()
+        self.classifier = classifier
+
+    def predict(self, text: str) -> tuple[str, float]:
+        vec = self.model.encode([text], normalize_embeddings=True)
+        proba = self.classifier.predict_proba(np.asarray(vec, dtype="float32"))[0]
+        best = int(proba.argmax())
+        return LABELS[best], float(proba[best])
+
+
+def get_local_intent_judge() -> LocalIntentJudge | None:
+    """
+    INTENT_CLASSIFIER_MODE="on" 时返回进程内共享的本地意图分类器，每个进程只加载一次；
+    未开启或模型文件不存在时返回 None（全部走 LLM）。
+    """
+    global _LOCAL_JUDGE, _LOCAL_JUDGE_LOADED
+    if getattr(config, "INTENT_CLASSIFIER_MODE", "off") != "on":
+        return None
+    if not _LOCAL_JUDGE_LOADED:
+        _LOCAL_JUDGE_LOADED = True
+        path = config.INTENT_CLASSIFIER_PATH
+        if os.path.exists(path):
+            _LOCAL_JUDGE = LocalIntentJudge(IntentClassifier.load(path))
+            print(f"[Init] Loaded local intent classifier: {path}")
+        else:
+            print(f"[Init] Intent classifier not found ({path}); falling back to the LLM judge.")
+    return _LOCAL_JUDGE
+
+
+def log_intent_decision(text: str, label: str):
+    """记录一次 LLM 意图判断，作为本地分类器的训练数据（多进程追加写同一个 JSONL）。"""
+    if getattr(config, "INTENT_CLASSIFIER_MODE", "off") == "off":
+        return
+    path = config.INTENT_LOG_PATH
+    line = json.dumps({"text": text, "label": label}, ensure_ascii=False) + "\n"
+    with _LOG_LOCK:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+
+def load_intent_log(path: str) -> tuple[list[str], list[str]]:
+    """读取判断日志，同一文本以最后一次结论为准。"""
+    latest = {}
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                rec = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if rec.get("label") in LABELS and rec.get("text"):
+                latest[rec["text"]] = rec["label"]
+    return list(latest), list(latest.values())
+
+
+def evaluate(classifier: IntentClassifier, X: np.ndarray, y: np.ndarray, threshold: float) -> dict:
+    """与 LLM 标签对比：整体准确率、置信度达到阈值时的覆盖率（省下的 LLM 调用）与准确率、各类别准确率。"""
+    proba = classifier.predict_proba(X)
+    pred = proba.argmax(axis=1)
+    confident = proba.max(axis=1) >= threshold
+    correct = pred == y
+    per_class = {}
+    for k, label in enumerate(LABELS):
+        mask = y == k
+        per_class[label] = {"support": int(mask.sum()), "accuracy": float(correct[mask].mean()) if mask.any() else 0.0}
+    return {
+        "samples": int(len(y)),
+        "accuracy": float(correct.mean()) if len(y) else 0.0,
+        "threshold": threshold,
+        "coverage": float(confident.mean()) if len(y) else 0.0,
+        "confident_accuracy": float(correct[confident].mean()) if confident.any() else 0.0,
+        # 低于阈值的样本回退到 LLM，视为正确
+        "effective_accuracy": float((correct | ~confident).mean()) if len(y) else 0.0,
+        "per_class": per_class,
+    }
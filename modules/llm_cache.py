@@ -0,0 +1,197 @@
+import hashlib
+import json
+import os
+import threading
+import uuid
+import config
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+
+class CacheMissError(RuntimeError):
+    """严格回放模式下请求未被录制过。"""
+
+
+class LLMResponseCache:
+    """
+    基于内容寻址的 LLM 响应磁盘缓存。
+    key = sha256(model, messages, temperature, response_format, 其他请求参数)，
+    每个响应存为 <dir>/<key 前两位>/<key>.json，可在多进程间共享。
+
+    模式:
+    - "off":       不使用缓存
+    - "readwrite": 只缓存 temperature=0 的确定性调用（评审 / 意图判断等），命中即复用
+    - "record":    缓存所有调用（含采样调用），供之后离线回放
+    - "replay":    只读缓存，未命中直接抛 CacheMissError，可完全离线重跑
+    超过 max_bytes 时按最近访问时间（LRU）淘汰。
+    """
+
+    def __init__(self, cache_dir: str, mode: str = "readwrite", max_bytes: int = 0):
+        if mode not in ("off", "readwrite", "record", "replay"):
+            raise ValueError(f"Unknown LLM cache mode: {mode}")
+        self.cache_dir = cache_dir
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = None
+        self._lock = threading.Lock()
+        if mode != "off":
+            os.makedirs(cache_dir, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    def should_cache(self, temperature: float) -> bool:
+        if self.mode in ("record", "replay"):
+            return True
+        return self.mode == "readwrite" and not temperature
+
+    @staticmethod
+    def make_key(model: str, messages: list, temperature: float, response_format=None, **extra) -> str:
+        payload = {
+            "model": model,
+            "messages": messages,
+            "temperature": temperature,
+            "response_format": response_format,
+            "extra": extra,
+        }
+        raw = json.dumps(payload, ensure_ascii=False, sort_keys=True, default=str)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key: str) -> dict | None:
+        """命中返回缓存的响应 dict；replay 模式下未命中抛 CacheMissError。"""
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            self.misses += 1
+            if self.mode == "replay":
+                raise CacheMissError(f"LLM cache miss in replay mode: {key}")
+            return None
+        self.hits += 1
+        try:
+            # 更新访问时间，作为 LRU 淘汰依据
+            os.utime(path)
+        except OSError:
+            pass
+        return data
+
+    def put(self, key: str, response: dict):
+        if self.mode not in ("readwrite", "record"):
+            return
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        raw = json.dumps(response, ensure_ascii=False)
+        # 先写临时文件再原子替换，多进程同时写同一 key 也不会读到半个文件
+        tmp_path = f"{path}.{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(raw)
+        os.replace(tmp_path, path)
+        if self.max_bytes:
+            with self._lock:
+                if self._size is None:
+                    self._size = self._scan_size()
+                self._size += len(raw.encode("utf-8"))
+                if self._size > self.max_bytes:
+                    self._evict()
+
+    def _iter_entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                yield path, st.st_size, st.st_mtime
+
+    def _scan_size(self) -> int:
+        return sum(size for _, size, _ in self._iter_entries())
+
+    def _evict(self):
+        """按最近访问时间从旧到新删除，直到降到上限的 90%。"""
+        entries = sorted(self._iter_entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        target = int(self.max_bytes * 0.9)
+        for path, size, _ in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                continue
+        self._size = total
+
+
+def get_llm_cache() -> LLMResponseCache:
+    """进程内共享的缓存实例，按 config 初始化。"""
+    global _CACHE
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            _CACHE = LLMResponseCache(
+                cache_dir=getattr(config, "LLM_CACHE_DIR", "output/llm_cache"),
+                mode=getattr(config, "LLM_CACHE_MODE", "off"),
+                max_bytes=int(getattr(config, "LLM_CACHE_MAX_MB", 0) * 1024 * 1024),
+            )
+        return _CACHE
+
+
+def get_autogen_cache():
+    """
+    record / replay 模式下给 autogen initiate_chat 使用的磁盘缓存，
+    使 agent 的生成与工具调用同样可以录制后离线回放。
+    """
+    cache = get_llm_cache()
+    if cache.mode not in ("record", "replay"):
+        return None
+    from autogen import Cache
+    return Cache.disk(cache_path_root=os.path.join(cache.cache_dir, "autogen"))
+
+
+class ReplayMissModelClient:
+    """
+    replay 模式下 autogen 的 model client：autogen 先查磁盘缓存，只有未命中时才会调用 create，
+    这里直接抛 CacheMissError，而不是悄悄访问网络（与 AsyncChatClient / ToolCallingAgent 的回放行为一致）。
+    """
+
+    def __init__(self, config: dict, **kwargs):
+        self.model = config.get("model")
+
+    def create(self, params: dict):
+        raise CacheMissError(f"Autogen cache miss in replay mode (model {self.model})")
+
+    def message_retrieval(self, response) -> list:
+        return []
+
+    def cost(self, response) -> float:
+        return 0.0
+
+    @staticmethod
+    def get_usage(response) -> dict:
+        return {}
+
+
+def inject_replay_client(llm_config: dict) -> dict:
+    """replay 模式下返回 config_list 使用 ReplayMissModelClient 的 llm_config 副本（优先于 BatchModelClient）。"""
+    if get_llm_cache().mode != "replay":
+        return llm_config
+    return {
+        **llm_config,
+        "config_list": [{**entry, "model_client_cls": "ReplayMissModelClient"} for entry in llm_config.get("config_list", [])],
+    }
+
+
+def register_replay_client(assistant):
+    """replay 模式下为已构造的 AssistantAgent 注册 ReplayMissModelClient。"""
+    if get_llm_cache().mode == "replay":
+        assistant.register_model_client(model_client_cls=ReplayMissModelClient)
@@ -0,0 +1,109 @@
+import asyncio
+import openai
+from openai import AsyncOpenAI
+from openai.types.chat import ChatCompletion
+import config
+from modules.rate_limiter import get_limiter, estimate_tokens, retry_after_seconds
+from modules.llm_cache import get_llm_cache
+from modules.tracing import record_llm_usage
+from modules.http_pool import get_shared_async_http_client
+from modules.batch_api import get_batch_dispatcher, build_request_body
+
+
+class AsyncChatClient:
+    """
+    DialogueController 使用的异步 LLM 调用入口。
+    同一事件循环内可同时挂起大量请求，等待网络时不占用进程。
+    安装了共享限流器时，每次调用前先占用配额，429 由限流器统一退避后重试。
+    开启响应缓存时先查磁盘缓存，命中则不发请求（也不占用限流配额）。
+    BATCH_MODE 下请求交给 BatchDispatcher，与其他对话同阶段的请求合并为一个批量任务。
+    """
+
+    def __init__(self, model: str = config.MODEL_NAME):
+        self.model = model
+        self.limiter = get_limiter()
+        self.cache = get_llm_cache()
+        self._client = None
+        self._owns_http_client = True
+
+    @property
+    def client(self) -> AsyncOpenAI:
+        """在事件循环内首次使用时创建，以便接入当前 loop 的共享连接池。"""
+        if self._client is None:
+            http_client = get_shared_async_http_client()
+            self._owns_http_client = http_client is None
+            # 有共享限流器时关闭 SDK 自带的重试，429 交给限流器协调
+            max_retries = 0 if self.limiter is not None else 2
+            self._client = AsyncOpenAI(
+                api_key=config.API_KEY,
+                base_url=config.BASE_URL,
+                max_retries=max_retries,
+                http_client=http_client,
+            )
+        return self._client
+
+    async def complete(self, messages: list[dict], temperature: float = 0.0, **kwargs):
+        cache_key = None
+        if self.cache.enabled and self.cache.should_cache(temperature):
+            cache_key = self.cache.make_key(self.model, messages, temperature, **kwargs)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                record_llm_usage(cached=True)
+                return ChatCompletion.model_validate(cached)
+
+        dispatcher = get_batch_dispatcher()
+        if dispatcher is not None:
+            body = build_request_body({"model": self.model, "messages": messages, "temperature": temperature, **kwargs})
+            resp = ChatCompletion.model_validate(await dispatcher.submit(body))
+        else:
+            resp = await self._request(messages, temperature, **kwargs)
+        record_llm_usage(getattr(resp, "usage", None))
+        if cache_key is not None:
+            self.cache.put(cache_key, resp.model_dump(mode="json"))
+        return resp
+
+    async def _request(self, messages: list[dict], temperature: float, **kwargs):
+        retries = getattr(config, "LLM_RATE_LIMIT_RETRIES", 5)
+        for attempt in range(retries + 1):
+            estimated = estimate_tokens(messages)
+            if self.limiter is not None:
+                await self.limiter.a_acquire(estimated)
+            try:
+                resp = await self.client.chat.completions.create(
+                    model=self.model,
+                    messages=messages,
+                    temperature=temperature,
+                    **kwargs,
+                )
+            except openai.RateLimitError as e:
+                if attempt >= retries:
+                    raise
+                if self.limiter is not None:
+                    delay = self.limiter.report_rate_limited(retry_after_seconds(e))
+                else:
+                    delay = max(retry_after_seconds(e) or 0.0, 2 ** attempt)
+                    await asyncio.sleep(delay)
+                print(f"    [RATE LIMIT] 429 received, backing off {delay:.1f}s (attempt {attempt + 1}/{retries})")
+                continue
+            if self.limiter is not None:
+                usage = getattr(resp, "usage", None)
+                self.limiter.record_usage(estimated, getattr(usage, "total_tokens", None))
+                self.limiter.report_success()
+            return resp
+
+    async def chat(self, prompt: str, temperature: float = 0.0, system: str | None = None, **kwargs) -> str:
+        """
+        单条 user 消息的便捷调用，返回去除首尾空白的文本。
+        system 放每个对话内不变的指令与画像，使其成为请求的公共前缀，便于命中 provider 端的上下文缓存。
+        """
+        messages = [{"role": "user", "content": prompt}]
+        if system:
+            messages.insert(0, {"role": "system", "content": system})
+        resp = await self.complete(messages, temperature=temperature, **kwargs)
+        return (resp.choices[0].message.content or "").strip()
+
+    async def close(self):
+        # 共享连接池由事件循环的持有者关闭，这里只关闭自建的客户端
+        if self._client is not None and self._owns_http_client:
+            await self._client.close()
+        self._client = None
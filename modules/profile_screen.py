@@ -0,0 +1,146 @@
+import json
+import os
+import numpy as np
+import config
+from modules.tools import get_shared_model
+
+
+class ProfileScreen:
+    """
+    本地 PROFILE 一致性预筛：用共享的 MiniLM 模型给候选回复打分，只有落在不确定区间的回复才交给 LLM 审查。
+    每个对话构造一次，画像侧的向量（persona + tone + verbosity、各条偏好）只编码一次。
+
+    分数 = 0.5 * 与人设/语气描述的余弦相似度 + 0.5 * 与最接近的一条偏好的余弦相似度。
+    score >= pass_threshold 直接 PASS，score <= fail_threshold 直接 FAIL，其余调用 LLM。
+    """
+
+    def __init__(self, profile: dict, pass_threshold: float, fail_threshold: float):
+        self.pass_threshold = pass_threshold
+        self.fail_threshold = fail_threshold
+        self.model = get_shared_model()
+
+        reflections = profile.get("reflections", {})
+        style = profile.get("dialogue_style", {})
+        persona_text = ". ".join(
+            str(part) for part in (
+                reflections.get("spectator_persona"),
+                style.get("tone"),
+                style.get("verbosity"),
+                reflections.get("decision_logic"),
+            ) if part
+        )
+        preferences = [str(p) for p in reflections.get("aesthetic_preferences", []) if p] or [persona_text]
+        anchors = self.model.encode([persona_text or "movie viewer"] + preferences, normalize_embeddings=True)
+        self.persona_vec = np.asarray(anchors[0], dtype="float32")
+        self.preference_mat = np.asarray(anchors[1:], dtype="float32")
+
+    def score(self, response: str) -> float:
+        vec = np.asarray(self.model.encode([response], normalize_embeddings=True)[0], dtype="float32")
+        persona_sim = float(self.persona_vec @ vec)
+        preference_sim = float((self.preference_mat @ vec).max())
+        return 0.5 * persona_sim + 0.5 * preference_sim
+
+    def decide(self, score: float) -> bool | None:
+        """返回 True（直接通过）、False（直接否决）或 None（不确定，需要 LLM 审查）。"""
+        if score >= self.pass_threshold:
+            return True
+        if score <= self.fail_threshold:
+            return False
+        return None
+
+
+def load_thresholds() -> tuple[float, float]:
+    """优先使用校准文件中的阈值，没有时使用 config 中的默认值。"""
+    pass_threshold = getattr(config, "PROFILE_SCREEN_PASS_THRESHOLD", 0.55)
+    fail_threshold = getattr(config, "PROFILE_SCREEN_FAIL_THRESHOLD", 0.10)
+    path = getattr(config, "PROFILE_SCREEN_CALIBRATION_PATH", "")
+    if path and os.path.exists(path):
+        with open(path, "r", encoding="utf-8") as f:
+            calibration = json.load(f)
+        pass_threshold = calibration.get("pass_threshold", pass_threshold)
+        fail_threshold = calibration.get("fail_threshold", fail_threshold)
+    return pass_threshold, fail_threshold
+
+
+def create_profile_screen(profile: dict) -> ProfileScreen | None:
+    """按 PROFILE_SCREEN_MODE 创建预筛器："off" 时返回 None。"""
+    mode = getattr(config, "PROFILE_SCREEN_MODE", "off")
+    if mode not in ("off", "shadow", "on"):
+        raise ValueError(f"Unknown PROFILE_SCREEN_MODE: {mode}")
+    if mode == "off":
+        return None
+    pass_threshold, fail_threshold = load_thresholds()
+    return ProfileScreen(profile, pass_threshold, fail_threshold)
+
+
+def load_screen_samples(trace_paths: list[str]) -> list[tuple[float, bool]]:
+    """
+    从 trace JSONL 中取出同时带有本地分数与 LLM 结论的 PROFILE 审查记录: [(score, llm_pass)]。
+    用 PROFILE_SCREEN_MODE="shadow" 运行时每次审查都会记录这两项。
+    """
+    samples = []
+    for path in trace_paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                rec = json.loads(line)
+                attrs = rec.get("attrs", {})
+                if rec.get("name") == "user.review.profile" and "screen_score" in attrs and "llm_pass" in attrs:
+                    samples.append((float(attrs["screen_score"]), bool(attrs["llm_pass"])))
+    return samples
+
+
+def evaluate_thresholds(samples: list[tuple[float, bool]], pass_threshold: float, fail_threshold: float) -> dict:
+    """按给定阈值统计：本地直接判定的比例（即省下的 LLM 调用）及其与 LLM 结论的一致率。"""
+    decided = agreed = 0
+    for score, llm_pass in samples:
+        if score >= pass_threshold:
+            decided += 1
+            agreed += llm_pass
+        elif score <= fail_threshold:
+            decided += 1
+            agreed += not llm_pass
+    total = len(samples)
+    return {
+        "samples": total,
+        "pass_threshold": pass_threshold,
+        "fail_threshold": fail_threshold,
+        "auto_decided": decided,
+        "calls_saved_rate": decided / total if total else 0.0,
+        "auto_agreement_rate": agreed / decided if decided else 1.0,
+        # 不确定区间交给 LLM，视为一致
+        "overall_agreement_rate": (agreed + total - decided) / total if total else 1.0,
+    }
+
+
+def fit_thresholds(samples: list[tuple[float, bool]], target_precision: float = 0.95, min_support: int = 20) -> dict:
+    """
+    分别拟合两个阈值：
+    - pass_threshold：最小的 t，使得 score >= t 的样本中 LLM 判 PASS 的比例不低于 target_precision
+    - fail_threshold：最大的 t，使得 score <= t 的样本中 LLM 判 FAIL 的比例不低于 target_precision
+    样本数少于 min_support 的区间不采用；找不到时对应阈值设为永不触发。
+    """
+    ordered = sorted(samples)
+    n = len(ordered)
+
+    pass_threshold = float("inf")
+    passes = 0
+    for i in range(n - 1, -1, -1):
+        passes += ordered[i][1]
+        support = n - i
+        if support >= min_support and passes / support >= target_precision:
+            pass_threshold = ordered[i][0]
+
+    fail_threshold = float("-inf")
+    fails = 0
+    for i in range(n):
+        fails += not ordered[i][1]
+        support = i + 1
+        if support >= min_support and fails / support >= target_precision:
+            fail_threshold = ordered[i][0]
+
+    if fail_threshold >= pass_threshold:
+        # 两个区间重叠时说明分数区分度不足，放弃自动否决
+        fail_threshold = float("-inf")
+    return evaluate_thresholds(samples, pass_threshold, fail_threshold)
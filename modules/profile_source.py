@@ -0,0 +1,47 @@
+import json
+import os
+from typing import Iterator
+
+
+def iter_profiles(profile_path: str, chunk_size: int = 1 << 20) -> Iterator[dict]:
+    """
+    流式读取 profile：支持 JSON 数组、单个 JSON 对象或 JSONL（每行一个对象）。
+    按块读取并逐个解析，内存占用与文件大小无关。
+    """
+    if not os.path.exists(profile_path):
+        raise FileNotFoundError(f"Profile not found: {profile_path}")
+    decoder = json.JSONDecoder()
+    with open(profile_path, "r", encoding="utf-8-sig") as f:
+        buf, pos, eof = "", 0, False
+        started = in_array = False
+        while True:
+            # 跳过空白与数组分隔符，缓冲区耗尽时再读一块
+            while pos < len(buf) and buf[pos] in " \t\r\n,":
+                pos += 1
+            if pos >= len(buf):
+                if eof:
+                    return
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buf, pos = buf[pos:] + chunk, 0
+                continue
+            if not started:
+                started = True
+                if buf[pos] == "[":
+                    in_array = True
+                    pos += 1
+                    continue
+            if in_array and buf[pos] == "]":
+                return
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                # 对象被块边界截断：补读后重新解析
+                if eof:
+                    raise
+                chunk = f.read(chunk_size)
+                eof = not chunk
+                buf, pos = buf[pos:] + chunk, 0
+                continue
+            pos = end
+            yield obj
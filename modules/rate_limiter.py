@@ -0,0 +1,233 @@
+import asyncio
+import json
+import multiprocessing
+import time
+import openai
+import config
+
+# 共享状态数组中的下标
+_REQ = 0          # 剩余请求令牌
+_TOK = 1          # 剩余 token 令牌
+_LAST = 2         # 上次补充令牌的时间
+_PENALTY = 3      # 收到 429 后，所有进程暂停到该时间点
+_BACKOFF = 4      # 当前退避时长（秒），连续 429 时翻倍，成功后减半
+
+_LIMITER = None
+
+
+class SharedRateLimiter:
+    """
+    跨进程令牌桶限流：同时限制每分钟请求数与每分钟 token 数。
+    状态放在共享内存中，通过 ProcessPoolExecutor 的 initializer 传给各 worker，
+    所有 worker（以及 autogen agent 的调用）共用同一组配额。
+    收到 429 时触发全局退避，避免各进程各自重试把限额打得更满。
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: float = 0,
+        tokens_per_minute: float = 0,
+        initial_backoff: float = 1.0,
+        max_backoff: float = 60.0,
+    ):
+        self.rpm = float(requests_per_minute or 0)
+        self.tpm = float(tokens_per_minute or 0)
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self._lock = multiprocessing.Lock()
+        self._state = multiprocessing.RawArray("d", [self.rpm, self.tpm, time.monotonic(), 0.0, 0.0])
+
+    def _refill(self, now: float):
+        s = self._state
+        elapsed = max(0.0, now - s[_LAST])
+        s[_LAST] = now
+        if self.rpm:
+            s[_REQ] = min(self.rpm, s[_REQ] + elapsed * self.rpm / 60.0)
+        if self.tpm:
+            s[_TOK] = min(self.tpm, s[_TOK] + elapsed * self.tpm / 60.0)
+
+    def _reserve(self, tokens: int) -> float:
+        """尝试占用一个请求与 tokens 个 token；成功返回 0，否则返回建议等待秒数。"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            s = self._state
+            if now < s[_PENALTY]:
+                return s[_PENALTY] - now
+            need = min(float(tokens), self.tpm) if self.tpm else 0.0
+            req_ok = not self.rpm or s[_REQ] >= 1.0
+            tok_ok = not self.tpm or s[_TOK] >= need
+            if req_ok and tok_ok:
+                if self.rpm:
+                    s[_REQ] -= 1.0
+                if self.tpm:
+                    s[_TOK] -= need
+                return 0.0
+            wait = 0.0
+            if not req_ok:
+                wait = max(wait, (1.0 - s[_REQ]) * 60.0 / self.rpm)
+            if not tok_ok:
+                wait = max(wait, (need - s[_TOK]) * 60.0 / self.tpm)
+            return max(wait, 0.01)
+
+    def acquire(self, tokens: int = 0):
+        """阻塞直到拿到配额（线程 / 同步调用使用）。"""
+        while True:
+            wait = self._reserve(tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    async def a_acquire(self, tokens: int = 0):
+        """异步版本，等待期间让出事件循环。"""
+        while True:
+            wait = self._reserve(tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def record_usage(self, estimated_tokens: int, actual_tokens: int):
+        """用实际 token 用量修正预估值（多退少补，可暂时为负）。"""
+        if not self.tpm or actual_tokens is None:
+            return
+        with self._lock:
+            self._state[_TOK] += min(float(estimated_tokens), self.tpm) - float(actual_tokens)
+
+    def report_rate_limited(self, retry_after: float | None = None) -> float:
+        """收到 429：退避时长翻倍并让所有进程暂停，返回本次退避秒数。"""
+        with self._lock:
+            s = self._state
+            now = time.monotonic()
+            backoff = min(self.max_backoff, max(self.initial_backoff, s[_BACKOFF] * 2))
+            s[_BACKOFF] = backoff
+            delay = max(backoff, retry_after or 0.0)
+            s[_PENALTY] = max(s[_PENALTY], now + delay)
+            # 清空请求桶，恢复后重新按速率放行
+            s[_REQ] = 0.0
+            return delay
+
+    def report_success(self):
+        with self._lock:
+            s = self._state
+            if s[_BACKOFF] > 0:
+                s[_BACKOFF] = s[_BACKOFF] / 2 if s[_BACKOFF] / 2 >= self.initial_backoff else 0.0
+
+
+def create_limiter_from_config() -> SharedRateLimiter | None:
+    rpm = getattr(config, "LLM_REQUESTS_PER_MINUTE", 0)
+    tpm = getattr(config, "LLM_TOKENS_PER_MINUTE", 0)
+    if not rpm and not tpm:
+        return None
+    return SharedRateLimiter(rpm, tpm, max_backoff=getattr(config, "LLM_MAX_BACKOFF", 60.0))
+
+
+def install_limiter(limiter: SharedRateLimiter | None):
+    """在当前进程安装共享限流器（父进程与各 worker 的 initializer 中调用）。"""
+    global _LIMITER
+    _LIMITER = limiter
+
+
+def get_limiter() -> SharedRateLimiter | None:
+    return _LIMITER
+
+
+def estimate_tokens(messages: list[dict] | None) -> int:
+    """粗略估算一次调用的 token 数：输入按 4 字符 / token，再加预期输出。"""
+    chars = 0
+    for msg in messages or []:
+        content = msg.get("content") if isinstance(msg, dict) else None
+        if isinstance(content, str):
+            chars += len(content)
+    return chars // 4 + getattr(config, "LLM_ESTIMATED_COMPLETION_TOKENS", 256)
+
+
+def retry_after_seconds(exc) -> float | None:
+    """从 429 响应头中读取 Retry-After。"""
+    response = getattr(exc, "response", None)
+    if response is None:
+        return None
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+
+def inject_retry_policy(llm_config: dict) -> dict:
+    """
+    有共享限流器时返回 config_list 条目带 max_retries=0 的 llm_config 副本：关闭 OpenAI SDK 自带的 429 重试，
+    交给 call_with_rate_limit_retry 与限流器统一退避（与 AsyncChatClient、ToolCallingAgent 一致）。
+    """
+    if _LIMITER is None:
+        return llm_config
+    return {**llm_config, "config_list": [{**entry, "max_retries": 0} for entry in llm_config.get("config_list", [])]}
+
+
+def _autogen_usage_tokens(agent) -> int:
+    """agent client 累计的实际 token 用量（不含 autogen 缓存命中）。"""
+    summary = getattr(getattr(agent, "client", None), "actual_usage_summary", None) or {}
+    return sum(usage.get("total_tokens", 0) or 0 for usage in summary.values() if isinstance(usage, dict))
+
+
+def _settle_autogen_reservation(agent, limiter):
+    """用预占以来的实际用量修正上一次预占；没有发出回复（如 429）时实际用量为 0，预占全部退回。"""
+    reservation = getattr(agent, "_rate_limit_reservation", None)
+    if reservation is None:
+        return
+    agent._rate_limit_reservation = None
+    estimated, usage_before = reservation
+    limiter.record_usage(estimated, max(0, _autogen_usage_tokens(agent) - usage_before))
+
+
+def throttle_autogen_reply(recipient, messages=None, sender=None, config=None):
+    """
+    注册在 autogen AssistantAgent 最前面的 reply 函数：
+    每次 LLM 生成前先占用共享配额（估算包含 system message 与工具定义），然后返回 (False, None) 交给后续的 LLM reply 继续处理。
+    回复发出时由 settle_autogen_usage 按实际用量修正。
+    """
+    limiter = get_limiter()
+    if limiter is not None:
+        # 上一次预占没有等到回复（429 等异常）时先退回
+        _settle_autogen_reservation(recipient, limiter)
+        llm_config = getattr(recipient, "llm_config", None) or {}
+        context = [{"content": getattr(recipient, "system_message", "")}]
+        if llm_config.get("tools"):
+            context.append({"content": json.dumps(llm_config["tools"])})
+        estimated = estimate_tokens(context + list(messages or []))
+        limiter.acquire(estimated)
+        recipient._rate_limit_reservation = (estimated, _autogen_usage_tokens(recipient))
+    return False, None
+
+
+def settle_autogen_usage(sender, message, recipient, silent):
+    """
+    注册为 AssistantAgent 的 process_message_before_send hook：LLM 回复发出前，
+    用 client 用量汇总的增量修正 throttle_autogen_reply 的预占。返回原消息。
+    """
+    limiter = get_limiter()
+    if limiter is not None:
+        _settle_autogen_reservation(sender, limiter)
+    return message
+
+
+def call_with_rate_limit_retry(fn, *args, **kwargs):
+    """
+    同步调用（autogen initiate_chat）遇到 429 时统一退避后重试，
+    而不是把异常抛给上层导致整段对话失败。
+    """
+    retries = getattr(config, "LLM_RATE_LIMIT_RETRIES", 5)
+    for attempt in range(retries + 1):
+        try:
+            result = fn(*args, **kwargs)
+            if _LIMITER is not None:
+                _LIMITER.report_success()
+            return result
+        except openai.RateLimitError as e:
+            if attempt >= retries:
+                raise
+            if _LIMITER is not None:
+                # 退避由共享限流器执行：下次 acquire 会等到全局暂停结束
+                delay = _LIMITER.report_rate_limited(retry_after_seconds(e))
+            else:
+                delay = max(retry_after_seconds(e) or 0.0, 2 ** attempt)
+                time.sleep(delay)
+            print(f"    [RATE LIMIT] 429 received, backing off {delay:.1f}s (attempt {attempt + 1}/{retries})")
@@ -0,0 +1,159 @@
+import json
+import os
+import time
+
+
+class JsonlResultSink:
+    """
+    逐条追加写入对话结果（JSONL）。
+    - 每条写入后 flush，进程崩溃时已完成的对话不会丢失；
+    - fsync 按条数 / 时间间隔批量进行，兼顾掉电安全与写入开销。
+    """
+
+    def __init__(self, path: str, append: bool = False, fsync_every: int = 20, fsync_interval: float = 5.0):
+        self.path = path
+        self.fsync_every = max(1, fsync_every)
+        self.fsync_interval = fsync_interval
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        if append:
+            _truncate_partial_line(path)
+        self._file = open(path, "a" if append else "w", encoding="utf-8")
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self.written = 0
+
+    def write(self, record: dict):
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+        self.written += 1
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        if self._unsynced == 0:
+            return
+        os.fsync(self._file.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._file.flush()
+        self.sync()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def _truncate_partial_line(path: str):
+    """崩溃可能留下半行记录，续写前截断到最后一个完整行。"""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        if size == 0:
+            return
+        f.seek(size - 1)
+        if f.read(1) == b"\n":
+            return
+        # 向前查找最后一个换行符
+        pos = size - 1
+        chunk = 4096
+        while pos > 0:
+            start = max(0, pos - chunk)
+            f.seek(start)
+            data = f.read(pos - start)
+            nl = data.rfind(b"\n")
+            if nl != -1:
+                f.truncate(start + nl + 1)
+                return
+            pos = start
+        f.truncate(0)
+
+
+def iter_jsonl_records(path: str):
+    """读取 JSONL 结果文件，跳过空行与损坏行（例如崩溃时写了一半的最后一行）。"""
+    if not os.path.exists(path):
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                continue
+
+
+def load_completed_user_ids(path: str) -> set[str]:
+    """扫描已有输出，返回已完成对话的 user_id 集合（用于 --resume）。"""
+    return {rec.get("user_id") for rec in iter_jsonl_records(path) if rec.get("user_id")}
+
+
+def finalize_jsonl(path: str, output_path: str, user_order: list[str] | None = None) -> int:
+    """
+    将 JSONL 结果整理为 JSON 数组（下游沿用旧格式）。
+    - 同一 user_id 多次出现时保留最后一条；
+    - 按 user_order（原始 profile 顺序）排序，未出现在其中的排在最后。
+    返回写出的对话数。
+    """
+    by_user = {}
+    for rec in iter_jsonl_records(path):
+        by_user[rec.get("user_id")] = rec
+
+    rank = {uid: i for i, uid in enumerate(user_order or [])}
+    records = sorted(by_user.values(), key=lambda r: rank.get(r.get("user_id"), len(rank)))
+
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(records, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, output_path)
+    return len(records)
+
+
+def merge_jsonl_outputs(paths: list[str], output_path: str, user_order: list[str]) -> dict:
+    """
+    合并多个分片的 JSONL 输出，按原始 profile 顺序写出。
+    返回统计: merged / missing（profile 中有但没有结果）/ duplicated（同一 user_id 出现多次）/ unknown（不在 profile 中）。
+    """
+    by_user = {}
+    seen_in = {}
+    for path in paths:
+        for rec in iter_jsonl_records(path):
+            uid = rec.get("user_id")
+            if uid is None:
+                continue
+            seen_in.setdefault(uid, []).append(path)
+            # 重复时保留第一条（按 paths 中文件的先后）
+            by_user.setdefault(uid, rec)
+
+    order_set = set(user_order)
+    ordered = [by_user[uid] for uid in user_order if uid in by_user]
+    unknown = [uid for uid in by_user if uid not in order_set]
+    ordered.extend(by_user[uid] for uid in unknown)
+
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    tmp_path = output_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        if output_path.endswith(".jsonl"):
+            for rec in ordered:
+                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        else:
+            json.dump(ordered, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, output_path)
+
+    return {
+        "merged": len(ordered),
+        "missing": [uid for uid in user_order if uid not in by_user],
+        "duplicated": {uid: files for uid, files in seen_in.items() if len(files) > 1},
+        "unknown": unknown,
+    }
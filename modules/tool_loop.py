@@ -0,0 +1,201 @@
+import inspect
+import json
+from openai import OpenAI
+from openai.types.chat import ChatCompletion
+import config
+from modules.rate_limiter import get_limiter, estimate_tokens, call_with_rate_limit_retry
+from modules.llm_cache import get_llm_cache
+from modules.http_pool import get_shared_http_client
+from modules.batch_api import batch_mode_enabled, BatchModelClient
+from modules.tracing import record_llm_usage
+
+
+class StreamAbortedError(RuntimeError):
+    """流式生成中途未通过检查而被中止；text 为已生成的部分，issues 为检查发现的问题。"""
+
+    def __init__(self, text: str, issues: list[str]):
+        super().__init__(f"Stream aborted: {', '.join(issues)}")
+        self.text = text
+        self.issues = issues
+
+
+def native_tool_calling_enabled() -> bool:
+    """AGENT_EXECUTOR="native" 时 agent 使用 ToolCallingAgent，"autogen" 时使用 initiate_chat。"""
+    mode = getattr(config, "AGENT_EXECUTOR", "autogen")
+    if mode not in ("autogen", "native"):
+        raise ValueError(f"Unknown AGENT_EXECUTOR: {mode}")
+    return mode == "native"
+
+
+def function_tool_schema(fn, name: str, description: str) -> dict:
+    """由函数签名生成 tools 条目：参数均为字符串，没有默认值的为必填（与 autogen.register_function 的用法一致）。"""
+    params = inspect.signature(fn).parameters
+    return {
+        "type": "function",
+        "function": {
+            "name": name,
+            "description": description,
+            "parameters": {
+                "type": "object",
+                "properties": {p: {"type": "string", "description": p} for p in params},
+                "required": [p for p, v in params.items() if v.default is inspect.Parameter.empty],
+            },
+        },
+    }
+
+
+class ToolCallingAgent:
+    """
+    autogen initiate_chat 的轻量替代：直接用 chat/completions 的 function calling 完成一次回复。
+    请求带上工具，模型发起工具调用时在本地执行并追加结果；工具轮数达到 max_tool_rounds 后
+    以 tool_choice="none" 请求最终回复，不会再多一轮只为输出 TERMINATE。
+    通常只需两次请求（工具 + 回复），不调用工具时只需一次。
+    限流、响应缓存、批量模式与 trace 计数的处理方式与 AsyncChatClient 一致（同步版本，在 agent 线程中调用）。
+    """
+
+    def __init__(self, system_message: str, tools: list[tuple], temperature: float = 0.7, max_tool_rounds: int = 1):
+        """tools: [(工具名, 描述, 函数)]"""
+        self.model = config.MODEL_NAME
+        self.system_message = system_message
+        self.temperature = temperature
+        self.max_tool_rounds = max_tool_rounds
+        self.functions = {name: fn for name, _, fn in tools}
+        self.tools = [function_tool_schema(fn, name, description) for name, description, fn in tools]
+        self.limiter = get_limiter()
+        self.cache = get_llm_cache()
+        self._client = None
+        self._shared_pool = False
+
+    @property
+    def client(self) -> OpenAI:
+        if self._client is None:
+            http_client = get_shared_http_client()
+            self._shared_pool = http_client is not None
+            # 有共享限流器时关闭 SDK 自带的重试，429 交给 call_with_rate_limit_retry 统一退避
+            self._client = OpenAI(
+                api_key=config.API_KEY,
+                base_url=config.BASE_URL,
+                max_retries=0 if self.limiter is not None else 2,
+                timeout=config.LLM_CONFIG.get("timeout", 120),
+                http_client=http_client,
+            )
+        return self._client
+
+    def _request(self, params: dict) -> ChatCompletion:
+        estimated = estimate_tokens(params["messages"])
+        if self.limiter is not None:
+            self.limiter.acquire(estimated)
+        resp = self.client.chat.completions.create(**params)
+        if self.limiter is not None:
+            self.limiter.record_usage(estimated, getattr(resp.usage, "total_tokens", None))
+        return resp
+
+    def _complete(self, messages: list[dict], **kwargs) -> ChatCompletion:
+        cache_key = None
+        if self.cache.enabled and self.cache.should_cache(self.temperature):
+            cache_key = self.cache.make_key(self.model, messages, self.temperature, **kwargs)
+            cached = self.cache.get(cache_key)
+            if cached is not None:
+                record_llm_usage(cached=True)
+                return ChatCompletion.model_validate(cached)
+
+        params = {"model": self.model, "messages": messages, "temperature": self.temperature, **kwargs}
+        if batch_mode_enabled():
+            resp = BatchModelClient({"model": self.model}).create(params)
+            record_llm_usage(resp.usage)
+        else:
+            resp = call_with_rate_limit_retry(self._request, params)
+            usage = resp.usage
+            if self._shared_pool and usage is not None:
+                # 共享连接池已从响应体记下缓存命中的 token，这里只记调用次数与 token 总量
+                usage = {"prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens}
+            record_llm_usage(usage)
+        if cache_key is not None:
+            self.cache.put(cache_key, resp.model_dump(mode="json"))
+        return resp
+
+    def _stream(self, params: dict, check) -> tuple[str, object]:
+        """流式请求：每收到一段内容就检查已生成的全部文本，check 返回问题时立即关闭连接并抛出 StreamAbortedError。"""
+        estimated = estimate_tokens(params["messages"])
+        if self.limiter is not None:
+            self.limiter.acquire(estimated)
+        stream = self.client.chat.completions.create(**params, stream=True, stream_options={"include_usage": True})
+        text, usage = "", None
+        try:
+            for chunk in stream:
+                if chunk.usage is not None:
+                    usage = chunk.usage
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if not delta:
+                    continue
+                text += delta
+                issues = check(text)
+                if issues:
+                    # 中止的请求拿不到 usage：按输入估算加上已生成的部分修正限流器的预留，trace 只计调用次数
+                    if self.limiter is not None:
+                        prompt_estimate = estimated - getattr(config, "LLM_ESTIMATED_COMPLETION_TOKENS", 256)
+                        self.limiter.record_usage(estimated, prompt_estimate + len(text) // 4)
+                    record_llm_usage(None)
+                    raise StreamAbortedError(text.replace("TERMINATE", "").strip(), issues)
+        finally:
+            stream.close()
+        if self.limiter is not None:
+            self.limiter.record_usage(estimated, getattr(usage, "total_tokens", None))
+        # 流式响应不经过共享连接池的缓存命中统计，这里记完整 usage
+        record_llm_usage(usage)
+        return text, usage
+
+    def _stream_reply(self, messages: list[dict], check, **kwargs) -> str:
+        params = {"model": self.model, "messages": messages, "temperature": self.temperature, **kwargs}
+        if batch_mode_enabled() or (self.cache.enabled and self.cache.should_cache(self.temperature)):
+            # 批量接口与响应缓存都需要完整响应：生成完再检查，效果与非流式审查相同
+            content = self._complete(messages, **kwargs).choices[0].message.content or ""
+            issues = check(content)
+            if issues:
+                raise StreamAbortedError(content.replace("TERMINATE", "").strip(), issues)
+        else:
+            content, _ = call_with_rate_limit_retry(self._stream, params, check)
+        return content.replace("TERMINATE", "").strip()
+
+    def _call_tool(self, tool_call) -> str:
+        fn = self.functions.get(tool_call.function.name)
+        if fn is None:
+            return f"Error: Function {tool_call.function.name} not found."
+        try:
+            args = json.loads(tool_call.function.arguments or "{}")
+        except json.JSONDecodeError as e:
+            return f"Error: Invalid arguments for {tool_call.function.name}: {e}"
+        accepted = inspect.signature(fn).parameters
+        try:
+            return str(fn(**{k: str(v) for k, v in args.items() if k in accepted}))
+        except Exception as e:
+            # 与 autogen 一致：工具异常作为结果返回给模型，而不是中断整次回复
+            return f"Error: {e}"
+
+    def reply(self, prompt: str, stream_check=None) -> str:
+        """
+        stream_check(已生成文本) -> 问题列表：提供时最终回复以流式生成，
+        一旦返回非空列表立即中止并抛出 StreamAbortedError，由调用方直接重新生成。
+        """
+        messages = [
+            {"role": "system", "content": self.system_message},
+            {"role": "user", "content": prompt},
+        ]
+        for tool_round in range(self.max_tool_rounds + 1):
+            final = tool_round == self.max_tool_rounds
+            # 没有工具时（如 MEMORY_PREFETCH）不带 tools 参数，一次请求直接得到回复
+            tool_kwargs = {"tools": self.tools, "tool_choice": "none" if final else "auto"} if self.tools else {}
+            if stream_check is not None and (final or not self.tools):
+                # 只对确定输出文本的请求流式生成（工具调用的增量需要拼接，不值得）
+                return self._stream_reply(messages, stream_check, **tool_kwargs)
+            resp = self._complete(messages, **tool_kwargs)
+            message = resp.choices[0].message
+            if final or not self.tools or not message.tool_calls:
+                return (message.content or "").replace("TERMINATE", "").strip()
+            messages.append({
+                "role": "assistant",
+                "content": message.content,
+                "tool_calls": [tc.model_dump(mode="json") for tc in message.tool_calls],
+            })
+            for tool_call in message.tool_calls:
+                messages.append({"role": "tool", "tool_call_id": tool_call.id, "content": self._call_tool(tool_call)})
@@ -6,6 +6,8 @@ from sentence_transformers import SentenceTransformer
 import config
 
 _SHARED_MODEL = None
+_SHARED_MOVIE_INDEX = None
+_SHARED_MEMORY_INDEX = None
 
 def get_shared_model():
     global _SHARED_MODEL
@@ -15,17 +17,87 @@ def get_shared_model():
     return _SHARED_MODEL
 
 
+def get_shared_movie_index():
+    """
+    电影 FAISS 索引与元数据，每个进程只加载一次，所有 MovieRetriever 只读共享。
+    返回: (index, metadata)
+    """
+    global _SHARED_MOVIE_INDEX
+    if _SHARED_MOVIE_INDEX is None:
+        print(f"Loading FAISS Index: {config.FAISS_INDEX_PATH}...")
+        index = faiss.read_index(config.FAISS_INDEX_PATH)
+
+        print(f"Loading Metadata: {config.FAISS_META_PATH}...")
+        with open(config.FAISS_META_PATH, 'rb') as f:
+            metadata = pickle.load(f)
+        _SHARED_MOVIE_INDEX = (index, metadata)
+    return _SHARED_MOVIE_INDEX
+
+
+def get_shared_memory_index():
+    """
+    用户记忆 FAISS 索引、元数据以及 user_id -> 条目下标映射，每个进程只加载一次。
+    加载失败时返回 (None, None, {})，同样只尝试一次。
+    """
+    global _SHARED_MEMORY_INDEX
+    if _SHARED_MEMORY_INDEX is not None:
+        return _SHARED_MEMORY_INDEX
+
+    idx_path = config.MEMORY_FAISS_INDEX_PATH
+    meta_path = config.MEMORY_FAISS_META_PATH
+    _SHARED_MEMORY_INDEX = (None, None, {})
+    if not (os.path.exists(idx_path) and os.path.exists(meta_path)):
+        print(f"[MemoryRetriever] Memory index or meta not found: {idx_path}, {meta_path}")
+        return _SHARED_MEMORY_INDEX
+    try:
+        print(f"Loading FAISS Index: {idx_path}...")
+        index = faiss.read_index(idx_path)
+        with open(meta_path, "rb") as f:
+            print(f"Loading Metadata: {meta_path}...")
+            metadata = pickle.load(f)
+        # 为快速按 user 过滤，建立 user_id -> index 列表
+        mapping = {}
+        for i, meta in enumerate(metadata):
+            uid = meta.get("user_id")
+            if not uid:
+                continue
+            mapping.setdefault(uid, []).append(i)
+        _SHARED_MEMORY_INDEX = (index, metadata, mapping)
+        print(f"[MemoryRetriever] Loaded memory index with {index.ntotal} entries.")
+    except Exception as e:
+        print(f"[MemoryRetriever] Failed to load memory index: {e}")
+    return _SHARED_MEMORY_INDEX
+
+
+def preload_shared_resources():
+    """
+    预加载 Embedding 模型与两个 FAISS 索引。
+    - 在父进程调用：fork 出的 worker 通过 copy-on-write 共享同一份内存。
+    - 作为 ProcessPoolExecutor 的 initializer：每个 worker 只加载一次。
+    """
+    get_shared_model()
+    get_shared_movie_index()
+    get_shared_memory_index()
+
+
+def get_rss_mb() -> float:
+    """当前进程常驻内存 (MB)，优先读 /proc，其他平台退化为峰值 RSS。"""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
 # --- System 端工具: 电影检索 ---
 class MovieRetriever:
     def __init__(self):
         self.model = get_shared_model()
-        
-        print(f"Loading FAISS Index: {config.FAISS_INDEX_PATH}...")
-        self.index = faiss.read_index(config.FAISS_INDEX_PATH)
-        
-        print(f"Loading Metadata: {config.FAISS_META_PATH}...")
-        with open(config.FAISS_META_PATH, 'rb') as f:
-            self.metadata = pickle.load(f)
+        self.index, self.metadata = get_shared_movie_index()
 
     def search(self, keywords: str, exclude_titles: str = "") -> str:
         """
@@ -91,31 +163,8 @@ class MemoryRetriever:
         self._load_index()
 
     def _load_index(self):
-        idx_path = config.MEMORY_FAISS_INDEX_PATH
-        meta_path = config.MEMORY_FAISS_META_PATH
-        if not (os.path.exists(idx_path) and os.path.exists(meta_path)):
-            print(f"[MemoryRetriever] Memory index or meta not found: {idx_path}, {meta_path}")
-            return
-        try:
-            print(f"Loading FAISS Index: {idx_path}...")
-            self.index = faiss.read_index(idx_path)
-            with open(meta_path, "rb") as f:
-                print(f"Loading Metadata: {meta_path}...")
-                self.metadata = pickle.load(f)
-            # 为快速按 user 过滤，建立 user_id -> index 列表
-            mapping = {}
-            for i, meta in enumerate(self.metadata):
-                uid = meta.get("user_id")
-                if not uid:
-                    continue
-                mapping.setdefault(uid, []).append(i)
-            self.user_index_map = mapping
-            print(f"[MemoryRetriever] Loaded memory index with {self.index.ntotal} entries.")
-        except Exception as e:
-            print(f"[MemoryRetriever] Failed to load memory index: {e}")
-            self.index = None
-            self.metadata = None
-            self.user_index_map = {}
+        # 索引与元数据在进程内共享，只读使用
+        self.index, self.metadata, self.user_index_map = get_shared_memory_index()
 
     def _search_in_users(self, query_vec: np.ndarray, users: set[str]):
         if not self.index or not self.metadata or not users:
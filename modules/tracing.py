@@ -0,0 +1,295 @@
+import contextvars
+import json
+import os
+import time
+from contextlib import contextmanager
+
+# 当前 tracer / span 通过 contextvars 传递：asyncio task 与 asyncio.to_thread 都会复制上下文，
+# 因此并发的评审协程、线程里跑的 autogen agent 与工具函数都能记到正确的 span 上
+_CURRENT_TRACER = contextvars.ContextVar("current_tracer", default=None)
+_CURRENT_SPAN = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    __slots__ = ("span_id", "parent_id", "name", "start", "end", "attrs",
+                 "prompt_tokens", "completion_tokens", "cached_prompt_tokens", "llm_calls", "cached_calls")
+
+    def __init__(self, span_id: int, parent_id: int | None, name: str, attrs: dict):
+        self.span_id = span_id
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.time()
+        self.end = None
+        self.attrs = attrs
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_prompt_tokens = 0
+        self.llm_calls = 0
+        self.cached_calls = 0
+
+    def to_record(self, trace_id: str) -> dict:
+        end = self.end if self.end is not None else time.time()
+        return {
+            "trace_id": trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start,
+            "duration_ms": (end - self.start) * 1000,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_prompt_tokens": self.cached_prompt_tokens,
+            "llm_calls": self.llm_calls,
+            "cached_calls": self.cached_calls,
+            "attrs": self.attrs,
+        }
+
+
+class Tracer:
+    """单个对话的 span 记录器，每个轮次阶段一个 span。"""
+
+    def __init__(self, trace_id: str, enabled: bool = True):
+        self.trace_id = trace_id
+        self.enabled = enabled
+        self.spans: list[Span] = []
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        if not self.enabled:
+            yield None
+            return
+        parent = _CURRENT_SPAN.get()
+        span = Span(len(self.spans), parent.span_id if parent else None, name, attrs)
+        self.spans.append(span)
+        tracer_token = _CURRENT_TRACER.set(self)
+        span_token = _CURRENT_SPAN.set(span)
+        try:
+            yield span
+        finally:
+            span.end = time.time()
+            _CURRENT_SPAN.reset(span_token)
+            _CURRENT_TRACER.reset(tracer_token)
+
+    def records(self) -> list[dict]:
+        return [s.to_record(self.trace_id) for s in self.spans]
+
+
+@contextmanager
+def trace_span(name: str, **attrs):
+    """在当前对话的 tracer 下开一个 span（没有 tracer 时不记录），供 agent / 工具函数使用。"""
+    tracer = _CURRENT_TRACER.get()
+    if tracer is None:
+        yield None
+        return
+    with tracer.span(name, **attrs) as span:
+        yield span
+
+
+def annotate_span(**attrs):
+    """给当前 span 追加属性（没有 tracer 时忽略）。"""
+    span = _CURRENT_SPAN.get()
+    if span is not None:
+        span.attrs.update(attrs)
+
+
+def cached_prompt_tokens(usage) -> int:
+    """
+    provider 端上下文缓存命中的 prompt token 数:
+    OpenAI 为 prompt_tokens_details.cached_tokens，DeepSeek 为 prompt_cache_hit_tokens。
+    """
+    if usage is None:
+        return 0
+    get = usage.get if isinstance(usage, dict) else lambda k, d=None: getattr(usage, k, d)
+    hit = get("prompt_cache_hit_tokens", None)
+    if hit is not None:
+        return hit or 0
+    details = get("prompt_tokens_details", None)
+    if details is None:
+        return 0
+    if isinstance(details, dict):
+        return details.get("cached_tokens", 0) or 0
+    return getattr(details, "cached_tokens", 0) or 0
+
+
+def record_cached_prompt_tokens(usage):
+    """只记录缓存命中的 prompt token（autogen 的用量由 record_autogen_usage 汇总，但不含缓存明细）。"""
+    span = _CURRENT_SPAN.get()
+    if span is not None:
+        span.cached_prompt_tokens += cached_prompt_tokens(usage)
+
+
+def record_llm_usage(usage=None, cached: bool = False):
+    """把一次 LLM 调用的 token 用量记到当前 span 上（usage 可以是 SDK 对象或 dict）。"""
+    span = _CURRENT_SPAN.get()
+    if span is None:
+        return
+    span.llm_calls += 1
+    if cached:
+        span.cached_calls += 1
+        return
+    if usage is None:
+        return
+    get = usage.get if isinstance(usage, dict) else lambda k, d=None: getattr(usage, k, d)
+    span.prompt_tokens += get("prompt_tokens", 0) or 0
+    span.completion_tokens += get("completion_tokens", 0) or 0
+    span.cached_prompt_tokens += cached_prompt_tokens(usage)
+
+
+def clear_autogen_usage(agent):
+    """
+    initiate_chat 前清空 agent client 的用量汇总。ChatResult.cost 取自 client 创建（或上次清空）以来的累计值，
+    clear_history() 不会清空它，不清的话每次回复都会把之前的用量重复记一遍。
+    """
+    client = getattr(agent, "client", None)
+    if client is not None:
+        client.clear_usage_summary()
+
+
+def record_autogen_usage(chat_result):
+    """
+    autogen initiate_chat 结束后，把 ChatResult.cost 中的 token 用量记到当前 span。
+    （调用次数由 count_autogen_reply 逐次累计；调用前须先 clear_autogen_usage）
+    """
+    span = _CURRENT_SPAN.get()
+    cost = getattr(chat_result, "cost", None)
+    if span is None or not isinstance(cost, dict):
+        return
+    usage = cost.get("usage_excluding_cached_inference") or {}
+    for model_usage in usage.values():
+        if isinstance(model_usage, dict):
+            span.prompt_tokens += model_usage.get("prompt_tokens", 0) or 0
+            span.completion_tokens += model_usage.get("completion_tokens", 0) or 0
+
+
+def count_autogen_reply(recipient, messages=None, sender=None, config=None):
+    """注册在 autogen AssistantAgent 前部的 reply 函数：每次 LLM 生成计一次调用，然后交给后续 reply。"""
+    span = _CURRENT_SPAN.get()
+    if span is not None:
+        span.llm_calls += 1
+    return False, None
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    k = (len(ordered) - 1) * q
+    lo = int(k)
+    hi = min(lo + 1, len(ordered) - 1)
+    return ordered[lo] + (ordered[hi] - ordered[lo]) * (k - lo)
+
+
+class TraceCollector:
+    """
+    主进程汇总各对话的 span：逐条追加到 JSONL，结束时导出 Chrome trace 并打印 p50/p95 分阶段统计。
+    """
+
+    def __init__(self, jsonl_path: str):
+        self.jsonl_path = jsonl_path
+        os.makedirs(os.path.dirname(jsonl_path) or ".", exist_ok=True)
+        self._file = open(jsonl_path, "a", encoding="utf-8")
+        self._stats = {}
+        self.http_requests = 0
+        self.http_new_connections = 0
+        self.prompt_tokens = 0
+        self.cached_prompt_tokens = 0
+        self.history_baseline_tokens = 0
+        self.history_sent_tokens = 0
+        self.stream_aborts = 0
+
+    def add(self, records: list[dict]):
+        for rec in records:
+            if rec["name"] == "dialogue":
+                self.http_requests += rec["attrs"].get("http_requests", 0)
+                self.http_new_connections += rec["attrs"].get("http_new_connections", 0)
+                self.history_baseline_tokens += rec["attrs"].get("history_baseline_tokens", 0)
+                self.history_sent_tokens += rec["attrs"].get("history_sent_tokens", 0)
+            self._file.write(json.dumps(rec, ensure_ascii=False) + "\n")
+            self.prompt_tokens += rec["prompt_tokens"]
+            self.stream_aborts += bool(rec["attrs"].get("stream_aborted"))
+            self.cached_prompt_tokens += rec.get("cached_prompt_tokens", 0)
+            stat = self._stats.setdefault(rec["name"], {
+                "durations": [], "prompt_tokens": 0, "completion_tokens": 0, "cached_prompt_tokens": 0,
+                "llm_calls": 0, "cached_calls": 0, "retries": 0,
+            })
+            stat["durations"].append(rec["duration_ms"])
+            stat["prompt_tokens"] += rec["prompt_tokens"]
+            stat["completion_tokens"] += rec["completion_tokens"]
+            stat["cached_prompt_tokens"] += rec.get("cached_prompt_tokens", 0)
+            stat["llm_calls"] += rec["llm_calls"]
+            stat["cached_calls"] += rec["cached_calls"]
+            stat["retries"] += rec["attrs"].get("retries", 0)
+        self._file.flush()
+
+    def close(self):
+        if not self._file.closed:
+            self._file.close()
+
+    def export_chrome_trace(self, output_path: str):
+        """转换为 chrome://tracing / Perfetto 可读的格式，每个对话一条泳道。"""
+        export_chrome_trace(self.jsonl_path, output_path)
+
+    def summary(self) -> str:
+        header = f"{'phase':<28}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'total s':>10}{'calls':>7}{'cached':>7}{'retries':>8}{'prompt tok':>12}{'hit tok':>10}{'compl tok':>11}"
+        lines = [header, "-" * len(header)]
+        for name in sorted(self._stats):
+            stat = self._stats[name]
+            durations = stat["durations"]
+            lines.append(
+                f"{name:<28}{len(durations):>7}"
+                f"{_percentile(durations, 0.5):>10.0f}{_percentile(durations, 0.95):>10.0f}"
+                f"{sum(durations) / 1000:>10.1f}{stat['llm_calls']:>7}{stat['cached_calls']:>7}{stat['retries']:>8}"
+                f"{stat['prompt_tokens']:>12}{stat['cached_prompt_tokens']:>10}{stat['completion_tokens']:>11}"
+            )
+        if self.prompt_tokens:
+            lines.append(
+                f"Prompt cache hits: {self.cached_prompt_tokens}/{self.prompt_tokens} prompt tokens "
+                f"({self.cached_prompt_tokens / self.prompt_tokens:.1%}) served from the provider's context cache"
+            )
+        if self.history_baseline_tokens:
+            saved = self.history_baseline_tokens - self.history_sent_tokens
+            lines.append(
+                f"History budget: {self.history_sent_tokens} history tokens sent vs {self.history_baseline_tokens} "
+                f"with the fixed windows (saved {saved}, {saved / self.history_baseline_tokens:.1%})"
+            )
+        if self.stream_aborts:
+            lines.append(f"Streams aborted early on format violations: {self.stream_aborts}")
+        if self.http_requests:
+            reuse = 1 - self.http_new_connections / self.http_requests
+            lines.append(
+                f"HTTP connection reuse: {reuse:.1%} "
+                f"({self.http_requests} requests, {self.http_new_connections} new connections)"
+            )
+        return "\n".join(lines)
+
+
+def export_chrome_trace(jsonl_path: str, output_path: str):
+    lanes = {}
+    events = []
+    with open(jsonl_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            rec = json.loads(line)
+            tid = lanes.setdefault(rec["trace_id"], len(lanes) + 1)
+            events.append({
+                "name": rec["name"],
+                "cat": "dialogue",
+                "ph": "X",
+                "ts": rec["start"] * 1e6,
+                "dur": rec["duration_ms"] * 1e3,
+                "pid": 1,
+                "tid": tid,
+                "args": {
+                    "prompt_tokens": rec["prompt_tokens"],
+                    "completion_tokens": rec["completion_tokens"],
+                    "cached_prompt_tokens": rec.get("cached_prompt_tokens", 0),
+                    "llm_calls": rec["llm_calls"],
+                    "cached_calls": rec["cached_calls"],
+                    **rec["attrs"],
+                },
+            })
+    for trace_id, tid in lanes.items():
+        events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": tid, "args": {"name": str(trace_id)}})
+    with open(output_path, "w", encoding="utf-8") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
@@ -1,11 +1,15 @@
 import json
 import os
+import sys
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from typing import List, Optional, Dict
 from pydantic import BaseModel, Field
 from openai import OpenAI
 from tqdm import tqdm
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from modules.llm_cache import get_llm_cache, CacheMissError
+
 
 class KeyMemoryItem(BaseModel):
     movie_title: str
@@ -143,18 +147,38 @@ class MemoryProfileChain:
         schema = json.dumps(pydantic_model.model_json_schema(), indent=2)
         full_system_prompt = f"{system_prompt}\n\nIMPORTANT: Output valid JSON only following this schema:\n{schema}"
 
+        messages = [
+            {"role": "system", "content": full_system_prompt},
+            {"role": "user", "content": user_content}
+        ]
+        response_format = {"type": "json_object"}
+        # 保持原有的 temperature 0.1（readwrite 模式只缓存 temperature 0 的调用，这里由 record / replay 覆盖）
+        temperature = 0.1
+
         try:
-            response = self.client.chat.completions.create(
-                model=self.model_name,
-                messages=[
-                    {"role": "system", "content": full_system_prompt},
-                    {"role": "user", "content": user_content}
-                ],
-                response_format={"type": "json_object"},
-                temperature=0.1
-            )
-            content = response.choices[0].message.content
+            cache = get_llm_cache()
+            cache_key = None
+            cached = None
+            if cache.enabled and cache.should_cache(temperature):
+                cache_key = cache.make_key(self.model_name, messages, temperature, response_format)
+                cached = cache.get(cache_key)
+
+            if cached is not None:
+                content = cached["choices"][0]["message"]["content"]
+            else:
+                response = self.client.chat.completions.create(
+                    model=self.model_name,
+                    messages=messages,
+                    response_format=response_format,
+                    temperature=temperature
+                )
+                content = response.choices[0].message.content
+                if cache_key is not None:
+                    cache.put(cache_key, response.model_dump(mode="json"))
             return pydantic_model.model_validate(json.loads(content))
+        except CacheMissError:
+            # 严格回放模式下缺失的录制必须暴露出来，不能当作普通失败吞掉
+            raise
         except Exception as e:
             print(f"LLM Call Failed: {e}")
             return None
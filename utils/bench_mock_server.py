@@ -0,0 +1,303 @@
+"""
+本地 OpenAI 兼容的模拟服务，用于离线压测对话流水线（不消耗 API 额度）。
+
+- POST .../chat/completions：按请求内容返回评审 PASS/FAIL、融合审查 JSON、意图 ACCEPT/REJECT/INQUIRY、工具调用或普通回复；
+  stream=true 时以 SSE 分段返回，延迟分摊到各段
+- GET  /stats：各类请求的计数；POST /reset：清零
+
+单独启动:
+    python utils/bench_mock_server.py --port 8765 --latency lognormal:-0.7,0.4 --fail-rate 0.2
+然后令 CFG_BASE_URL=http://127.0.0.1:8765/v1 运行 main.py。
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class LatencyModel:
+    """
+    延迟分布（秒）:
+    - fixed:0.5
+    - uniform:0.2,1.0
+    - lognormal:mu,sigma   (random.lognormvariate)
+    """
+
+    def __init__(self, spec: str = "fixed:0"):
+        kind, _, params = spec.partition(":")
+        self.kind = kind
+        self.params = [float(p) for p in params.split(",") if p.strip()]
+        if kind not in ("fixed", "uniform", "lognormal"):
+            raise ValueError(f"Unknown latency distribution: {spec}")
+
+    def sample(self) -> float:
+        if self.kind == "fixed":
+            return self.params[0] if self.params else 0.0
+        if self.kind == "uniform":
+            return random.uniform(self.params[0], self.params[1])
+        return random.lognormvariate(self.params[0], self.params[1])
+
+
+class MockBehavior:
+    def __init__(
+        self,
+        latency: LatencyModel,
+        fail_rate: float = 0.1,
+        intent_mix: dict | None = None,
+        tool_call_rate: float = 1.0,
+        format_violation_rate: float = 0.0,
+        seed: int | None = None,
+    ):
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.intent_mix = intent_mix or {"ACCEPT": 0.3, "REJECT": 0.4, "INQUIRY": 0.3}
+        self.tool_call_rate = tool_call_rate
+        self.format_violation_rate = format_violation_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {}
+
+    def count(self, kind: str):
+        with self.lock:
+            self.stats[kind] = self.stats.get(kind, 0) + 1
+            self.stats["total"] = self.stats.get("total", 0) + 1
+
+    def reset(self):
+        with self.lock:
+            self.stats = {}
+
+    def _pick_intent(self) -> str:
+        r = self.rng.random() * sum(self.intent_mix.values())
+        for label, weight in self.intent_mix.items():
+            r -= weight
+            if r <= 0:
+                return label
+        return "INQUIRY"
+
+    def respond(self, body: dict) -> tuple[str, dict]:
+        """返回 (请求类别, message dict)。"""
+        messages = body.get("messages", [])
+        tools = body.get("tools") or []
+        text = "\n".join(m.get("content") or "" for m in messages if isinstance(m.get("content"), str))
+        last = messages[-1] if messages else {}
+        has_tool_result = any(m.get("role") in ("tool", "function") for m in messages)
+
+        tool_choice_allowed = body.get("tool_choice") != "none"
+        if tools and tool_choice_allowed and not has_tool_result and self.rng.random() < self.tool_call_rate:
+            fn = tools[0].get("function", {})
+            params = fn.get("parameters", {}).get("properties", {})
+            args = {name: "mock query" for name in params if name in fn.get("parameters", {}).get("required", params)}
+            return "tool_call", {
+                "role": "assistant",
+                "content": None,
+                "tool_calls": [{
+                    "id": f"call_{uuid.uuid4().hex[:12]}",
+                    "type": "function",
+                    "function": {"name": fn.get("name", "tool"), "arguments": json.dumps(args)},
+                }],
+            }
+        if "profile_ok" in text:
+            # 融合审查（FUSED_USER_REVIEW）：JSON 结构化结果
+            failed = self.rng.random() < self.fail_rate
+            verdict = {
+                "profile_ok": not failed,
+                "profile_reason": "mock reviewer rejected this response" if failed else "",
+                "coherence_ok": True,
+                "coherence_reason": "",
+                "intent": self._pick_intent(),
+            }
+            return "review_fused", {"role": "assistant", "content": json.dumps(verdict)}
+        if "Output ONLY the category word" in text:
+            return "intent", {"role": "assistant", "content": self._pick_intent()}
+        if "output: PASS" in text:
+            if self.rng.random() < self.fail_rate:
+                return "review_fail", {"role": "assistant", "content": "FAIL|mock reviewer rejected this response"}
+            return "review_pass", {"role": "assistant", "content": "PASS"}
+        if "Movie Buff Friend" in text:
+            if self.rng.random() < self.format_violation_rate:
+                # 违反格式规则的推荐（编号列表 + 多部电影），用于测试流式提前中止
+                return "system_reply_bad_format", {
+                    "role": "assistant",
+                    "content": (
+                        "Here are a few picks you might enjoy tonight:\n"
+                        '1. **"Mock Movie"** - slow-burn tension with great practical effects.\n'
+                        '2. **"Other Mock Movie"** - a tense thriller with a twist ending.\n'
+                        '3. **"Third Mock Movie"** - moody, atmospheric and patient. TERMINATE'
+                    ),
+                }
+            return "system_reply", {
+                "role": "assistant",
+                "content": '**"Mock Movie"** has the slow-burn tension you are after. Want to give it a shot? TERMINATE',
+            }
+        if "movie enthusiast" in text:
+            reply = self.rng.choice([
+                "Hmm, not really my thing. Anything darker?",
+                "That sounds great, I'll watch it!",
+                "What's it about, exactly?",
+            ])
+            return "user_reply", {"role": "assistant", "content": f"{reply} TERMINATE"}
+        if last.get("role") == "tool":
+            return "tool_followup", {"role": "assistant", "content": "Mock reply based on the tool result. TERMINATE"}
+        return "other", {"role": "assistant", "content": "Mock response."}
+
+
+def make_handler(behavior: MockBehavior):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status: int, payload: dict):
+            raw = json.dumps(payload).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(raw)))
+            self.end_headers()
+            self.wfile.write(raw)
+
+        def do_GET(self):
+            if self.path.rstrip("/").endswith("/stats"):
+                with behavior.lock:
+                    self._send_json(200, dict(behavior.stats))
+            else:
+                self._send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            if self.path.rstrip("/").endswith("/reset"):
+                behavior.reset()
+                self._send_json(200, {"ok": True})
+                return
+            if not self.path.rstrip("/").endswith("/chat/completions"):
+                self._send_json(404, {"error": "not found"})
+                return
+
+            kind, message = behavior.respond(body)
+            behavior.count(kind)
+            latency = behavior.latency.sample()
+            if body.get("stream"):
+                self._send_stream(body, message, latency)
+                return
+            time.sleep(latency)
+
+            prompt_chars = sum(len(m.get("content") or "") for m in body.get("messages", []) if isinstance(m.get("content"), str))
+            completion_chars = len(message.get("content") or "")
+            prompt_tokens = prompt_chars // 4
+            completion_tokens = max(1, completion_chars // 4)
+            self._send_json(200, {
+                "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": body.get("model", "mock"),
+                "choices": [{
+                    "index": 0,
+                    "message": message,
+                    "finish_reason": "tool_calls" if message.get("tool_calls") else "stop",
+                }],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                },
+            })
+
+        def _send_stream(self, body: dict, message: dict, latency: float, piece_chars: int = 16):
+            """SSE 分段返回（chunked 编码）：首段前等待 30% 的延迟，其余平均分摊到各段；客户端中途断开时直接结束。"""
+            content = message.get("content") or ""
+            pieces = [content[i:i + piece_chars] for i in range(0, len(content), piece_chars)] or [""]
+            base = {
+                "id": f"chatcmpl-{uuid.uuid4().hex[:12]}",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": body.get("model", "mock"),
+            }
+            prompt_chars = sum(len(m.get("content") or "") for m in body.get("messages", []) if isinstance(m.get("content"), str))
+            prompt_tokens, completion_tokens = prompt_chars // 4, max(1, len(content) // 4)
+
+            def write_event(payload):
+                data = f"data: {payload if isinstance(payload, str) else json.dumps(payload)}\n\n".encode("utf-8")
+                self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+                self.wfile.flush()
+
+            try:
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                time.sleep(latency * 0.3)
+                for i, piece in enumerate(pieces):
+                    delta = {"role": "assistant", "content": piece} if i == 0 else {"content": piece}
+                    write_event({**base, "choices": [{"index": 0, "delta": delta, "finish_reason": None}]})
+                    time.sleep(latency * 0.7 / len(pieces))
+                write_event({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+                if (body.get("stream_options") or {}).get("include_usage"):
+                    write_event({**base, "choices": [], "usage": {
+                        "prompt_tokens": prompt_tokens,
+                        "completion_tokens": completion_tokens,
+                        "total_tokens": prompt_tokens + completion_tokens,
+                    }})
+                write_event("[DONE]")
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True
+
+    return Handler
+
+
+def start_mock_server(behavior: MockBehavior, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """在后台线程启动服务，返回 server（server.server_address 给出实际端口）。"""
+    server = ThreadingHTTPServer((host, port), make_handler(behavior))
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+
+def parse_intent_mix(spec: str) -> dict:
+    """解析 ACCEPT=0.3,REJECT=0.4,INQUIRY=0.3 形式的意图分布。"""
+    mix = {}
+    for part in spec.split(","):
+        label, _, weight = part.partition("=")
+        mix[label.strip().upper()] = float(weight)
+    return mix
+
+
+def add_behavior_args(parser: argparse.ArgumentParser):
+    parser.add_argument("--latency", default="fixed:0.2", help="fixed:S | uniform:A,B | lognormal:MU,SIGMA (seconds)")
+    parser.add_argument("--fail-rate", type=float, default=0.1, help="Share of reviewer calls answered FAIL.")
+    parser.add_argument("--intent-mix", default="ACCEPT=0.3,REJECT=0.4,INQUIRY=0.3")
+    parser.add_argument("--tool-call-rate", type=float, default=1.0, help="Share of tool-enabled calls answered with a tool call.")
+    parser.add_argument("--format-violation-rate", type=float, default=0.0, help="Share of system replies that break the format rules.")
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def behavior_from_args(args) -> MockBehavior:
+    return MockBehavior(
+        latency=LatencyModel(args.latency),
+        fail_rate=args.fail_rate,
+        intent_mix=parse_intent_mix(args.intent_mix),
+        tool_call_rate=args.tool_call_rate,
+        format_violation_rate=args.format_violation_rate,
+        seed=args.seed,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="OpenAI-compatible mock server for offline benchmarks.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_behavior_args(parser)
+    args = parser.parse_args()
+
+    server = start_mock_server(behavior_from_args(args), args.host, args.port)
+    print(f"Mock OpenAI server listening on http://{args.host}:{server.server_address[1]}/v1")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,309 @@
+"""
+离线吞吐基准：启动本地 OpenAI 兼容模拟服务，用合成 profile 在多个并发度下运行 main.py，
+报告 dialogues/sec、每个对话的 LLM 调用数与端到端延迟、每次 agent 回复的调用数与延迟（来自 trace），
+以及每个 worker 的 CPU / RSS。
+
+用法（在仓库根目录执行）:
+    python utils/bench_throughput.py --profiles 64 --workers 1,4,8,16 --latency lognormal:-0.7,0.4
+    python utils/bench_throughput.py --async-mode --workers 16,64,256
+    # 对比不同配置，例如:
+    python utils/bench_throughput.py --workers 8 --variant base: --variant cached:LLM_CACHE_MODE=readwrite
+    # 多次调用审查 vs 融合结构化审查:
+    python utils/bench_throughput.py --workers 8 --variant multi: --variant fused:FUSED_USER_REVIEW=true
+    # autogen initiate_chat vs 原生 function calling:
+    python utils/bench_throughput.py --workers 8 --variant autogen:AGENT_EXECUTOR=autogen --variant native:AGENT_EXECUTOR=native
+    # 模型调用 lookup_memory vs 本地预取记忆:
+    python utils/bench_throughput.py --workers 8 --variant tool: --variant prefetch:MEMORY_PREFETCH=true
+    # 模型调用 search_movie_database vs 本地投机检索:
+    python utils/bench_throughput.py --workers 8 --variant tool: --variant speculative:SPECULATIVE_MOVIE_SEARCH=true
+    # 完整生成后审查 vs 流式生成、格式违规即中止（需要 native 执行方式）:
+    python utils/bench_throughput.py --workers 8 --format-violation-rate 0.3 \
+        --variant full:AGENT_EXECUTOR=native --variant stream:AGENT_EXECUTOR=native;STREAM_FORMAT_ABORT=true
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from bench_mock_server import add_behavior_args, behavior_from_args, start_mock_server
+
+CLK_TCK = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def make_synthetic_profiles(n: int) -> list[dict]:
+    personas = ["Critical Historian", "Popcorn Fan", "Arthouse Devotee", "Horror Completionist"]
+    tones = ["sarcastic", "warm", "blunt", "enthusiastic"]
+    profiles = []
+    for i in range(n):
+        profiles.append({
+            "user_id": f"bench_user_{i:05d}",
+            "meta_stats": {"total_reviews": 10, "sampled": 5, "time_span": "2010 to 2020"},
+            "key_memories": [
+                {"movie_title": "Mock Classic", "rating": 5.0, "memory_text": "Loved the slow-burn tension."},
+            ],
+            "reflections": {
+                "aesthetic_preferences": ["slow-burn thrillers", "practical effects", "hates musicals"],
+                "spectator_persona": personas[i % len(personas)],
+                "decision_logic": "Picks films by director reputation.",
+                "taste_evolution": "Shifted from action to drama.",
+                "contradictions": None,
+            },
+            "dialogue_style": {
+                "tone": tones[i % len(tones)],
+                "verbosity": "short",
+                "common_keywords": ["tension", "pacing"],
+                "review_structure": "one-liner",
+            },
+            "related_users": [],
+        })
+    return profiles
+
+
+def _read_proc_stat(pid: int):
+    """返回 (ppid, cpu_seconds)，进程已退出时返回 None。"""
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            raw = f.read()
+    except OSError:
+        return None
+    # comm 字段可能包含空格，从最后一个 ')' 之后解析
+    fields = raw[raw.rfind(")") + 2:].split()
+    ppid = int(fields[1])
+    cpu = (int(fields[11]) + int(fields[12])) / CLK_TCK
+    return ppid, cpu
+
+
+def _read_rss_mb(pid: int) -> float:
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+class ProcessTreeMonitor:
+    """轮询 /proc，记录某进程所有子孙进程的峰值 RSS 与最后一次观测到的 CPU 时间（仅 Linux）。"""
+
+    def __init__(self, root_pid: int):
+        self.root_pid = root_pid
+        self.peak_rss = {}
+        self.cpu = {}
+
+    def poll(self):
+        if not os.path.isdir("/proc"):
+            return
+        parents = {}
+        for name in os.listdir("/proc"):
+            if not name.isdigit():
+                continue
+            info = _read_proc_stat(int(name))
+            if info:
+                parents[int(name)] = info
+        tree = {self.root_pid}
+        changed = True
+        while changed:
+            changed = False
+            for pid, (ppid, _) in parents.items():
+                if ppid in tree and pid not in tree:
+                    tree.add(pid)
+                    changed = True
+        for pid in tree:
+            if pid not in parents:
+                continue
+            self.cpu[pid] = parents[pid][1]
+            self.peak_rss[pid] = max(self.peak_rss.get(pid, 0.0), _read_rss_mb(pid))
+
+    def worker_stats(self) -> dict:
+        workers = [pid for pid in self.cpu if pid != self.root_pid]
+        return {
+            "parent_cpu_s": self.cpu.get(self.root_pid, 0.0),
+            "parent_peak_rss_mb": self.peak_rss.get(self.root_pid, 0.0),
+            "workers": len(workers),
+            "worker_cpu_s_avg": sum(self.cpu[p] for p in workers) / len(workers) if workers else 0.0,
+            "worker_peak_rss_mb_avg": sum(self.peak_rss[p] for p in workers) / len(workers) if workers else 0.0,
+            "worker_peak_rss_mb_max": max((self.peak_rss[p] for p in workers), default=0.0),
+        }
+
+
+def _iter_trace_records(trace_dir: str):
+    if not os.path.isdir(trace_dir):
+        return
+    for name in os.listdir(trace_dir):
+        if not name.endswith(".jsonl"):
+            continue
+        with open(os.path.join(trace_dir, name), "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def dialogue_latencies(trace_dir: str) -> list[float]:
+    """从 main.py 写出的 trace JSONL 中读取每个对话（dialogue span）的耗时，单位秒。"""
+    return [rec["duration_ms"] / 1000 for rec in _iter_trace_records(trace_dir) if rec["name"] == "dialogue"]
+
+
+def reply_stats(trace_dir: str) -> dict:
+    """每次 agent 回复（user.generate / system.generate span）的 LLM 调用数与耗时。"""
+    calls, durations = [], []
+    for rec in _iter_trace_records(trace_dir):
+        if rec["name"] in ("user.generate", "system.generate"):
+            calls.append(rec["llm_calls"])
+            durations.append(rec["duration_ms"] / 1000)
+    return {
+        "replies": len(calls),
+        "llm_calls_per_reply": sum(calls) / len(calls) if calls else 0.0,
+        "reply_p50_s": _percentile(durations, 0.5),
+        "reply_p95_s": _percentile(durations, 0.95),
+    }
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round((len(ordered) - 1) * q)))]
+
+
+def _http_json(url: str, data: dict | None = None) -> dict:
+    req = urllib.request.Request(
+        url,
+        data=json.dumps(data).encode("utf-8") if data is not None else None,
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(req) as resp:
+        return json.loads(resp.read())
+
+
+def run_once(base_url: str, profile_path: str, workdir: str, concurrency: int, async_mode: bool, overrides: dict) -> dict:
+    server_root = base_url.rsplit("/v1", 1)[0]
+    _http_json(f"{server_root}/reset", {})
+
+    tag = f"{'async' if async_mode else 'pool'}_{concurrency}_{int(time.time() * 1000)}"
+    output_path = os.path.join(workdir, f"bench_{tag}.jsonl")
+    trace_dir = os.path.join(workdir, "traces", tag)
+    # 每次运行独立的检查点目录，前一个变体失败留下的检查点不会被下一个变体续跑
+    checkpoint_dir = os.path.join(workdir, "checkpoints", tag)
+    env = dict(os.environ)
+    env.update({
+        "CFG_BASE_URL": base_url,
+        "CFG_API_KEY": "mock-key",
+        "CFG_DIALOGUE_MAX_WORKERS": str(concurrency),
+        "CFG_ASYNC_MODE": "true" if async_mode else "false",
+        "CFG_ASYNC_MAX_CONCURRENCY": str(concurrency),
+        "CFG_LLM_CACHE_MODE": "off",
+        "CFG_TRACE_DIR": trace_dir,
+        "CFG_CHECKPOINT_DIR": checkpoint_dir,
+        "CFG_ENABLE_TRACING": "true",
+    })
+    for key, value in overrides.items():
+        env[f"CFG_{key}"] = value
+
+    cmd = [sys.executable, "main.py", "--profiles", profile_path, "--output", output_path, "--limit", "0", "--finalize", ""]
+    log_path = os.path.join(workdir, f"bench_{tag}.log")
+    start = time.perf_counter()
+    # 输出写到文件而不是管道，避免日志填满管道缓冲区阻塞子进程
+    with open(log_path, "w", encoding="utf-8") as log_file:
+        proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=log_file, stderr=subprocess.STDOUT)
+        monitor = ProcessTreeMonitor(proc.pid)
+        while proc.poll() is None:
+            monitor.poll()
+            time.sleep(0.2)
+    elapsed = time.perf_counter() - start
+    with open(log_path, "r", encoding="utf-8", errors="replace") as f:
+        log_tail = f.read()[-2000:]
+
+    stats = _http_json(f"{server_root}/stats")
+    dialogues = sum(1 for line in open(output_path, encoding="utf-8") if line.strip()) if os.path.exists(output_path) else 0
+    calls = stats.get("total", 0)
+    latencies = dialogue_latencies(trace_dir)
+    return {
+        "mode": "async" if async_mode else "pool",
+        "concurrency": concurrency,
+        "overrides": overrides,
+        "exit_code": proc.returncode,
+        "dialogues": dialogues,
+        "elapsed_s": elapsed,
+        "dialogues_per_s": dialogues / elapsed if elapsed > 0 else 0.0,
+        "llm_calls": calls,
+        "llm_calls_per_dialogue": calls / dialogues if dialogues else 0.0,
+        "dialogue_p50_s": _percentile(latencies, 0.5),
+        "dialogue_p95_s": _percentile(latencies, 0.95),
+        **reply_stats(trace_dir),
+        "call_breakdown": {k: v for k, v in stats.items() if k != "total"},
+        **monitor.worker_stats(),
+        "log_tail": log_tail if proc.returncode else "",
+    }
+
+
+def parse_variant(spec: str) -> tuple[str, dict]:
+    """解析 name:KEY=VALUE;KEY2=VALUE2 形式的变体，返回 (name, overrides)。"""
+    name, _, rest = spec.partition(":")
+    overrides = {}
+    for part in rest.split(";"):
+        if part.strip():
+            key, _, value = part.partition("=")
+            overrides[key.strip()] = value.strip()
+    return name or "default", overrides
+
+
+def print_table(results: list[dict]):
+    header = f"{'variant':<14}{'mode':<7}{'conc':>6}{'dlg':>6}{'dlg/s':>9}{'calls/dlg':>11}{'p50 s':>8}{'p95 s':>8}{'calls/rep':>11}{'rep p50':>9}{'wrk cpu s':>11}{'wrk rss MB':>12}{'parent rss':>12}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(
+            f"{r['variant']:<14}{r['mode']:<7}{r['concurrency']:>6}{r['dialogues']:>6}"
+            f"{r['dialogues_per_s']:>9.3f}{r['llm_calls_per_dialogue']:>11.1f}"
+            f"{r['dialogue_p50_s']:>8.1f}{r['dialogue_p95_s']:>8.1f}"
+            f"{r['llm_calls_per_reply']:>11.2f}{r['reply_p50_s']:>9.2f}"
+            f"{r['worker_cpu_s_avg']:>11.1f}{r['worker_peak_rss_mb_avg']:>12.0f}{r['parent_peak_rss_mb']:>12.0f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Offline throughput benchmark against a mock OpenAI server.")
+    parser.add_argument("--profiles", type=int, default=32, help="Number of synthetic profiles per run.")
+    parser.add_argument("--workers", default="1,4,8,16", help="Comma-separated worker counts (concurrency in --async-mode).")
+    parser.add_argument("--async-mode", action="store_true", help="Benchmark ASYNC_MODE instead of the process pool.")
+    parser.add_argument("--variant", action="append", default=[], help="name:KEY=VALUE;... config overrides to compare.")
+    parser.add_argument("--json-out", default="", help="Also write raw results to this JSON file.")
+    add_behavior_args(parser)
+    args = parser.parse_args()
+
+    server = start_mock_server(behavior_from_args(args))
+    base_url = f"http://127.0.0.1:{server.server_address[1]}/v1"
+    print(f"Mock server: {base_url}  latency={args.latency} fail_rate={args.fail_rate} intents={args.intent_mix}")
+
+    variants = [parse_variant(v) for v in args.variant] or [("default", {})]
+    results = []
+    with tempfile.TemporaryDirectory(prefix="bench_") as workdir:
+        profile_path = os.path.join(workdir, "profiles.json")
+        with open(profile_path, "w", encoding="utf-8") as f:
+            json.dump(make_synthetic_profiles(args.profiles), f)
+
+        for name, overrides in variants:
+            for concurrency in [int(w) for w in args.workers.split(",") if w.strip()]:
+                print(f"> {name}: {'async' if args.async_mode else 'pool'} x{concurrency} ...", flush=True)
+                result = run_once(base_url, profile_path, workdir, concurrency, args.async_mode, overrides)
+                result["variant"] = name
+                results.append(result)
+                if result["exit_code"]:
+                    print(f"  main.py exited with {result['exit_code']}:\n{result['log_tail']}")
+
+    server.shutdown()
+    print()
+    print_table(results)
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\nRaw results written to {args.json_out}")
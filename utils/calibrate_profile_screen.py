@@ -0,0 +1,62 @@
+"""
+根据 LLM 的 PROFILE 审查结论校准本地预筛阈值（见 modules/profile_screen.py）。
+
+1) 先以 shadow 模式运行一批对话，每次审查同时记录本地分数与 LLM 结论:
+    CFG_PROFILE_SCREEN_MODE='"shadow"' python main.py --limit 200
+2) 拟合阈值并写入校准文件（PROFILE_SCREEN_MODE="on" 时自动读取）:
+    python -m utils.calibrate_profile_screen output/traces/trace_*.jsonl --target-precision 0.95
+"""
+import argparse
+import json
+import math
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from modules.profile_screen import load_screen_samples, fit_thresholds, evaluate_thresholds
+
+
+def print_report(title: str, stats: dict):
+    print(f"{title}:")
+    print(f"  samples:              {stats['samples']}")
+    print(f"  pass_threshold:       {stats['pass_threshold']:.4f}")
+    print(f"  fail_threshold:       {stats['fail_threshold']:.4f}")
+    print(f"  auto-decided:         {stats['auto_decided']} ({stats['calls_saved_rate']:.1%} of LLM calls saved)")
+    print(f"  agreement (auto):     {stats['auto_agreement_rate']:.1%}")
+    print(f"  agreement (overall):  {stats['overall_agreement_rate']:.1%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fit local profile pre-screen thresholds against logged LLM verdicts.")
+    parser.add_argument("traces", nargs="+", help="Trace JSONL files from a PROFILE_SCREEN_MODE=shadow run.")
+    parser.add_argument("--target-precision", type=float, default=0.95, help="Required agreement with the LLM in each auto band.")
+    parser.add_argument("--min-support", type=int, default=20, help="Minimum samples in an auto band.")
+    parser.add_argument("--output", default=config.PROFILE_SCREEN_CALIBRATION_PATH, help="Where to write the fitted thresholds.")
+    args = parser.parse_args()
+
+    samples = load_screen_samples([p for p in args.traces if not p.endswith(".chrome.json")])
+    if not samples:
+        print("No shadow-mode profile reviews found in the given traces.")
+        sys.exit(1)
+    llm_pass_rate = sum(p for _, p in samples) / len(samples)
+    print(f"Loaded {len(samples)} reviews (LLM PASS rate {llm_pass_rate:.1%})\n")
+
+    print_report("Current thresholds", evaluate_thresholds(
+        samples, config.PROFILE_SCREEN_PASS_THRESHOLD, config.PROFILE_SCREEN_FAIL_THRESHOLD
+    ))
+    fitted = fit_thresholds(samples, args.target_precision, args.min_support)
+    print()
+    print_report("Fitted thresholds", fitted)
+
+    os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+    with open(args.output, "w", encoding="utf-8") as f:
+        # 永不触发的阈值用 ±1e9 表示，保证 JSON 可读
+        json.dump({
+            **fitted,
+            "pass_threshold": fitted["pass_threshold"] if math.isfinite(fitted["pass_threshold"]) else 1e9,
+            "fail_threshold": fitted["fail_threshold"] if math.isfinite(fitted["fail_threshold"]) else -1e9,
+            "target_precision": args.target_precision,
+        }, f, indent=2)
+    print(f"\nCalibration written to {args.output}")
@@ -0,0 +1,48 @@
+"""
+合并 main.py --shard K/N 在多台机器上产生的 JSONL 输出。
+
+用法（在仓库根目录执行）:
+    python -m utils.merge_shards --profiles output/sample_profile_100.json \
+        --output output/dialogue_merged.json output/shard_*.jsonl
+"""
+import argparse
+import itertools
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from modules.profile_source import iter_profiles
+from modules.result_store import merge_jsonl_outputs
+
+
+def load_user_order(profile_path: str, limit: int = 0) -> list[str]:
+    # 与 main.py 相同的流式读取（JSON 数组 / 单个对象 / JSONL），只保留 user_id
+    profiles = iter_profiles(profile_path)
+    if limit and limit > 0:
+        profiles = itertools.islice(profiles, limit)
+    return [p.get("user_id", f"user_{idx}") for idx, p in enumerate(profiles)]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Merge per-shard JSONL dialogue outputs in profile order.")
+    parser.add_argument("inputs", nargs="+", help="Per-shard JSONL files.")
+    parser.add_argument("--profiles", required=True, help="The profile file the shards were generated from.")
+    parser.add_argument("--limit", type=int, default=0, help="Same --limit the shards were run with (0 = all).")
+    parser.add_argument("--output", required=True, help="Merged output (.json array, or .jsonl).")
+    args = parser.parse_args()
+
+    user_order = load_user_order(args.profiles, args.limit)
+    stats = merge_jsonl_outputs(args.inputs, args.output, user_order)
+
+    print(f"Merged {stats['merged']} dialogues from {len(args.inputs)} file(s) into {args.output}")
+    print(f"Missing: {len(stats['missing'])}")
+    for uid in stats["missing"][:20]:
+        print(f"  - {uid}")
+    if len(stats["missing"]) > 20:
+        print(f"  ... and {len(stats['missing']) - 20} more")
+    print(f"Duplicated: {len(stats['duplicated'])}")
+    for uid, files in list(stats["duplicated"].items())[:20]:
+        print(f"  - {uid}: {', '.join(files)}")
+    if stats["unknown"]:
+        print(f"Not in profile file: {len(stats['unknown'])}")
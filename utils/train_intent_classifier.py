@@ -0,0 +1,67 @@
+"""
+训练 / 评估本地意图分类器（见 modules/intent_classifier.py）。
+
+1) 以 INTENT_CLASSIFIER_MODE="log" 运行一批对话，记录 LLM 的意图判断:
+    CFG_INTENT_CLASSIFIER_MODE='"log"' python main.py --limit 200
+2) 训练并报告与 LLM 标签的一致率，模型写入 INTENT_CLASSIFIER_PATH:
+    python -m utils.train_intent_classifier --threshold 0.9
+   仅评估已有模型:
+    python -m utils.train_intent_classifier --eval-only
+"""
+import argparse
+import os
+import sys
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from modules.intent_classifier import LABELS, IntentClassifier, load_intent_log, evaluate
+from modules.tools import get_shared_model
+
+
+def print_report(title: str, stats: dict):
+    print(f"{title} ({stats['samples']} samples):")
+    print(f"  accuracy vs LLM:      {stats['accuracy']:.1%}")
+    print(f"  coverage @ {stats['threshold']:.2f}:     {stats['coverage']:.1%} of judgements answered locally")
+    print(f"  accuracy when local:  {stats['confident_accuracy']:.1%}")
+    print(f"  accuracy with LLM fallback: {stats['effective_accuracy']:.1%}")
+    for label, s in stats["per_class"].items():
+        print(f"    {label:<8} support={s['support']:<6} accuracy={s['accuracy']:.1%}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Train and evaluate the local intent classifier against logged LLM labels.")
+    parser.add_argument("--log", default=config.INTENT_LOG_PATH, help="JSONL of logged LLM intent judgements.")
+    parser.add_argument("--model", default=config.INTENT_CLASSIFIER_PATH, help="Where to save / load the classifier.")
+    parser.add_argument("--threshold", type=float, default=config.INTENT_CLASSIFIER_THRESHOLD, help="Confidence needed to skip the LLM.")
+    parser.add_argument("--test-ratio", type=float, default=0.2)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--eval-only", action="store_true", help="Evaluate the saved model on the whole log.")
+    args = parser.parse_args()
+
+    texts, labels = load_intent_log(args.log)
+    if not texts:
+        print(f"No logged judgements in {args.log}")
+        sys.exit(1)
+    y = np.array([LABELS.index(label) for label in labels])
+    print(f"Loaded {len(texts)} judgements: " + ", ".join(f"{l}={int((y == k).sum())}" for k, l in enumerate(LABELS)))
+
+    X = np.asarray(get_shared_model().encode(texts, normalize_embeddings=True, batch_size=128), dtype="float32")
+
+    if args.eval_only:
+        print_report("Saved model", evaluate(IntentClassifier.load(args.model), X, y, args.threshold))
+        sys.exit(0)
+
+    order = np.random.default_rng(args.seed).permutation(len(y))
+    n_test = int(len(y) * args.test_ratio)
+    test_idx, train_idx = order[:n_test], order[n_test:]
+
+    classifier = IntentClassifier().fit(X[train_idx], y[train_idx])
+    print_report("Train", evaluate(classifier, X[train_idx], y[train_idx], args.threshold))
+    if n_test:
+        print_report("Held-out", evaluate(classifier, X[test_idx], y[test_idx], args.threshold))
+
+    # 评估完后用全部数据重新训练再保存
+    IntentClassifier().fit(X, y).save(args.model)
+    print(f"\nClassifier written to {args.model}")